@@ -0,0 +1,59 @@
+"""
+Compare the dict based chase tableau with the matrix based one on a context
+of many relations and attributes.
+
+Usage: python -m benchmarks.lossless [relations] [attributes]
+"""
+import random
+import sys
+import timeit
+
+from pyro.lossless import build_tableau, _build_matrix, chase, chase_matrix
+
+
+def generate(n_relations, n_attributes, seed=0):
+    """
+    Generate chain of relations, each having its own key and a foreign key
+    of the next relation, and the dependencies held on them.
+    """
+    rnd = random.Random(seed)
+    attributes = ['A{}'.format(i) for i in range(n_attributes)]
+    keys = attributes[:n_relations]
+    others = attributes[n_relations:]
+    relations = []
+    deps = []
+    for i, key in enumerate(keys):
+        own = rnd.sample(others, len(others) // n_relations)
+        relation_attributes = {key} | set(own)
+        if i + 1 < n_relations:
+            relation_attributes.add(keys[i + 1])
+        relations.append({'name': 'R{}'.format(i),
+                          'attributes': {a: 'INT'
+                                         for a in relation_attributes}})
+        deps.append({'left': {key}, 'right': relation_attributes - {key}})
+    rnd.shuffle(deps)
+    return relations, deps
+
+
+def main(n_relations=25, n_attributes=250, number=5):
+    relations, deps = generate(n_relations, n_attributes)
+
+    def run_dict():
+        return chase(build_tableau(relations), deps)
+
+    def run_matrix():
+        attributes, matrix = _build_matrix(relations)
+        return chase_matrix(matrix, attributes, deps)
+
+    assert run_dict() == run_matrix()
+    dict_time = min(timeit.repeat(run_dict, number=number, repeat=3)) / number
+    matrix_time = min(timeit.repeat(run_matrix, number=number,
+                                    repeat=3)) / number
+    print('{} relations, {} attributes'.format(n_relations, n_attributes))
+    print('dict:   {:.4f}s'.format(dict_time))
+    print('matrix: {:.4f}s'.format(matrix_time))
+    print('speedup: {:.1f}x'.format(dict_time / matrix_time))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
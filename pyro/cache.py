@@ -1,22 +1,341 @@
 import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
 from json import JSONDecodeError
 
-from pyro import db
-from pyro.constraints.operations import is_domain_included, equal
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pyro import db, cfg
+from pyro.constraints.operations import is_domain_included, fingerprint
 from pyro.utils import SQLAlchemySerializer
 
 
+@contextmanager
+def _locked(config_file):
+    """
+    Hold exclusive advisory lock on the opened file if the platform supports
+    it, so cache registry can be shared between processes.
+    """
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(config_file, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(config_file, fcntl.LOCK_UN)
+
+
+def _load(config_file):
+    config_file.seek(0)
+    try:
+        return json.load(config_file)
+    except JSONDecodeError:
+        return None
+
+
+def _context_key(context_names):
+    return json.dumps(sorted(set(context_names)))
+
+
+def _entry_key(context, constraint):
+    """
+    Key identifying cache entries of the same context and equal constraints.
+    """
+    return (_context_key(map(lambda r: r['name'], context)),
+            fingerprint(constraint))
+
+
+def _has_attributes(entry, attributes=None):
+    """
+    Check whether TJ of the cache entry has all the given attributes its
+    context has. TJs might be built with some attributes left out.
+    """
+    if attributes is None:
+        return True
+    context_attributes = {name for relation in entry['context']
+                          for name in relation['attributes']}
+    return context_attributes.intersection(attributes).issubset(
+        entry['relation']['attributes'])
+
+
+def _process_start(pid):
+    """
+    Start time of the process in clock ticks since boot, it tells the
+    processes having the same reused PID apart. None if it's unknown, e.g.
+    there's no procfs.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            # command name might contain spaces, it's enclosed in parentheses
+            return int(stat.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _new_pin():
+    """
+    Pin of a TJ by the current process: host and id of the process, its start
+    time and time of pinning.
+    """
+    pid = os.getpid()
+    return {'host': socket.gethostname(), 'pid': pid,
+            'start': _process_start(pid), 'time': time.time()}
+
+
+def _is_same_process(pin, other_pin):
+    return (pin['host'], pin['pid'], pin['start']) == \
+        (other_pin['host'], other_pin['pid'], other_pin['start'])
+
+
+def _is_alive(pin):
+    """
+    Check whether the process holding the pin is still running. Processes of
+    other hosts can't be checked, so their pins expire `cache_pin_timeout`
+    seconds after the last hit.
+    """
+    if pin['host'] != socket.gethostname():
+        return time.time() - pin['time'] < \
+            cfg.settings.get('cache_pin_timeout', 86400)
+    try:
+        os.kill(pin['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # PID might have been reused by another process
+    return pin['start'] is None or \
+        _process_start(pin['pid']) in (None, pin['start'])
+
+
+def _new_usage(rows=0, size=0):
+    """
+    Accounting record of a cache entry: number of rows and estimated size of
+    the TJ, number of cache hits, time of the last hit and pins of the
+    processes using the TJ (see `_new_pin`).
+    """
+    return {'rows': rows, 'size': size, 'hits': 0, 'last_hit': time.time(),
+            'pins': [_new_pin()]}
+
+
+class SQLiteRegistry:
+    """
+    Register of cached Tables of Joins stored in indexed tables of a SQLite
+    file. Entries are keyed by the sorted names of their context relations
+    and the constraint fingerprint, so entry of the same context and
+    constraint is found with an index lookup, and every context relation is
+    indexed to find entries of the contexts contained in a given one without
+    scanning the whole register.
+    """
+    def __init__(self, file):
+        self._connection = sqlite3.connect(file, timeout=30)
+        try:
+            self._connection.execute('SELECT name FROM sqlite_master')
+        except sqlite3.DatabaseError:
+            self._connection.close()
+            raise ValueError('Cache file {} is not a SQLite database, e.g. '
+                             'it\'s a JSON cache register. Set `cache_file` '
+                             'to another file to use the sqlite cache '
+                             'backend'.format(file))
+        with self._connection as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries ('
+                         'id INTEGER PRIMARY KEY, '
+                         'relation_name TEXT UNIQUE, '
+                         'context_key TEXT, '
+                         'constraint_key TEXT, '
+                         'context_size INTEGER, '
+                         'entry TEXT, '
+                         'rows INTEGER DEFAULT 0, '
+                         'size INTEGER DEFAULT 0, '
+                         'hits INTEGER DEFAULT 0, '
+                         'last_hit REAL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS '
+                         'ix_cache_entries_last_hit '
+                         'ON cache_entries (last_hit)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+                         'ix_cache_entries_key '
+                         'ON cache_entries (context_key, constraint_key)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entry_relations ('
+                         'relation_name TEXT, '
+                         'entry_id INTEGER, '
+                         'PRIMARY KEY (relation_name, entry_id))')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_pins ('
+                         'relation_name TEXT, '
+                         'host TEXT, '
+                         'pid INTEGER, '
+                         'start INTEGER, '
+                         'time REAL, '
+                         'PRIMARY KEY (relation_name, host, pid))')
+
+    def find(self, context, constraint):
+        """
+        Get entry having exactly the given context and constraint.
+
+        :param context: list of relations
+        :param constraint: logical constraint
+        :return: entry or None if there's no such one
+        """
+        row = self._connection.execute(
+            'SELECT entry FROM cache_entries '
+            'WHERE context_key = ? AND constraint_key = ?',
+            _entry_key(context, constraint)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def entries_within(self, context_names):
+        """
+        Get entries whose context is a subset of the given context.
+
+        :param context_names: names of context relations
+        :return: list of entries in order they were added
+        """
+        names = sorted(set(context_names))
+        rows = self._connection.execute(
+            'SELECT e.id, e.entry FROM cache_entries e JOIN ('
+            '  SELECT entry_id, COUNT(*) AS n FROM cache_entry_relations'
+            '  WHERE relation_name IN ({})'
+            '  GROUP BY entry_id'
+            ') m ON m.entry_id = e.id '
+            'WHERE m.n = e.context_size '
+            'UNION ALL '
+            'SELECT id, entry FROM cache_entries WHERE context_key = ? '
+            'ORDER BY 1'.format(', '.join('?' * len(names))),
+            names + [_context_key([])])
+        return [json.loads(entry) for _, entry in rows]
+
+    def add(self, entry, usage=None):
+        """
+        Add entry in a single transaction unless its TJ or an entry with the
+        same context and constraint is registered already.
+
+        :param entry: dict with relation, context and constraint
+        :param usage: accounting record of the entry, new one by default
+        :return: True if entry was added
+        """
+        usage = usage or _new_usage()
+        name = entry['relation']['name']
+        names = set(map(lambda r: r['name'], entry['context']))
+        context_key, constraint_key = _entry_key(entry['context'],
+                                                 entry['constraint'])
+        with self._connection as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO cache_entries '
+                '(relation_name, context_key, constraint_key, context_size, '
+                'entry, rows, size, hits, last_hit) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, context_key, constraint_key, len(names),
+                 json.dumps(entry, cls=SQLAlchemySerializer,
+                            ensure_ascii=False),
+                 usage['rows'], usage['size'], usage['hits'],
+                 usage['last_hit']))
+            if not cursor.rowcount:
+                return False
+            conn.executemany(
+                'INSERT INTO cache_entry_relations (relation_name, entry_id) '
+                'VALUES (?, ?)', [(n, cursor.lastrowid) for n in names])
+            conn.executemany(
+                'INSERT OR REPLACE INTO cache_pins '
+                '(relation_name, host, pid, start, time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(name, pin['host'], pin['pid'], pin['start'], pin['time'])
+                 for pin in usage['pins']])
+        return True
+
+    def touch(self, relation_name, pin):
+        """
+        Register cache hit of the TJ by the process holding the pin.
+
+        :return: True if the process hasn't pinned the TJ before
+        """
+        with self._connection as conn:
+            conn.execute('UPDATE cache_entries SET hits = hits + 1, '
+                         'last_hit = ? WHERE relation_name = ?',
+                         (time.time(), relation_name))
+            old_pin = conn.execute(
+                'SELECT start FROM cache_pins '
+                'WHERE relation_name = ? AND host = ? AND pid = ?',
+                (relation_name, pin['host'], pin['pid'])).fetchone()
+            conn.execute('INSERT OR REPLACE INTO cache_pins '
+                         '(relation_name, host, pid, start, time) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (relation_name, pin['host'], pin['pid'],
+                          pin['start'], pin['time']))
+        return old_pin is None or old_pin[0] != pin['start']
+
+    def unpin(self, relation_name, pin):
+        """
+        Remove pin of the TJ by the process.
+        """
+        with self._connection as conn:
+            conn.execute('DELETE FROM cache_pins '
+                         'WHERE relation_name = ? AND host = ? AND pid = ?',
+                         (relation_name, pin['host'], pin['pid']))
+
+    def usage(self):
+        """
+        Get accounting records of all entries.
+
+        :return: list of tuples (TJ name, usage record), least recently hit
+            go first
+        """
+        pins = {}
+        for name, host, pid, start, pin_time in self._connection.execute(
+                'SELECT relation_name, host, pid, start, time '
+                'FROM cache_pins'):
+            pins.setdefault(name, []).append(
+                {'host': host, 'pid': pid, 'start': start, 'time': pin_time})
+        rows = self._connection.execute(
+            'SELECT relation_name, rows, size, hits, last_hit '
+            'FROM cache_entries ORDER BY last_hit, id')
+        return [(name, {'rows': n, 'size': size, 'hits': hits,
+                        'last_hit': last_hit, 'pins': pins.get(name, [])})
+                for name, n, size, hits, last_hit in rows]
+
+    def remove(self, relation_name):
+        """
+        Remove entry of the TJ from the register.
+        """
+        with self._connection as conn:
+            conn.execute('DELETE FROM cache_entry_relations WHERE entry_id IN '
+                         '(SELECT id FROM cache_entries '
+                         'WHERE relation_name = ?)', (relation_name,))
+            conn.execute('DELETE FROM cache_entries WHERE relation_name = ?',
+                         (relation_name,))
+            conn.execute('DELETE FROM cache_pins WHERE relation_name = ?',
+                         (relation_name,))
+
+
 class Cache:
     """
     Class implementing register of cached Tables of Joins. It also has a state
     of enabled TJ that can be used to restore data into some other table.
+
+    Register is kept in a JSON file unless `cache_backend` setting is
+    'sqlite', then `SQLiteRegistry` is used.
+
+    Usage of each TJ is accounted (see `_new_usage`), so that the least
+    recently hit ones can be evicted. TJs are pinned by the processes that
+    built or hit them, and are not evicted while those processes are alive.
+    TJ restored from is unpinned on `release`.
     """
     def __init__(self, engine, file):
         self._engine = engine
         self._file = file
         self._config = None
+        # entries of the JSON register by `_entry_key` and TJ names
+        self._index = {}
+        self._relation_names = set()
+        self._registry = None
         self._active_entry = None
+        # whether active entry's TJ was pinned when cache was enabled
+        self._pinned = False
         self.enabled = False
+        self.partial = False
 
         self.read_config(self._file)
 
@@ -28,49 +347,160 @@ class Cache:
         :param file: path of the configuration file to use
         :type file: str
         """
-        with open(file, 'a+') as config_file:
-            config_file.seek(0)
-            try:
-                self._config = json.load(config_file)
-            except JSONDecodeError:
-                self._config = []
-                json.dump(self._config, config_file)
         self._active_entry = None
+        self._pinned = False
         self.enabled = False
+        self.partial = False
+        if cfg.settings.get('cache_backend', 'json') == 'sqlite':
+            self._registry = SQLiteRegistry(file)
+            return
+        with open(file, 'a+') as config_file, _locked(config_file):
+            self._config = _load(config_file)
+            if self._config is None:
+                self._config = []
+                config_file.truncate(0)
+                json.dump(self._config, config_file)
+        self._index_entries()
+
+    def _index_entries(self):
+        self._index = {}
+        for entry in self._config:
+            self._index.setdefault(
+                _entry_key(entry['context'], entry['constraint']), entry)
+        self._relation_names = {entry['relation']['name']
+                                for entry in self._config}
+
+    def _update_config(self, update):
+        """
+        Apply `update` function to the JSON register re-read from the file,
+        as it might have been changed by other processes, and write it back.
+        """
+        with open(self._file, 'a+') as config_file, \
+                _locked(config_file):
+            config = _load(config_file) or []
+            update(config)
+            config_file.truncate(0)
+            json.dump(config, config_file, cls=SQLAlchemySerializer,
+                      ensure_ascii=False)
+        self._config = config
+        self._index_entries()
+
+    def _touch(self, entry):
+        """
+        Register cache hit of the entry and pin its TJ by the current process.
+        Pins of the processes that aren't alive are dropped.
+
+        :return: True if the process hasn't pinned the TJ before
+        """
+        relation_name = entry['relation']['name']
+        pin = _new_pin()
+        if self._registry is not None:
+            return self._registry.touch(relation_name, pin)
+        pinned = []
+
+        def touch(config):
+            for e in config:
+                if e['relation']['name'] == relation_name:
+                    usage = e.setdefault('usage', _new_usage())
+                    usage['hits'] += 1
+                    usage['last_hit'] = time.time()
+                    pins = [p for p in usage['pins']
+                            if not _is_same_process(p, pin)]
+                    pinned.append(len(pins) == len(usage['pins']))
+                    usage['pins'] = [p for p in pins if _is_alive(p)] + [pin]
+        self._update_config(touch)
+        return all(pinned)
+
+    def _unpin(self, entry):
+        relation_name = entry['relation']['name']
+        pin = _new_pin()
+        if self._registry is not None:
+            self._registry.unpin(relation_name, pin)
+            return
 
-    def enable(self, context, constraint):
+        def unpin(config):
+            for e in config:
+                if e['relation']['name'] == relation_name and 'usage' in e:
+                    e['usage']['pins'] = [p for p in e['usage']['pins']
+                                          if not _is_same_process(p, pin)]
+        self._update_config(unpin)
+
+    def enable(self, context, constraint, attributes=None):
         """
         Activate cache functionality for the given context with logical
-        constraint if there is cached data that has all required rows. Set
-        enabled flag to True if the appropriate cache entry was found.
+        constraint if there is cached data that has all required rows and
+        attributes. Set enabled flag to True if the appropriate cache entry
+        was found.
+
+        Unless `partial_cache_hits` setting is false, cache entry whose
+        constraint doesn't include the given one is used as well, then
+        `partial` flag is set and rows satisfying the given constraint but
+        not the cached one (see `constraint` property) have to be obtained
+        elsewhere.
 
         :param context: list of relations in the join
         :param constraint: list of lists of predicates, representing logical
             constraint
+        :param attributes: names of attributes cached TJ should have if its
+            context has them, they aren't checked by default
         """
-        for entry in self._config:
+        entries = self._config
+        if self._registry is not None:
+            entries = self._registry.entries_within(
+                map(lambda r: r['name'], context))
+        partial_entry = None
+        for entry in entries:
             context_names = map(lambda r: r['name'], context)
             entry_names = map(lambda r: r['name'], entry['context'])
             context_supersets = set(entry_names).issubset(context_names)
-            if not context_supersets:
+            if not context_supersets or \
+                    not _has_attributes(entry, attributes):
                 continue
             domain_included = is_domain_included(constraint,
                                                  entry['constraint'])
             if domain_included:
                 self._active_entry = entry
                 self.enabled = True
+                self._pinned = self._touch(entry)
                 return
+            if partial_entry is None or \
+                    len(entry['context']) > len(partial_entry['context']):
+                partial_entry = entry
+        if partial_entry is not None and \
+                cfg.settings.get('partial_cache_hits', True):
+            self._active_entry = partial_entry
+            self.enabled = True
+            self.partial = True
+            self._pinned = self._touch(partial_entry)
 
-    def full_match(self, context, constraint):
-        for entry in self._config:
-            context_names = map(lambda r: r['name'], context)
-            entry_names = map(lambda r: r['name'], entry['context'])
-            contexts_equal = set(entry_names) == set(context_names)
-            if not contexts_equal:
-                continue
-            if equal(constraint, entry['constraint']):
-                return entry['relation']
-        return None
+    def release(self):
+        """
+        Unpin TJ of the active cache entry once it has been restored from,
+        unless the current process had pinned it before cache was enabled.
+        """
+        if self._active_entry is not None and self._pinned:
+            self._unpin(self._active_entry)
+        self._pinned = False
+
+    def full_match(self, context, constraint, attributes=None):
+        """
+        Find cached TJ of exactly the given context and constraint.
+
+        :param context: list of relations in the join
+        :param constraint: list of lists of predicates, representing logical
+            constraint
+        :param attributes: names of attributes cached TJ should have if its
+            context has them, they aren't checked by default
+        :return: TJ relation or None if there's no such one
+        """
+        if self._registry is not None:
+            entry = self._registry.find(context, constraint)
+        else:
+            entry = self._index.get(_entry_key(context, constraint))
+        if entry is None or not _has_attributes(entry, attributes):
+            return None
+        self._touch(entry)
+        return entry['relation']
 
     def contains(self, constraint):
         """
@@ -110,14 +540,81 @@ class Cache:
         :param constraint: list of lists of predicates, representing logical
             constraint
         """
-        if relation in map(lambda entry: entry['relation'], self._config):
-            return
         new_entry = {'relation': relation, 'context': context,
                      'constraint': constraint}
-        self._config.append(new_entry)
-        with open(self._file, 'w') as config_file:
-            json.dump(self._config, config_file, cls=SQLAlchemySerializer,
-                      ensure_ascii=False)
+        if self._registry is None and (
+                relation['name'] in self._relation_names or
+                _entry_key(context, constraint) in self._index):
+            return
+        usage = _new_usage()
+        if self._engine is not None:
+            usage['rows'], usage['size'] = db.table_size(self._engine,
+                                                         relation)
+        if self._registry is not None:
+            self._registry.add(new_entry, usage)
+            return
+        new_entry['usage'] = usage
+        self._update_config(lambda config: config.append(new_entry))
+
+    def evict(self, max_size, keep=()):
+        """
+        Drop the least recently hit TJs and their cache entries until total
+        estimated size of the cached TJs fits `max_size`. TJs pinned by
+        running processes are never dropped.
+
+        :param max_size: maximum total size in bytes
+        :param keep: names of TJs that mustn't be dropped
+        :return: list of dropped TJ names
+        """
+        if self._registry is not None:
+            usages = self._registry.usage()
+        else:
+            # entries added before accounting are the least recent ones
+            unknown = {'rows': 0, 'size': 0, 'hits': 0, 'last_hit': 0,
+                       'pins': []}
+            usages = sorted(((e['relation']['name'], e.get('usage', unknown))
+                             for e in self._config),
+                            key=lambda u: u[1]['last_hit'])
+        total = sum(usage['size'] for _, usage in usages)
+        evicted = []
+        for name, usage in usages:
+            if total <= max_size:
+                break
+            if name in keep or any(_is_alive(pin) for pin in usage['pins']):
+                continue
+            db.drop_table(self._engine, {'name': name})
+            total -= usage['size']
+            evicted.append(name)
+        if not evicted:
+            return evicted
+        if self._registry is not None:
+            for name in evicted:
+                self._registry.remove(name)
+        else:
+            def remove(config):
+                config[:] = [e for e in config
+                             if e['relation']['name'] not in evicted]
+            self._update_config(remove)
+        return evicted
+
+    @property
+    def relation(self):
+        """
+        DB relation of the active cache entry, None if cache isn't enabled.
+        """
+        if self._active_entry is None:
+            return None
+        return self._active_entry['relation']
+
+    @property
+    def constraint(self):
+        """
+        Logical constraint of the active cache entry, None if cache isn't
+        enabled.
+        """
+        if self._active_entry is None:
+            return None
+        return self._active_entry['constraint']
 
     def restore(self, dest_relation, *constraints):
         """
@@ -130,3 +627,38 @@ class Cache:
         """
         db.insert_from_select(self._engine, dest_relation,
                               self._active_entry['relation'], *constraints)
+
+    def restore_packs(self, dest_relation, attribute, packs):
+        """
+        Load the data of several relation packs from the cache to the
+        dest_relation DB relation by a single statement. Rows of a pack are
+        told apart by the value of `attribute` (the vector), which is
+        translated from the cached value to the new one.
+
+        :param dest_relation: dict describing DB table to be restored into
+        :param attribute: name of the attribute identifying the pack of a row
+        :param packs: list of (cached value, new value, constraint) tuples,
+            rows of each pack are filtered by its own logical constraint
+            unless it evaluates to unknown (NULL) for them, as such rows
+            survive building TJ as well
+        """
+        # packs sharing the constraint are filtered by the set of values
+        groups = {}
+        mapping = {}
+        for cached_value, value, constraint in packs:
+            key = fingerprint(constraint)
+            groups.setdefault(key, (constraint, []))[1].append(cached_value)
+            if cached_value != value:
+                mapping[cached_value] = value
+        if not groups:
+            return
+        filter_constraint = [
+            [{'attribute': attribute, 'operation': 'IN', 'value': values}] +
+            conjunction_clause
+            for constraint, values in groups.values()
+            for conjunction_clause in constraint or [[]]]
+        db.insert_from_select(self._engine, dest_relation,
+                              self._active_entry['relation'],
+                              filter_constraint,
+                              mapping={attribute: mapping},
+                              keep_unknown=True)
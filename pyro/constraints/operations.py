@@ -1,3 +1,5 @@
+import hashlib
+import json
 from operator import itemgetter
 
 from pyro.constraints.domains import factory
@@ -110,3 +112,56 @@ def equal(c1, c2):
         else:
             return False
     return True
+
+
+def _dump(obj):
+    return json.dumps(obj, sort_keys=True, default=str, ensure_ascii=False)
+
+
+def _normalize_value(value):
+    if isinstance(value, (list, tuple)):
+        return [_normalize_value(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _normalize_predicate(predicate):
+    operation = ' '.join(predicate['operation'].upper().split())
+    value = _normalize_value(predicate.get('value'))
+    if operation in ('IN', 'NOT IN'):
+        # order of the listed values doesn't matter
+        value = [v for _, v in sorted({_dump(v): v for v in value}.items())]
+    return {'attribute': predicate['attribute'], 'operation': operation,
+            'value': value}
+
+
+def normalize(constraint):
+    """
+    Bring constraint to the canonical form: operations are upper case, values
+    of IN lists are sorted, integral floats are integers, duplicated
+    predicates and conjunction clauses are removed and the rest are sorted.
+    Constraints having the same canonical form are equal.
+
+    :param constraint: logical constraint
+    :type constraint: list of lists of dicts
+    :return: canonical constraint
+    """
+    clauses = {}
+    for conjunction_clause in constraint:
+        predicates = {_dump(p): p
+                      for p in map(_normalize_predicate, conjunction_clause)}
+        clause = [predicates[key] for key in sorted(predicates)]
+        clauses[_dump(clause)] = clause
+    return [clauses[key] for key in sorted(clauses)]
+
+
+def fingerprint(constraint):
+    """
+    Stable hash of the canonical form of the constraint, see `normalize`.
+
+    :param constraint: logical constraint
+    :type constraint: list of lists of dicts
+    :return: hex digest string
+    """
+    return hashlib.sha1(_dump(normalize(constraint)).encode()).hexdigest()
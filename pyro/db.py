@@ -1,18 +1,41 @@
 import operator
 from copy import deepcopy
-from functools import reduce
+from threading import RLock
+from weakref import WeakKeyDictionary
 
 from sqlalchemy import Column, Table, MetaData, select, column, delete, \
-    distinct, insert, table
+    distinct, insert, table, exists, literal, literal_column, case, true
 from sqlalchemy import text
 from sqlalchemy.sql.elements import and_, or_, between, not_
-from sqlalchemy.sql.functions import count
-from sqlalchemy.types import Integer, _Binary, LargeBinary
+from sqlalchemy.sql.functions import count, func
+from sqlalchemy.types import Integer, String, _Binary, LargeBinary
 
-from pyro.utils import containing_relation, common_keys, chunks
+from pyro.utils import containing_relation, common_keys, chunks, batches, \
+    all_attributes
+from pyro.joins import join_order, join_equalities
 # noinspection PyUnresolvedReferences
 from pyro import compilers, cfg
 
+# name source SQLite DB file is attached under to the cube DB connection
+SQLITE_SOURCE_SCHEMA = 'pyro_source'
+
+# metadata of each engine holding tables reflected so far, so that every
+# table is reflected only once per run. Kept in sync by `create_table` and
+# `drop_table`, use `invalidate_metadata` after changing schema other way
+_metadata_registry = WeakKeyDictionary()
+# registry is shared by threads building relation packs concurrently
+_metadata_lock = RLock()
+
+# number of rows of the tables of each engine counted so far, used to order
+# joined relations when `join_order` setting is 'cardinality'
+_cardinality_registry = WeakKeyDictionary()
+
+# dialect specific operators comparing two values so that NULL equals NULL
+NULL_SAFE_OPERATORS = {
+    'sqlite': 'IS',
+    'mysql': '<=>',
+}
+
 
 def _transform_column_type(column_type):
     """
@@ -35,13 +58,13 @@ def _transform_column_type(column_type):
     return new_type
 
 
-def _attrs_to_columns(metadata, relations, attributes):
+def _attrs_to_columns(tables, relations, attributes):
     """
     Retrieve all those columns from `attributes` that actually exist in
     `relations` list of relations. Set table name for those columns so they are
     ready for selection query.
 
-    :param metadata: SQLAlchemy metadata bound to the DB engine
+    :param tables: dict of relation name -> SQLAlchemy table
     :param relations: list of relations to consider
     :param attributes: list of attributes to filter
     :return: list of resulting columns
@@ -51,12 +74,56 @@ def _attrs_to_columns(metadata, relations, attributes):
     for col in columns:
         try:
             relation = containing_relation(relations, col.name)
-            col.table = metadata.tables[relation['name']]
+            col.table = tables[relation['name']]
             yield col
         except ValueError:
             pass
 
 
+def _get_metadata(engine):
+    with _metadata_lock:
+        metadata = _metadata_registry.get(engine)
+        if metadata is None:
+            metadata = MetaData(engine)
+            _metadata_registry[engine] = metadata
+        return metadata
+
+
+def _get_table(engine, relation_name):
+    """
+    Get reflected table from the metadata registry, reflecting it on first
+    access.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relation_name: name of the table
+    :return: SQLAlchemy table
+    """
+    with _metadata_lock:
+        metadata = _get_metadata(engine)
+        if relation_name not in metadata.tables:
+            metadata.reflect(only=[relation_name])
+        return metadata.tables[relation_name]
+
+
+def _forget_table(engine, relation_name):
+    with _metadata_lock:
+        metadata = _metadata_registry.get(engine)
+        if metadata is not None and relation_name in metadata.tables:
+            metadata.remove(metadata.tables[relation_name])
+
+
+def invalidate_metadata(engine):
+    """
+    Drop all reflected tables of the engine from the registry, so they are
+    reflected again on next access.
+
+    :param engine: SQLAlchemy engine to be used
+    """
+    with _metadata_lock:
+        _metadata_registry.pop(engine, None)
+        _cardinality_registry.pop(engine, None)
+
+
 def get_schema(engine):
     """
     Obtain DB schema and transform it into Python types.
@@ -71,7 +138,8 @@ def get_schema(engine):
     :rtype: tuple
     :return list of relations, list of dependencies
     """
-    metadata = MetaData(engine, reflect=True)
+    metadata = _get_metadata(engine)
+    metadata.reflect()
 
     relations = []
     dependencies = []
@@ -99,21 +167,35 @@ def get_schema(engine):
     return relations, dependencies
 
 
-def create_table(engine, relation):
+def create_table(engine, relation, indexes=()):
     """
     Execute CREATE TABLE on desired DB with specified name/attributes.
 
     :param engine: SQLAlchemy engine to be used
     :param relation: table name
+    :param indexes: names of attributes to create an index on
     """
     cube_metadata = MetaData(engine)
-    columns = {Column(name, type) for name, type in
+    columns = {Column(name, type, index=name in indexes) for name, type in
                relation['attributes'].items()}
     t = Table(relation['name'], cube_metadata, *columns)
     t.drop(checkfirst=True)
+    _forget_table(engine, relation['name'])
     t.create(engine)
 
 
+def drop_table(engine, relation):
+    """
+    Execute DROP TABLE on desired DB if the table exists.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relation: relation to drop
+    """
+    t = Table(relation['name'], MetaData(engine))
+    t.drop(checkfirst=True)
+    _forget_table(engine, relation['name'])
+
+
 def _execute(engine, query, *multiparams, **params):
     """
     Execute SQLAlchemy query and then transform query result object into list
@@ -129,26 +211,210 @@ def _execute(engine, query, *multiparams, **params):
             return [dict(r) for r in result_proxy.fetchall()]
 
 
-def natural_join(engine, relations, attributes):
-    metadata = MetaData(engine, reflect=True)
+def _execute_batches(engine, query, batch_size):
+    """
+    Execute SQLAlchemy query using server-side cursor where DB driver supports
+    it and yield its result in lists of dicts, `batch_size` rows each.
+
+    :param engine: SQLAlchemy engine to be used
+    :param query: SQLAlchemy query
+    :param batch_size: maximum amount of rows in each list
+    """
+    with engine.connect() as conn:
+        result_proxy = conn.execution_options(stream_results=True)\
+            .execute(query)
+        rows = result_proxy.fetchmany(batch_size)
+        while rows:
+            yield [dict(r) for r in rows]
+            rows = result_proxy.fetchmany(batch_size)
+
+
+def _join_clause(tables, relations, cardinalities=None):
+    """
+    Explicit JOIN ... ON clause of the natural join. Relations are joined in
+    `joins.join_order` and only the equalities of `joins.join_equalities`
+    are put to the ON clauses, the rest of them being implied.
+
+    :param tables: dict of relation name -> SQLAlchemy selectable
+    :param relations: list of relations to join
+    :param cardinalities: dict of relation name -> number of rows to order
+        relations by
+    :return: SQLAlchemy join or selectable of the single relation
+    """
+    ordered = join_order(relations, cardinalities)
+    join_clause = None
+    for relation, equalities in zip(ordered, join_equalities(ordered)):
+        t = tables[relation['name']]
+        if join_clause is None:
+            join_clause = t
+            continue
+        # relations having no common attributes make a cross product
+        onclause = and_(*(t.columns[a] ==
+                          tables[ordered[i]['name']].columns[a]
+                          for a, i in equalities)) if equalities else true()
+        join_clause = join_clause.join(t, onclause)
+    return join_clause
+
+
+def _natural_join_query(tables, relations, attributes, constraint=None,
+                        pushed_constraint=None, cardinalities=None):
+    join_clause = _join_clause(tables, relations, cardinalities)
 
     bin_exprs = ()
-    for i, r in enumerate(relations):
-        next_relations = deepcopy(relations[i+1:])
-        for r2 in next_relations:
-            common_attrs = common_keys(r['attributes'], r2['attributes'])
-            bin_exprs = reduce(
-                lambda t, a: t + (metadata.tables[r['name']].columns[a] ==
-                                  metadata.tables[r2['name']].columns[a],),
-                common_attrs, bin_exprs)
 
+    if constraint or pushed_constraint:
+        # constraint attributes are taken from any relation having them, as
+        # joined relations are equal on their common attributes
+        constraint_columns = {
+            a: tables[containing_relation(relations, a)['name']].columns[a]
+            for a in all_attributes(relations)}
+        if constraint:
+            bin_exprs += (_to_bool_clause(constraint, constraint_columns),)
+        if pushed_constraint:
+            # only rows the constraint is FALSE for are skipped, the same
+            # rows `delete_unsatisfied` would delete
+            pushed_clause = _to_bool_clause(pushed_constraint,
+                                            constraint_columns)
+            bin_exprs += (or_(pushed_clause, pushed_clause.is_(None)),)
     where_expr = and_(*bin_exprs)
-    columns = _attrs_to_columns(metadata, relations, attributes)
-    s = select(columns).where(where_expr)
+    columns = _attrs_to_columns(tables, relations, attributes)
+    return select(columns).select_from(join_clause).where(where_expr)
+
+
+def _cardinalities(engine, tables):
+    """
+    Number of rows of the tables if `join_order` setting is 'cardinality'.
+    Every table is counted once per engine.
+
+    :param engine: SQLAlchemy engine to be used
+    :param tables: dict of relation name -> SQLAlchemy table
+    :return: dict of relation name -> number of rows or None
+    """
+    if cfg.settings.get('join_order', 'existing') != 'cardinality':
+        return None
+    with _metadata_lock:
+        counted = _cardinality_registry.setdefault(engine, {})
+    for name, t in tables.items():
+        if name not in counted:
+            counted[name] = _execute(
+                engine, select([count()]).select_from(t))[0]['count_1']
+    return {name: counted[name] for name in tables}
+
+
+def natural_join(engine, relations, attributes):
+    tables = {r['name']: _get_table(engine, r['name']) for r in relations}
+    s = _natural_join_query(tables, relations, attributes,
+                            cardinalities=_cardinalities(engine, tables))
     return _execute(engine, s)
 
 
-def _convert_predicate(p):
+def natural_join_batches(engine, relations, attributes, batch_size=None,
+                         constraint=None, pushed_constraint=None):
+    """
+    Streaming version of `natural_join`. Only `batch_size` rows of the join
+    are kept in memory at once.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relations: list of relations to join
+    :param attributes: dict of attributes to select
+    :param batch_size: amount of rows in each batch, `join_batch_size`
+        setting is used by default
+    :param constraint: logical constraint joined rows should satisfy
+    :param pushed_constraint: logical constraint joined rows are filtered by
+        unless it evaluates to unknown (NULL) for them
+    :return: generator of lists of dicts, each representing a row
+    """
+    if batch_size is None:
+        batch_size = cfg.settings.get('join_batch_size', 10000)
+    tables = {r['name']: _get_table(engine, r['name']) for r in relations}
+    s = _natural_join_query(tables, relations, attributes, constraint,
+                            pushed_constraint, _cardinalities(engine, tables))
+    return _execute_batches(engine, s, batch_size)
+
+
+def server_side_schema(source_url, cube_url):
+    """
+    Find out whether the source DB is reachable from cube DB connection, so
+    that source data can be selected and inserted by a single statement.
+    MySQL databases are reachable when they live on the same server, as a
+    MySQL database is a schema of any connection to the server. Databases
+    of other backends, e.g. PostgreSQL, are never reachable this way.
+    `server_side_join` setting might force (true) or disable (false) usage of
+    this approach. SQLite database file is reachable by attaching it to the
+    cube DB connection, but only if the setting is true.
+
+    Rows joined on the server side are always merged into TJ by SQL, so
+    `subordination_engine` setting doesn't apply to them.
+
+    :param source_url: SQLAlchemy URL of the source DB
+    :param cube_url: SQLAlchemy URL of the cube DB
+    :return: name of the schema holding source tables in cube DB connection
+        or None if source DB is unreachable
+    """
+    setting = cfg.settings.get('server_side_join')
+    if setting is False:
+        return None
+    backend = source_url.drivername.split('+')[0]
+    if backend != cube_url.drivername.split('+')[0]:
+        return None
+    if backend == 'sqlite':
+        if not setting or source_url.database in (None, '', ':memory:'):
+            return None
+        return SQLITE_SOURCE_SCHEMA
+    if backend != 'mysql':
+        return None
+    same_server = (source_url.host, source_url.port) == \
+                  (cube_url.host, cube_url.port)
+    if setting or same_server:
+        return source_url.database
+    return None
+
+
+def insert_from_join(engine, dest_relation, source_url, relations,
+                     attributes, values=None, constraint=None,
+                     pushed_constraint=None):
+    """
+    Perform natural join of the source DB relations and insert its result
+    into `dest_relation` with a single INSERT ... SELECT statement, so no rows
+    are transferred from the DB server. Source DB should be reachable from
+    the cube DB, see `server_side_schema`.
+
+    :param engine: SQLAlchemy engine of the cube DB
+    :param dest_relation: relation to insert data into
+    :param source_url: SQLAlchemy URL of the source DB
+    :param relations: list of source relations to join
+    :param attributes: dict of attributes to select
+    :param values: dict of attribute name -> constant value to be set in
+        every inserted row
+    :param constraint: logical constraint joined rows should satisfy
+    :param pushed_constraint: logical constraint joined rows are filtered by
+        unless it evaluates to unknown (NULL) for them
+    """
+    schema = server_side_schema(source_url, engine.url)
+    source_metadata = MetaData()
+    tables = {r['name']: Table(r['name'], source_metadata,
+                               *map(Column, r['attributes']), schema=schema)
+              for r in relations}
+    s = _natural_join_query(tables, relations, attributes, constraint,
+                            pushed_constraint)
+    for name, value in (values or {}).items():
+        s = s.column(literal(value).label(name))
+
+    dest_table = _get_table(engine, dest_relation['name'])
+    insert_query = dest_table.insert().from_select(
+        [c.name for c in s.columns], s)
+    with engine.connect() as conn:
+        if schema == SQLITE_SOURCE_SCHEMA:
+            conn.execute(text('ATTACH DATABASE :file AS {}'.format(schema)),
+                         file=source_url.database)
+        try:
+            conn.execute(insert_query)
+        finally:
+            if schema == SQLITE_SOURCE_SCHEMA:
+                conn.execute(text('DETACH DATABASE {}'.format(schema)))
+
+
+def _convert_predicate(p, columns=None):
     operators = {
         '=': operator.eq,
         '<>': operator.ne,
@@ -162,19 +428,21 @@ def _convert_predicate(p):
     }
     op_str = p['operation'].lstrip('NOT ')
     values = (p['value'],) if not isinstance(p['value'], list) else p['value']
-    binary_expr = operators[op_str](column(p['attribute']), *values)
+    column_clause = columns[p['attribute']] if columns is not None \
+        else column(p['attribute'])
+    binary_expr = operators[op_str](column_clause, *values)
     if op_str == p['operation']:
         return binary_expr
     else:
         return not_(binary_expr)
 
 
-def _to_bool_clause(constraint):
+def _to_bool_clause(constraint, columns=None):
     if constraint is not None:
         if isinstance(constraint, dict):
             return and_(column(k) == v for k, v in constraint.items())
         else:
-            return or_(and_(_convert_predicate(predicate)
+            return or_(and_(_convert_predicate(predicate, columns)
                             for predicate in conjunction_clause)
                        for conjunction_clause in constraint)
     else:
@@ -223,6 +491,51 @@ def delete_rows(engine, relation, rows):
         _execute(engine, del_query)
 
 
+def _null_safe_equal(engine, column_1, column_2):
+    """
+    Build comparison of two columns treating NULL values as equal ones.
+
+    :param engine: SQLAlchemy engine the expression is built for
+    :param column_1: first column
+    :param column_2: second column
+    :return: SQLAlchemy boolean expression
+    """
+    operation = NULL_SAFE_OPERATORS.get(engine.dialect.name)
+    if operation:
+        return column_1.op(operation)(column_2)
+    return or_(column_1 == column_2,
+               and_(column_1.is_(None), column_2.is_(None)))
+
+
+def delete_matching(engine, relation, other_relation, attributes,
+                    filter_constraint=None, other_constraint=None):
+    """
+    Delete rows that have a matching row in other relation, i.e. the one
+    having the same values of all `attributes`. NULL values are considered
+    equal. Whole operation is a single DELETE ... WHERE EXISTS statement.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relation: relation to delete rows from
+    :param other_relation: relation to search matching rows in
+    :param attributes: list of attribute names to compare rows by
+    :param filter_constraint: constraint for defining section of table to
+        delete data from
+    :param other_constraint: constraint matching rows of other relation
+        should satisfy
+    """
+    target_table = _get_table(engine, relation['name'])
+    other_table = _get_table(engine, other_relation['name'])
+
+    match_clause = and_(*(_null_safe_equal(engine, target_table.columns[a],
+                                           other_table.columns[a])
+                          for a in attributes),
+                        _to_bool_clause(other_constraint, other_table.columns))
+    exists_clause = exists(select([literal_column('1')])
+                           .select_from(other_table).where(match_clause))
+    whereclause = and_(exists_clause, _to_bool_clause(filter_constraint))
+    _execute(engine, delete(target_table).where(whereclause))
+
+
 def delete_unsatisfied(engine, relation, constraint, filter_constraint=None):
     """
     Delete rows that DO NOT satisfy the specified constraint.
@@ -243,36 +556,54 @@ def delete_unsatisfied(engine, relation, constraint, filter_constraint=None):
 
 
 def insert_rows(engine, relation, rows):
-    _rows = list(rows)
-    if not _rows:
-        return
-    metadata = MetaData(engine, reflect=True)
-    insert_query = insert(metadata.tables[relation['name']])
-    _execute(engine, insert_query, _rows)
+    """
+    Insert rows into the relation. Rows are consumed lazily and sent to the DB
+    in chunks, so any iterator of rows might be passed.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relation: relation to insert data into
+    :param rows: iterable of dicts, each representing a row
+    """
+    insert_query = None
+    for chunk in batches(rows, cfg.settings.get('row_insert_chunk_size',
+                                                10000)):
+        if insert_query is None:
+            insert_query = insert(_get_table(engine, relation['name']))
+        _execute(engine, insert_query, chunk)
 
 
-def insert_from_select(engine, dest_relation, source_relation, *constraints):
+def insert_from_select(engine, dest_relation, source_relation, *constraints,
+                       mapping=None, keep_unknown=False):
     """
-    Count all rows satisfying given constraint
+    Copy all rows satisfying given constraints from one relation to another
 
     :param engine: SQLAlchemy engine to be used
     :param dest_relation: relation to insert data into
     :param source_relation: relation to get data from
     :param constraints: arbitrary amount of logical constraints to apply to
         source data (joining with AND)
+    :param mapping: dict of attribute name -> dict of source value -> value
+        to be inserted instead of it. Unmapped values are copied as is
+    :param keep_unknown: copy the rows constraints evaluate to unknown (NULL)
+        for as well, i.e. the rows `delete_unsatisfied` would keep
     """
-    metadata = MetaData(engine, reflect=True)
-
-    dest_table = metadata.tables[dest_relation['name']]
-    source_table = metadata.tables[source_relation['name']]
+    mapping = mapping or {}
+    dest_table = _get_table(engine, dest_relation['name'])
+    source_table = _get_table(engine, source_relation['name'])
     dest_attrs = dest_relation['attributes']
     source_attrs = source_relation['attributes']
-    attributes = common_keys(dest_attrs, source_attrs)
-    columns = list(map(column, attributes))
+    attributes = list(common_keys(dest_attrs, source_attrs))
+    columns = [case(mapping[name], value=column(name),
+                    else_=column(name)).label(name)
+               if mapping.get(name) else column(name)
+               for name in attributes]
     bool_clauses = map(_to_bool_clause, constraints)
     whereclause = and_(*bool_clauses)
+    if keep_unknown and any(constraints):
+        whereclause = or_(whereclause, whereclause.is_(None))
     s = select(columns=columns, from_obj=source_table).where(whereclause)
-    insert_query = dest_table.insert().from_select(columns, s)
+    insert_query = dest_table.insert().from_select(
+        list(map(column, attributes)), s)
 
     _execute(engine, insert_query)
 
@@ -301,6 +632,27 @@ def count_attributes(engine, relation_name, attributes):
     return [counts_dict[k] for k in keys]
 
 
+def table_size(engine, relation):
+    """
+    Estimate size of the table from its data. Values of string columns are
+    counted by their actual length rather than the declared one, values of
+    other columns are counted as 8 bytes.
+
+    :param engine: SQLAlchemy engine to be used
+    :param relation: relation to estimate
+    :return: tuple (number of rows, size in bytes)
+    """
+    t = _get_table(engine, relation['name'])
+    string_columns = [c for c in t.columns if isinstance(c.type, String)]
+    lengths = [func.coalesce(func.sum(func.length(c)), 0).label(c.name)
+               for c in string_columns]
+    result = _execute(engine, select([count().label('rows')] + lengths)
+                      .select_from(t))[0]
+    rows = result['rows']
+    width = 8 * (len(t.columns) - len(string_columns))
+    return rows, rows * width + sum(result[c.name] for c in string_columns)
+
+
 def count_constrained(engine, relation_name, constraint):
     """
     Count all rows satisfying given constraint
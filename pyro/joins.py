@@ -0,0 +1,86 @@
+from collections import defaultdict
+
+from pyro.transformation import existing_join
+
+
+def join_order(relations, cardinalities=None):
+    """
+    Order relations so that each one shares attributes with some previous
+    one if possible, see `transformation.existing_join`. Relations having
+    nothing in common with the previous ones are put to the end.
+
+    If cardinalities are given, join starts from the smallest relation and
+    the smallest relation sharing attributes with the joined ones is joined
+    next.
+
+    :param relations: list of relations
+    :param cardinalities: dict of relation name -> number of rows
+    :return: list of relations
+    """
+    if cardinalities is None:
+        # existing join isn't computed for a single relation
+        names = [r['name'] for r in existing_join(relations) or []]
+        by_name = {r['name']: r for r in relations}
+        return [by_name[name] for name in names] + \
+            [r for r in relations if r['name'] not in names]
+    remaining = sorted(relations,
+                       key=lambda r: cardinalities.get(r['name'], 0))
+    ordered = [remaining.pop(0)] if remaining else []
+    attributes = set(ordered[0]['attributes']) if ordered else set()
+    while remaining:
+        i = next((i for i, r in enumerate(remaining)
+                  if attributes.intersection(r['attributes'])), 0)
+        ordered.append(remaining.pop(i))
+        attributes.update(ordered[-1]['attributes'])
+    return ordered
+
+
+def join_equalities(relations):
+    """
+    Minimal set of equalities of the natural join of relations in the given
+    order. Every attribute a relation shares with the previous ones is only
+    equated to the first relation having it, equalities with the others are
+    implied by the ones already made between them.
+
+    :param relations: ordered list of relations
+    :return: list of lists of (attribute name, previous relation index)
+        tuples, one list per relation
+    """
+    first = {}
+    equalities = []
+    for i, relation in enumerate(relations):
+        equalities.append([(a, first[a])
+                           for a in sorted(relation['attributes'])
+                           if a in first])
+        for a in relation['attributes']:
+            first.setdefault(a, i)
+    return equalities
+
+
+def hash_join(build_rows, probe_rows, on, attributes=None):
+    """
+    Equi-join two lists of rows in memory. Rows having NULL in any of `on`
+    attributes match nothing, as in SQL.
+
+    :param build_rows: list of dicts, the hash index is built on
+    :param probe_rows: iterable of dicts, consumed lazily
+    :param on: names of attributes to join on
+    :param attributes: names of attributes to keep in the joined rows, all
+        the attributes are kept by default
+    :return: generator of joined rows
+    """
+    index = defaultdict(list)
+    for row in build_rows:
+        key = tuple(row.get(a) for a in on)
+        if None not in key:
+            index[key].append(row)
+    for probe_row in probe_rows:
+        key = tuple(probe_row.get(a) for a in on)
+        if None in key:
+            continue
+        for build_row in index.get(key, ()):
+            row = dict(probe_row)
+            row.update(build_row)
+            if attributes is not None:
+                row = {a: v for a, v in row.items() if a in attributes}
+            yield row
@@ -1,12 +1,23 @@
-from functools import partial
-from functools import reduce
-from itertools import groupby
+import itertools
+from collections import defaultdict
 
-from pyro import utils
-from pyro.utils import min_dict, all_equal, project
+from pyro import cfg, utils
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def _build_tableau(relations):
+
+def build_tableau(relations):
+    """
+    Build tableau for the relations, one row per relation. Attributes of the
+    relation get distinguished symbols, the rest of attributes get
+    non-distinguished symbols unique to the row.
+
+    :param relations: list of relations
+    :return: list of dicts representing tableau rows
+    """
     tableau = []
     all_attributes = utils.all_attributes(relations)
     for r in relations:
@@ -16,6 +27,50 @@ def _build_tableau(relations):
     return tableau
 
 
+def _build_matrix(relations):
+    """
+    Build tableau as a matrix of integer symbols: rows correspond to
+    relations, columns - to attributes. Distinguished symbols are 0, others
+    are unique positive numbers.
+
+    :param relations: list of relations
+    :return: tuple (list of attributes - matrix columns, matrix)
+    """
+    attributes = sorted(utils.all_attributes(relations))
+    matrix = np.arange(1, len(relations) * len(attributes) + 1,
+                       dtype=np.int64).reshape(len(relations),
+                                               len(attributes))
+    for i, r in enumerate(relations):
+        for j, attr in enumerate(attributes):
+            if attr in r['attributes']:
+                matrix[i, j] = 0
+    return attributes, matrix
+
+
+def extend_tableau(tableau, relation):
+    """
+    Add a row for the relation to the tableau, which might be already chased.
+    Columns of the relation's attributes missing in the tableau are filled
+    with unique non-distinguished symbols in existing rows.
+
+    :param tableau: list of dicts representing tableau rows, kept intact
+    :param relation: relation to add
+    :return: new tableau
+    """
+    attributes = set(tableau[0]) if tableau else set()
+    new_attributes = set(relation['attributes']) - attributes
+    result = []
+    for i, row in enumerate(tableau):
+        new_row = dict(row)
+        new_row.update({attr: (attr, '#{}'.format(i))
+                        for attr in new_attributes})
+        result.append(new_row)
+    result.append({attr: (attr,) if attr in relation['attributes']
+                   else (attr, relation['name'])
+                   for attr in attributes | new_attributes})
+    return result
+
+
 def is_clear(row):
     """
     Check that provided tableau row consists only of simple values
@@ -29,35 +84,202 @@ def is_clear(row):
     return True
 
 
-def is_lossless(relations, deps):
+class _SymbolClasses:
+    """
+    Union-find structure over tableau symbols. Representative of a class is
+    its minimal symbol, so distinguished symbol represents the class it's in.
+    For every class tableau cells holding its symbols are kept to count the
+    cells of each row that are not yet equal to distinguished symbols.
     """
-    Check whether lossless join property of database is held
+    def __init__(self, tableau):
+        self.parent = {}
+        self.cells = defaultdict(list)
+        self.pending = []
+        for i, row in enumerate(tableau):
+            pending = 0
+            for value in row.values():
+                self.cells[value].append(i)
+                if len(value) > 1:
+                    pending += 1
+            self.pending.append(pending)
+        self.clear = 0 in self.pending
 
-    :param relations: list of relations to be checked
-    :param deps: list of dependencies that are held on the given set of
-        relations
-    :return: True if connection without losses is held on current context
+    def find(self, symbol):
+        parent = self.parent
+        while symbol in parent:
+            grandparent = parent.get(parent[symbol])
+            if grandparent is not None:
+                parent[symbol] = grandparent
+            symbol = parent[symbol]
+        return symbol
+
+    def union(self, s1, s2):
+        """
+        Equate classes of two symbols.
+
+        :return: True if classes were different
+        """
+        s1, s2 = self.find(s1), self.find(s2)
+        if s1 == s2:
+            return False
+        if s2 < s1:
+            s1, s2 = s2, s1
+        self.parent[s2] = s1
+        cells = self.cells.pop(s2)
+        if len(s1) == 1:
+            for i in cells:
+                self.pending[i] -= 1
+                if not self.pending[i]:
+                    self.clear = True
+        self.cells[s1].extend(cells)
+        return True
+
+
+def chase(tableau, deps):
     """
-    tableau = _build_tableau(relations)
+    Apply chase algorithm to the tableau, equating symbols by the
+    dependencies until a row consisting only of distinguished symbols
+    appears or no more changes can be made. Equal symbols are kept in
+    union-find structure and rows are grouped by hashing representatives of
+    their symbols, the tableau is rewritten with the representatives at the
+    end.
 
+    :param tableau: list of dicts representing tableau rows, changed in place
+    :param deps: list of dependencies to chase with
+    :return: True if clear row was found, False otherwise
+    """
+    deps = [(tuple(dep['left']), tuple(dep['right'])) for dep in deps]
+    classes = _SymbolClasses(tableau)
+    find = classes.find
+    changed = True
+    while changed and not classes.clear:
+        changed = False
+        for left, right in deps:
+            groups = {}
+            for i, row in enumerate(tableau):
+                j = groups.setdefault(tuple(find(row[a]) for a in left), i)
+                if j == i:
+                    continue
+                for a in right:
+                    if classes.union(row[a], tableau[j][a]):
+                        changed = True
+                if classes.clear:
+                    break
+            if classes.clear:
+                break
+    for row in tableau:
+        for a, value in row.items():
+            row[a] = find(value)
+    return classes.clear
+
+
+def chase_matrix(matrix, attributes, deps):
+    """
+    Vectorized version of `chase` for the tableau built by `_build_matrix`.
+    Rows are grouped by the left side of a dependency with `numpy.unique` and
+    symbols of the right side are set to minimum in the group at once.
+
+    :param matrix: tableau matrix, changed in place
+    :param attributes: list of attributes corresponding to matrix columns
+    :param deps: list of dependencies to chase with
+    :return: True if row of distinguished symbols was found, False otherwise
+    """
+    index = {attr: i for i, attr in enumerate(attributes)}
+    columns = [([index[a] for a in dep['left'] if a in index],
+                [index[a] for a in dep['right'] if a in index])
+               for dep in deps]
     changed = True
     while changed:
         changed = False
-        for dep in deps:
-            dep_left = partial(project, keys=dep['left'])
-            dep_right = partial(project, keys=dep['right'])
-            tableau = sorted(tableau, key=lambda r: list(dep_left(r).values()))
-            for k, group in groupby(tableau, key=dep_left):
-                group = list(group)
-                values_to_change = list(map(dep_right, group))
-                if not all_equal(values_to_change):
-                    changed = True
-                    group_min = reduce(min_dict, values_to_change)
-                    for row in group:
-                        row.update(group_min)
-        try:
-            next(filter(is_clear, tableau))
+        for left, right in columns:
+            if not right:
+                continue
+            if len(left) == 1:
+                _, groups = np.unique(matrix[:, left[0]],
+                                      return_inverse=True)
+            elif left:
+                _, groups = np.unique(matrix[:, left], axis=0,
+                                      return_inverse=True)
+                groups = groups.reshape(-1)
+            else:
+                groups = np.zeros(len(matrix), dtype=np.intp)
+            n_groups = groups.max() + 1
+            if n_groups == len(matrix):
+                # every row is a group of its own, nothing to equate
+                continue
+            values = matrix[:, right]
+            group_min = np.full((n_groups, len(right)),
+                                np.iinfo(matrix.dtype).max,
+                                dtype=matrix.dtype)
+            np.minimum.at(group_min, groups, values)
+            new_values = group_min[groups]
+            if (new_values != values).any():
+                changed = True
+                matrix[:, right] = new_values
+        if not matrix.any(axis=1).all():
             return True
-        except StopIteration:
-            pass
     return False
+
+
+def is_lossless(relations, deps):
+    """
+    Check whether lossless join property of database is held. Tableau is
+    chased by `chase` unless `chase_engine` setting is 'matrix', then
+    `chase_matrix` is used, which requires numpy.
+
+    :param relations: list of relations to be checked
+    :param deps: list of dependencies that are held on the given set of
+        relations
+    :return: True if connection without losses is held on current context
+    """
+    if cfg.settings.get('chase_engine', 'tableau') == 'matrix' and relations:
+        if np is None:
+            raise ImportError('Matrix chase engine requires numpy')
+        attributes, matrix = _build_matrix(relations)
+        return chase_matrix(matrix, attributes, list(deps))
+    return chase(build_tableau(relations), list(deps))
+
+
+def held_dependencies(relations, deps):
+    """
+    Select dependencies that are held on the given set of relations
+
+    :param relations: list of relations
+    :param deps: list of dependencies
+    :return: list of dependencies with all attributes present in relations
+    """
+    attributes = utils.all_attributes(relations)
+    return [d for d in deps
+            if set(d['left']).union(d['right']).issubset(attributes)]
+
+
+def chase_combinations(base, relations, deps):
+    """
+    Check lossless join property of `base` relations extended by every
+    combination of `relations`, in order of increasing combination size.
+    Chased tableau of each combination is extended by one relation to get the
+    one of the next size, so the equalities found earlier aren't searched
+    again.
+
+    :param base: list of relations present in every combination
+    :param relations: list of relations to combine
+    :param deps: list of all dependencies held, only those that are held on
+        a combination are used for it
+    :return: generator of tuples (list of relations, True if lossless join
+        property is held for them)
+    """
+    deps = list(deps)
+    previous = {}
+    for k in range(len(relations) + 1):
+        current = {}
+        for indices in itertools.combinations(range(len(relations)), k):
+            context = list(base) + [relations[i] for i in indices]
+            if indices:
+                tableau = extend_tableau(previous[indices[:-1]],
+                                         relations[indices[-1]])
+            else:
+                tableau = build_tableau(context)
+            lossless = chase(tableau, held_dependencies(context, deps))
+            current[indices] = tableau
+            yield context, lossless
+        previous = current
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from itertools import chain
+
+from pyro import db, cfg
+from pyro.joins import hash_join
+from pyro.transformation import existing_join
+from pyro.utils import all_attributes, batches, common_keys
+
+
+class SubJoinMemo:
+    """
+    Memo of natural joins of relation packs kept in memory, so that join of
+    a larger pack is derived from the largest memoized join of its subset
+    instead of being computed by the source DB from scratch. The rest of
+    the pack relations are joined by the source DB (or taken from the memo
+    too) and joined with the memoized rows by `joins.hash_join`.
+
+    At most `max_rows` rows are kept, the earliest memoized joins are
+    dropped first. Joins of the larger packs are not memoized at all.
+
+    Memoized values are compared by Python equality, which might differ from
+    the source DB comparison, e.g. of strings having case insensitive
+    collation.
+    """
+    def __init__(self, source, attributes, max_rows):
+        """
+        :param source: SQLAlchemy engine for source DB
+        :param attributes: dict of attributes to select, they should include
+            the attributes relations are joined on
+        :param max_rows: maximum number of memoized rows
+        """
+        self._source = source
+        self._attributes = attributes
+        self._max_rows = max_rows
+        # frozenset of relation names -> list of rows
+        self._joins = OrderedDict()
+        self._rows = 0
+
+    def join_batches(self, relations, batch_size=None):
+        """
+        Natural join of the relations in batches, see
+        `db.natural_join_batches`. The join is memoized once consumed.
+
+        :param relations: list of relations to join
+        :param batch_size: amount of rows in each batch
+        :return: generator of lists of dicts, each representing a row
+        """
+        names = frozenset(r['name'] for r in relations)
+        join_batches = self._derive(relations, names, batch_size)
+        if join_batches is None:
+            join_batches = db.natural_join_batches(
+                self._source, relations, self._attributes, batch_size)
+        return self._memoize(names, join_batches)
+
+    def _derive(self, relations, names, batch_size):
+        subsets = [key for key in self._joins if key < names]
+        if not subsets:
+            return None
+        # the largest subset leaves the least to join
+        base = max(subsets, key=lambda key: (len(key),
+                                             -len(self._joins[key])))
+        base_relations = [r for r in relations if r['name'] in base]
+        rest = [r for r in relations if r['name'] not in base]
+        on = sorted(common_keys(all_attributes(base_relations),
+                                all_attributes(rest)))
+        if not on or not set(on).issubset(self._attributes):
+            return None
+        rest_names = frozenset(r['name'] for r in rest)
+        if rest_names in self._joins:
+            rest_rows = self._joins[rest_names]
+        elif len(existing_join(rest) or rest) == len(rest):
+            rest_rows = chain.from_iterable(db.natural_join_batches(
+                self._source, rest, self._attributes, batch_size))
+        else:
+            # rest of relations isn't connected
+            return None
+        if batch_size is None:
+            batch_size = cfg.settings.get('join_batch_size', 10000)
+        return batches(hash_join(self._joins[base], rest_rows, on,
+                                 self._attributes), batch_size)
+
+    def _memoize(self, names, join_batches):
+        rows = []
+        for batch in join_batches:
+            if rows is not None:
+                rows.extend(batch)
+                if len(rows) > self._max_rows:
+                    rows = None
+            yield batch
+        if rows is None:
+            return
+        while self._joins and self._rows + len(rows) > self._max_rows:
+            _, dropped = self._joins.popitem(last=False)
+            self._rows -= len(dropped)
+        self._joins[names] = rows
+        self._rows += len(rows)
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from itertools import groupby
 
 from mako.template import Template
@@ -84,17 +85,24 @@ def _build(engine, relation_names, dimensions, measure):
     projection_x = db.project(engine, relation_x_name, hierarchy_x)
     merged_projection_x = list(map(lambda g: g[0], groupby(projection_x)))
 
-    # section 3: build table body (Z block)
+    # section 3: build table body (Z block). Z relation is scanned once and
+    # measure values are bucketed into cells by hierarchy attributes values
     relation_z_name = relation_names[2]
+    cell_attributes = list(hierarchy_x) + [a for a in hierarchy_y
+                                           if a not in hierarchy_x]
+    z_attributes = cell_attributes + [measure] \
+        if measure not in cell_attributes else cell_attributes
+    cells = defaultdict(list)
+    for data_row in db.get_data(engine, relation_z_name, z_attributes):
+        cell_key = tuple(data_row[a] for a in cell_attributes)
+        cells[cell_key].append(data_row[measure])
     body = []
     for row in merged_projection_x:
         body_row = []
         for col in merged_projection_y:
             where_dict = {**row, **col}
-            data_rows = db.get_data(engine, relation_z_name, [measure],
-                                    constraint=where_dict)
-            cell = tuple(row[measure] for row in data_rows)
-            body_row.append(cell)
+            cell_key = tuple(where_dict[a] for a in cell_attributes)
+            body_row.append(tuple(cells.get(cell_key, ())))
         body.append(body_row)
 
     # section 4: finally assemble all 3 parts into single table view
@@ -1,41 +1,63 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
 from operator import itemgetter
 
 import logging
-from sqlalchemy import String
+import random
+from sqlalchemy import String, BigInteger, create_engine
 
-from pyro import db
+from pyro import db, cfg
 from pyro.cache import Cache
 from pyro.constraints import operations as constraint_operations
+from pyro.memo import SubJoinMemo
 from pyro.transformation import lossless_combinations
 from pyro.utils import all_attributes, process_value, random_str
 
 VECTOR_ATTRIBUTE = 'g'
 VECTOR_SEPARATOR = ';separator;'
 VECTOR_MAX_LENGTH = 10000
+# maximum amount of context relations bitmap vector can encode
+BITMAP_MAX_LENGTH = 63
 
 logger = logging.getLogger(__name__)
 
 
-def get_attributes(context, dependencies):
+def get_attributes(context, dependencies, required_attributes=None):
     """
     Calculate columns that are needed to be selected from given relations
 
     Attributes that go to the TJ:
-    - dimension attributes
-    - key attributes of Measure attribute. These are considered covered by
-        functional dependencies
+    - dimension attributes, measure and constrained attributes, all of them
+        are passed as `required_attributes`
+    - primary key attributes of each relation. Rows equal on them are equal
+        on all the attributes of the relation, so the rest of its attributes
+        aren't needed to find out subordinate rows
     - any common attributes of context relations
-    - binary vector of relations contributing to given row
 
-    :param context:
-    :param dependencies:
-    :return:
+    Vector attribute is added by `create_tj_schema`.
+
+    :param context: list of relations
+    :param dependencies: list of dependencies held
+    :param required_attributes: names of attributes needed in the TJ or None
+        if all the attributes of the context are needed
+    :return: dict of attribute name -> type
     """
-    # TODO: filter attributes to only pick needed ones
     attributes = dict()
     for relation in context:
         attributes.update(relation['attributes'])
-    return attributes
+    if required_attributes is None:
+        return attributes
+    needed = set(required_attributes)
+    seen = set()
+    for relation in context:
+        relation_attributes = set(relation['attributes'])
+        needed |= relation_attributes & seen
+        seen |= relation_attributes
+        # relation without primary key is only identified by all attributes
+        needed |= relation.get('pk') or relation_attributes
+    return {name: type_ for name, type_ in attributes.items()
+            if name in needed}
 
 
 def encode_vector(relations):
@@ -68,7 +90,47 @@ def decode_vector(row):
     return row[VECTOR_ATTRIBUTE].split(VECTOR_SEPARATOR)
 
 
-def is_empty_attr(row, attribute_name):
+def encode_bitmap(relations, vector_relations):
+    """
+    Encode relations as an integer bitmask, where bit i is set if relation
+    `vector_relations[i]` is present.
+
+    :param relations: input relations
+    :type relations: list of dicts
+    :param vector_relations: relation-index mapping, list of relation names
+    :return: integer bitmask
+    """
+    return sum(1 << vector_relations.index(r['name']) for r in relations)
+
+
+def decode_bitmap(vector, vector_relations):
+    """
+    Decode relation names from integer bitmask.
+
+    :param vector: integer bitmask
+    :param vector_relations: relation-index mapping, list of relation names
+    :return list of relation names encoded in vector
+    """
+    return [name for i, name in enumerate(vector_relations)
+            if vector & (1 << i)]
+
+
+def vector_value(tj, relations):
+    """
+    Encode relations the way vector attribute of the given TJ stores them.
+    TJs having 'vector_relations' mapping use bitmap encoding, others use
+    string one.
+
+    :param tj: TJ relation
+    :param relations: relations to encode
+    :return: value of vector attribute
+    """
+    if tj.get('vector_relations'):
+        return encode_bitmap(relations, tj['vector_relations'])
+    return encode_vector(relations)
+
+
+def is_empty_attr(row, attribute_name, vectors=None):
     """
     Attribute attr in row is considered empty if it has value None and
     its vector doesn't contain any relations having given attribute in their
@@ -78,12 +140,19 @@ def is_empty_attr(row, attribute_name):
     :type row: dict
     :param attribute_name: target attribute name
     :type attribute_name: str
+    :param vectors: dict mapping vector values to lists of relations they
+        encode, bitmap vectors can't be decoded without it
     :return: True - if the attribute value in row is empty, False otherwise
     """
-    if row[attribute_name] is not None or \
-                    attribute_name in row[VECTOR_ATTRIBUTE]:
+    if row[attribute_name] is not None:
         return False
-    return True
+    vector = row[VECTOR_ATTRIBUTE]
+    if vectors is not None and vector in vectors:
+        return attribute_name not in all_attributes(vectors[vector])
+    if isinstance(vector, int):
+        raise ValueError('Relations of bitmap vector {} are '
+                         'unknown'.format(vector))
+    return attribute_name not in vector
 
 
 def is_vector_less(r1, r2):
@@ -96,13 +165,15 @@ def is_vector_less(r1, r2):
     :param r2: second row
     """
     second_vector = r2[VECTOR_ATTRIBUTE]
+    if isinstance(second_vector, int):
+        return r1[VECTOR_ATTRIBUTE] & second_vector == r1[VECTOR_ATTRIBUTE]
     for vector_part in decode_vector(r1):
         if vector_part not in second_vector:
             return False
     return True
 
 
-def is_subordinate(r1, r2):
+def is_subordinate(r1, r2, vectors=None):
     if not is_vector_less(r1, r2):
         return False
     attributes = list(r1.keys())
@@ -110,40 +181,471 @@ def is_subordinate(r1, r2):
     for attr in attributes:
         value_1 = process_value(r1[attr])
         value_2 = process_value(r2.get(attr))
-        if value_1 != value_2 and not is_empty_attr(r1, attr):
+        if value_1 != value_2 and not is_empty_attr(r1, attr, vectors):
             return False
     return True
 
 
-def filter_subordinate_rows(tj_data, new_data):
+def filter_subordinate_rows(tj_data, new_data, vectors=None):
     """
     Filter existing tj_data based on new_data. Return subordinate rows to
     be deleted.
 
+    This is the reference implementation comparing every pair of rows, see
+    `find_subordinate_rows` for the indexed one TJ rows are merged with.
+
     :param tj_data: list of rows currently existing in TJ
     :param new_data: list of new rows
+    :param vectors: dict mapping vector values to lists of relations they
+        encode, required for bitmap vectors
     :return: list of rows to delete
     """
     for tj_row in tj_data:
         for new_row in new_data:
-            if is_subordinate(tj_row, new_row):
+            if is_subordinate(tj_row, new_row, vectors):
                 yield tj_row
 
 
+def _relation_names(relations):
+    return frozenset(map(itemgetter('name'), relations))
+
+
+def _is_contained(vector, other_vector, vectors):
+    if isinstance(vector, int) and isinstance(other_vector, int):
+        return vector & other_vector == vector
+    return _relation_names(vectors[vector]).issubset(
+        _relation_names(vectors[other_vector]))
+
+
+def _projection_key(row, attributes):
+    return tuple(process_value(row.get(attr)) for attr in attributes)
+
+
+def _index_rows(rows, vectors):
+    """
+    Index rows by their vectors and values of the vector attributes, see
+    `_pop_subordinate_rows`.
+
+    :param rows: list of rows having vectors present in `vectors`
+    :param vectors: dict mapping vector values to lists of relations they
+        encode
+    :return: dict mapping vectors to tuples (attributes, dict mapping
+        attribute values to lists of rows)
+    """
+    index = {}
+    for row in rows:
+        vector = row[VECTOR_ATTRIBUTE]
+        if vector not in index:
+            index[vector] = ([attr for attr in all_attributes(vectors[vector])
+                              if attr in row], defaultdict(list))
+        attributes, buckets = index[vector]
+        buckets[_projection_key(row, attributes)].append(row)
+    return index
+
+
+def _pop_subordinate_rows(index, new_data, vectors):
+    """
+    Remove rows subordinate to the new rows from the index built by
+    `_index_rows`. Row is subordinate iff its vector is contained in the new
+    row's one and its values of the vector attributes match the new row,
+    which is checked with a single hash lookup per contained vector.
+
+    :return: generator of removed rows, each row is returned once
+    """
+    contained = {}
+    for new_row in new_data:
+        new_vector = new_row[VECTOR_ATTRIBUTE]
+        if new_vector not in contained:
+            contained[new_vector] = [
+                entry for vector, entry in index.items()
+                if (_is_contained(vector, new_vector, vectors)
+                    if new_vector in vectors else
+                    is_vector_less({VECTOR_ATTRIBUTE: vector}, new_row))]
+        for attributes, buckets in contained[new_vector]:
+            yield from buckets.pop(_projection_key(new_row, attributes), [])
+
+
+def find_subordinate_rows(tj_data, new_data, vectors):
+    """
+    Indexed version of `filter_subordinate_rows`, see `_pop_subordinate_rows`.
+    Rows having vectors missing from `vectors` are compared the old way.
+
+    :param tj_data: list of rows currently existing in TJ
+    :param new_data: list of new rows
+    :param vectors: dict mapping vector values to lists of relations they
+        encode
+    :return: list of rows to delete, each row is returned once
+    """
+    for row in tj_data:
+        if row[VECTOR_ATTRIBUTE] not in vectors and any(
+                is_subordinate(row, new_row, vectors)
+                for new_row in new_data):
+            yield row
+    index = _index_rows([row for row in tj_data
+                         if row[VECTOR_ATTRIBUTE] in vectors], vectors)
+    yield from _pop_subordinate_rows(index, new_data, vectors)
+
+
 def compose_table_name():
     return 'TJ_' + random_str(10)
 
 
-def create_tj_schema(context, dependencies):
+def subordination_engine(engine):
+    """
+    Pick the way subordinate rows are deleted from TJ stored in the DB behind
+    `engine`. 'python' engine fetches TJ rows and looks subordinate ones up
+    in their index, as `find_subordinate_rows` does, 'sql' engine does
+    everything inside the DB.
+    Setting might be either a single engine name or a dict of dialect name to
+    engine name.
+
+    :param engine: SQLAlchemy engine for cube DB
+    :return: engine name, either 'python' or 'sql'
+    """
+    setting = cfg.settings.get('subordination_engine', 'python')
+    if isinstance(setting, dict):
+        setting = setting.get(engine.dialect.name, 'python')
+    return setting
+
+
+def _set_vector(batches, vector):
+    for batch in batches:
+        # not using functional approach here to avoid data copying
+        for row in batch:
+            row[VECTOR_ATTRIBUTE] = vector
+        yield batch
+
+
+def _contained_vectors(vector, vectors, inserted):
+    return [other_vector for other_vector in inserted
+            if other_vector != vector and
+            _is_contained(other_vector, vector, vectors)]
+
+
+def _containing_vectors(vector, vectors, inserted):
+    return [other_vector for other_vector in inserted
+            if other_vector != vector and
+            _is_contained(vector, other_vector, vectors)]
+
+
+def _merge_in_python(cube, tj, batches, vector, vectors, inserted):
+    """
+    Merge joined rows into TJ comparing them with TJ rows in Python. Only TJ
+    rows of the contained and containing packs are fetched, and they are
+    indexed once, so every batch is checked with hash lookups. If there are
+    more of them than `python_merge_max_rows`, rows are merged by SQL
+    instead, so TJ data never has to fit in memory.
+    """
+    contained_vectors = _contained_vectors(vector, vectors, inserted)
+    containing_vectors = _containing_vectors(vector, vectors, inserted)
+    other_constraint = [[{'attribute': VECTOR_ATTRIBUTE, 'operation': 'IN',
+                          'value': contained_vectors + containing_vectors}]]
+    if contained_vectors or containing_vectors:
+        max_rows = cfg.settings.get('python_merge_max_rows', 100000)
+        if db.count_constrained(cube, tj['name'],
+                                other_constraint) > max_rows:
+            staging = _create_staging(cube, tj)
+            try:
+                db.insert_rows(cube, staging, chain.from_iterable(batches))
+            except Exception:
+                db.drop_table(cube, staging)
+                raise
+            _merge_staging(cube, tj, staging, vectors[vector], vectors,
+                           inserted)
+            return
+        tj_data = db.get_data(cube, tj['name'], tj['attributes'].keys(),
+                              other_constraint)
+    else:
+        tj_data = []
+
+    # rows inserted from previous batches are never subordinate to the rows
+    # of the same relations pack, so TJ data is indexed only once
+    subordinate = _index_rows([row for row in tj_data
+                               if row[VECTOR_ATTRIBUTE] in contained_vectors],
+                              vectors)
+    # new rows subordinate to the rows of the containing packs already in TJ
+    # are never inserted, but they still subordinate the contained packs'
+    # rows
+    attributes = [attr for attr in all_attributes(vectors[vector])
+                  if attr in tj['attributes']]
+    containing = {_projection_key(row, attributes) for row in tj_data
+                  if row[VECTOR_ATTRIBUTE] in containing_vectors}
+    del tj_data
+    for join_data in batches:
+        db.delete_rows(cube, tj, _pop_subordinate_rows(subordinate,
+                                                       join_data, vectors))
+        if containing:
+            join_data = [row for row in join_data
+                         if _projection_key(row, attributes)
+                         not in containing]
+        db.insert_rows(cube, tj, join_data)
+
+
+def _create_staging(cube, tj):
+    staging = {'name': compose_table_name(), 'attributes': tj['attributes']}
+    db.create_table(cube, staging)
+    return staging
+
+
+def _merge_staging(cube, tj, staging, relations, vectors, inserted):
+    """
+    Delete subordinate TJ rows with a DELETE ... WHERE EXISTS query per each
+    contained vector and move new rows from staging table to TJ, so existing
+    TJ data never leaves the cube DB. New rows subordinate to the rows of
+    the containing vectors are deleted from staging table before moving.
+    Staging table is dropped even if merging fails.
+    """
+    try:
+        new_vector = vector_value(tj, relations)
+        for vector in _contained_vectors(new_vector, vectors, inserted):
+            attributes = [attr for attr in all_attributes(vectors[vector])
+                          if attr in tj['attributes']]
+            filter_constraint = [[{'attribute': VECTOR_ATTRIBUTE,
+                                   'operation': '=', 'value': vector}]]
+            db.delete_matching(cube, tj, staging, attributes,
+                               filter_constraint)
+        containing_vectors = _containing_vectors(new_vector, vectors,
+                                                 inserted)
+        if containing_vectors:
+            attributes = [attr for attr in all_attributes(relations)
+                          if attr in tj['attributes']]
+            other_constraint = [[{'attribute': VECTOR_ATTRIBUTE,
+                                  'operation': 'IN',
+                                  'value': containing_vectors}]]
+            db.delete_matching(cube, staging, tj, attributes,
+                               other_constraint=other_constraint)
+        db.insert_from_select(cube, tj, staging)
+    finally:
+        db.drop_table(cube, staging)
+
+
+def _join_batches(source, attributes, relations, pushed_constraint=None,
+                  memo=None):
+    # memoized joins aren't filtered, neither are the joins derived from them
+    if memo is not None and pushed_constraint is None:
+        return memo.join_batches(relations)
+    return db.natural_join_batches(source, relations, attributes,
+                                   pushed_constraint=pushed_constraint)
+
+
+def _stage_pack(source, cube, tj, attributes, relations, server_side,
+                pushed_constraint=None, memo=None):
+    """
+    Join relations pack into a new staging table having TJ schema. If both
+    DBs are reachable by the cube DB the join is done by the cube DB itself,
+    so no rows are transferred from the DB server at all.
+
+    :return: staging relation
+    """
+    staging = _create_staging(cube, tj)
+    vector = vector_value(tj, relations)
+    try:
+        if server_side:
+            db.insert_from_join(cube, staging, source.url, relations,
+                                attributes, {VECTOR_ATTRIBUTE: vector},
+                                pushed_constraint=pushed_constraint)
+        else:
+            join_batches = _set_vector(
+                _join_batches(source, attributes, relations,
+                              pushed_constraint, memo),
+                vector)
+            db.insert_rows(cube, staging, chain.from_iterable(join_batches))
+    except Exception:
+        db.drop_table(cube, staging)
+        raise
+    return staging
+
+
+def _pushed_constraint(constraint, tj, relations, vectors):
+    """
+    Constraint the rows of relations pack might be filtered by while joined.
+    Rows failing the projected constraint are deleted only after they have
+    subordinated rows of the contained packs, so a row can be skipped only
+    if it fails projected constraints of all of those packs too: then its
+    subordinate rows have been deleted already.
+
+    :return: logical constraint or None if all rows of the pack are needed
+    """
+    vector = vector_value(tj, relations)
+    clauses = {}
+    for other_vector, other_relations in vectors.items():
+        if not _is_contained(other_vector, vector, vectors):
+            continue
+        projected_constraint = constraint_operations.project(
+            constraint, all_attributes(other_relations))
+        if not projected_constraint:
+            # rows of the pack aren't filtered at all
+            return None
+        for conjunction_clause in projected_constraint:
+            clauses[constraint_operations.fingerprint(
+                [conjunction_clause])] = conjunction_clause
+    return list(clauses.values()) or None
+
+
+def _restored_packs(cache, constraint, tj, relations_packs, vectors):
+    """
+    Find out which relations packs are restored from the cached TJ. Rows of
+    a pack covered by cache whose projected constraint isn't included in the
+    cached one might be missing in cache, e.g. on partial hit. Cached TJ has
+    also dropped the rows of the containing packs failing cached constraint,
+    which might subordinate those missing rows, so all of these packs are
+    joined again instead.
+
+    :return: list of flags, True for the packs to be restored
+    """
+    if not cache.enabled:
+        return [False] * len(relations_packs)
+    incomplete = []
+    for relations in relations_packs:
+        if not cache.contains_context(relations):
+            continue
+        attributes = all_attributes(relations)
+        if not constraint_operations.is_domain_included(
+                constraint_operations.project(constraint, attributes),
+                constraint_operations.project(cache.constraint, attributes)):
+            incomplete.append(vector_value(tj, relations))
+    return [cache.contains_context(relations) and
+            not any(_is_contained(vector, vector_value(tj, relations),
+                                  vectors)
+                    for vector in incomplete)
+            for relations in relations_packs]
+
+
+def _is_thread_local(engine):
+    # every thread gets its own in-memory SQLite DB
+    return engine.url.get_backend_name() == 'sqlite' and \
+        engine.url.database in (None, '', ':memory:')
+
+
+def create_tj_schema(context, dependencies, required_attributes=None):
+    """
+    Compose TJ relation for the given context. Vector attribute is a string
+    unless `vector_encoding` setting is 'bitmap', then it's an integer and
+    relation-index mapping is kept under 'vector_relations' key.
+    Only the attributes needed for `required_attributes` are kept, see
+    `get_attributes`.
+    """
     tj_name = compose_table_name()
-    full_schema = get_attributes(context, dependencies)
-    # add vector attribute holding information about participating relations
-    full_schema.update({VECTOR_ATTRIBUTE: String(VECTOR_MAX_LENGTH)})
+    full_schema = get_attributes(context, dependencies, required_attributes)
     relation = {'name': tj_name, 'attributes': full_schema}
+    # add vector attribute holding information about participating relations
+    bitmap = cfg.settings.get('vector_encoding', 'string') == 'bitmap'
+    if bitmap and len(context) > BITMAP_MAX_LENGTH:
+        logger.warning('Context is too large for bitmap vector, falling '
+                       'back to string one')
+        bitmap = False
+    if bitmap:
+        full_schema.update({VECTOR_ATTRIBUTE: BigInteger})
+        relation['vector_relations'] = sorted(map(itemgetter('name'),
+                                                  context))
+    else:
+        full_schema.update({VECTOR_ATTRIBUTE: String(VECTOR_MAX_LENGTH)})
     return relation
 
 
-def build(context, dependencies, constraint, source, cube, cache_file):
+def _pack_workers(source, cube):
+    workers = cfg.settings.get('pack_workers', 1)
+    if workers > 1 and (_is_thread_local(source) or _is_thread_local(cube)):
+        logger.warning('In-memory DBs can\'t be shared between threads, '
+                       'joining relation packs sequentially')
+        workers = 1
+    return workers
+
+
+def _restore_packs(cache, constraint, tj, relations_packs):
+    """
+    Restore rows of the relations packs from the cached TJ at once, filtered
+    by the packs' projections of the constraint. The rest of packs are
+    never contained in them, so restored rows are subordinated later on.
+
+    :return: set of restored packs' vectors
+    """
+    if relations_packs:
+        # cached TJ might encode vectors differently
+        cache.restore_packs(tj, VECTOR_ATTRIBUTE, [
+            (vector_value(cache.relation, relations),
+             vector_value(tj, relations),
+             constraint_operations.project(constraint,
+                                           all_attributes(relations)))
+            for relations in relations_packs])
+    return {vector_value(tj, relations) for relations in relations_packs}
+
+
+def _merge_pack(source, cube, tj, attributes, relations, pushed_constraint,
+                vectors, inserted, server_side, memo, staged=None):
+    """
+    Join relations pack unless it's `staged` already, and merge its rows into
+    TJ by the subordination engine.
+    """
+    if staged is not None:
+        _merge_staging(cube, tj, staged.result(), relations, vectors,
+                       inserted)
+    elif server_side or subordination_engine(cube) == 'sql':
+        staging = _stage_pack(source, cube, tj, attributes, relations,
+                              server_side, pushed_constraint, memo)
+        _merge_staging(cube, tj, staging, relations, vectors, inserted)
+    else:
+        vector = vector_value(tj, relations)
+        join_batches = _set_vector(
+            _join_batches(source, attributes, relations, pushed_constraint,
+                          memo),
+            vector)
+        _merge_in_python(cube, tj, join_batches, vector, vectors, inserted)
+
+
+def _merge_packs(source, cube, tj, attributes, constraint, packs, vectors,
+                 inserted, server_side, memo, staged, largest_first):
+    """
+    Merge relations packs into TJ one by one and delete their rows failing
+    projected constraint. Packs processed largest first never insert rows
+    subordinate to the rows of the larger packs, but rows failing the
+    constraint still subordinate the smaller packs' rows, so they are
+    deleted in the end.
+
+    :param packs: list of tuples (relations, pushed constraint) in order
+    :param inserted: set of vectors of the packs having rows in TJ, merged
+        packs' vectors are added
+    :param staged: dict of pack index to the future of its staging table,
+        merged packs are removed
+    """
+    unsatisfied = []
+    for j, (relations, pushed_constraint) in enumerate(packs):
+        logger.debug('Using relations {}'.format(
+            list(map(itemgetter('name'), relations))))
+        vector = vector_value(tj, relations)
+        _merge_pack(source, cube, tj, attributes, relations,
+                    pushed_constraint, vectors, inserted, server_side, memo,
+                    staged.pop(j, None))
+        inserted.add(vector)
+        projected_constraint = constraint_operations.project(
+            constraint, all_attributes(relations))
+        filter_constraint = [[{'attribute': VECTOR_ATTRIBUTE,
+                               'operation': '=', 'value': vector}]]
+        if projected_constraint and largest_first:
+            unsatisfied.append((projected_constraint, filter_constraint))
+        elif projected_constraint:
+            db.delete_unsatisfied(cube, tj, projected_constraint,
+                                  filter_constraint)
+    for projected_constraint, filter_constraint in unsatisfied:
+        db.delete_unsatisfied(cube, tj, projected_constraint,
+                              filter_constraint)
+
+
+def _cancel_staging(cube, executor, staged):
+    """
+    Cancel joins of the packs left in `staged` because of an error, wait for
+    the running ones and drop their staging tables.
+    """
+    for future in staged.values():
+        future.cancel()
+    executor.shutdown()
+    for future in staged.values():
+        if not future.cancelled() and future.exception() is None:
+            db.drop_table(cube, future.result())
+
+
+def build(context, dependencies, constraint, source, cube, cache_file,
+          required_attributes=None):
     """
     Build Table of Joins and write it to the destination DB
 
@@ -154,44 +656,119 @@ def build(context, dependencies, constraint, source, cube, cache_file):
     :param source: SQLAlchemy engine for source DB
     :param cube: SQLAlchemy engine for cube DB
     :param cache_file: file name of the cache file to be used
+    :param required_attributes: names of attributes the TJ is queried for,
+        e.g. dimension and measure ones. Other attributes are only selected
+        when needed to build the TJ. All attributes are kept by default
     """
+    if required_attributes is not None:
+        required_attributes = set(required_attributes) | {
+            predicate['attribute'] for conjunction_clause in constraint
+            for predicate in conjunction_clause}
+    tj = create_tj_schema(context, dependencies, required_attributes)
+    tj_attributes = set(tj['attributes']) - {VECTOR_ATTRIBUTE}
+
     cache = Cache(cube, cache_file)
-    cached_tj = cache.full_match(context, constraint)
+    cached_tj = cache.full_match(context, constraint, tj_attributes)
     if cached_tj:
         return cached_tj
 
-    tj = create_tj_schema(context, dependencies)
-    db.create_table(cube, tj)
+    # integer vectors are short enough to be indexed
+    indexes = [VECTOR_ATTRIBUTE] if tj.get('vector_relations') else []
+    db.create_table(cube, tj, indexes)
 
-    cache.enable(context, constraint)
+    cache.enable(context, constraint, tj_attributes)
 
     # fill TJ with data
     relations_packs = list(lossless_combinations(context, dependencies))
     if context not in relations_packs:
         relations_packs.append(context)
-    for relations in relations_packs:
-        logger.debug('Using relations {}'.format(list(map(itemgetter('name'),
-                                                          relations))))
-        vector = encode_vector(relations)
-        projected_constraint = constraint_operations.project(
-            constraint, all_attributes(relations))
-        filter_constraint = [[{'attribute': 'g', 'operation': '=',
-                               'value': vector}]]
-        if cache.enabled and cache.contains_context(relations):
-            cache.restore(tj, projected_constraint, filter_constraint)
-        else:
-            attributes = tj['attributes'].copy()
-            del attributes[VECTOR_ATTRIBUTE]
-            join_data = db.natural_join(source, relations, attributes)
-            # not using functional approach here to avoid data copying
-            for row in join_data:
-                row[VECTOR_ATTRIBUTE] = vector
-            tj_data = db.get_rows(cube, tj)
-            rows_to_delete = filter_subordinate_rows(tj_data, join_data)
-            db.delete_rows(cube, tj, rows_to_delete)
-            db.insert_rows(cube, tj, join_data)
-            if projected_constraint:
-                db.delete_unsatisfied(cube, tj, projected_constraint,
-                                      filter_constraint)
+    vectors = {vector_value(tj, relations): relations
+               for relations in relations_packs}
+    server_side = db.server_side_schema(source.url, cube.url) is not None
+    attributes = tj['attributes'].copy()
+    del attributes[VECTOR_ATTRIBUTE]
+    restored = _restored_packs(cache, constraint, tj, relations_packs, vectors)
+    joined = [(relations, _pushed_constraint(constraint, tj, relations,
+                                             vectors))
+              for i, relations in enumerate(relations_packs)
+              if not restored[i]]
+    largest_first = cfg.settings.get('pack_order',
+                                     'smallest_first') == 'largest_first'
+    if largest_first:
+        joined.sort(key=lambda pack: -len(pack[0]))
+
+    # packs might be joined concurrently into staging tables, but they are
+    # merged into TJ one by one in the same order anyway
+    workers = _pack_workers(source, cube)
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 \
+        else None
+    # joins of the packs joined one by one might be derived from each other
+    memo_rows = cfg.settings.get('subjoin_memo_rows', 0)
+    memo = SubJoinMemo(source, attributes, memo_rows) \
+        if memo_rows and executor is None and not server_side else None
+    staged = {}
+    if executor is not None:
+        staged = {j: executor.submit(_stage_pack, source, cube, tj,
+                                     attributes, relations, server_side,
+                                     pushed_constraint)
+                  for j, (relations, pushed_constraint) in enumerate(joined)}
+    try:
+        # vectors of the packs having rows in TJ
+        inserted = _restore_packs(cache, constraint, tj, [
+            relations for i, relations in enumerate(relations_packs)
+            if restored[i]])
+        _merge_packs(source, cube, tj, attributes, constraint, joined,
+                     vectors, inserted, server_side, memo, staged,
+                     largest_first)
+    finally:
+        if executor is not None:
+            _cancel_staging(cube, executor, staged)
+        # cached TJ isn't needed anymore once its rows are restored
+        cache.release()
     cache.add(tj, context, constraint)
     return tj
+
+
+def _init_worker(settings):
+    cfg.settings = settings
+    # forked workers inherit random state and would give TJs same names
+    random.seed()
+
+
+def _build_in_worker(context, dependencies, constraint, source_url, cube_url,
+                     cache_file, required_attributes):
+    source = create_engine(source_url)
+    cube = create_engine(cube_url)
+    try:
+        return build(context, dependencies, constraint, source, cube,
+                     cache_file, required_attributes)
+    finally:
+        source.dispose()
+        cube.dispose()
+
+
+def build_parallel(jobs, dependencies, source, cube, cache_file, workers,
+                   required_attributes=None):
+    """
+    Build Tables of Joins for several contexts concurrently, each in a
+    separate process having its own engines. Cube DB has to support
+    concurrent writes.
+
+    :param jobs: list of tuples (context, constraint), see `build`
+    :param dependencies: list of dependencies held
+    :param source: SQLAlchemy engine for source DB, workers connect to its URL
+    :param cube: SQLAlchemy engine for cube DB, workers connect to its URL
+    :param cache_file: file name of the cache file to be used
+    :param workers: maximum number of processes to use
+    :param required_attributes: names of attributes the TJs are queried for,
+        see `build`
+    :return: list of TJ relations in order of the jobs
+    """
+    dependencies = list(dependencies)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cfg.settings,)) as executor:
+        futures = [executor.submit(_build_in_worker, context, dependencies,
+                                   constraint, source.url, cube.url,
+                                   cache_file, required_attributes)
+                   for context, constraint in jobs]
+        return [future.result() for future in futures]
@@ -1,31 +1,84 @@
 import itertools
-from copy import deepcopy
-
-from pyro.lossless import is_lossless
+import logging
+import time
+from collections import defaultdict
+from functools import lru_cache
+from heapq import heappush, heappop
+
+from pyro.lossless import chase_combinations, chase, extend_tableau, \
+    held_dependencies, build_tableau
 from pyro.utils import common_keys, all_attributes
 
+logger = logging.getLogger(__name__)
+
+
+class DependencyIndex:
+    """
+    List of dependencies precompiled for computing attributes closure in
+    linear time (Beeri-Bernstein algorithm): each dependency has a counter of
+    left side attributes not yet in closure and each attribute refers to the
+    dependencies having it on the left side. Computed closures are memoized.
+
+    Index can be used in place of the dependencies list it was built from.
+    """
+    def __init__(self, dependencies, cache_size=1024):
+        self._dependencies = list(dependencies)
+        self._left_sizes = [len(dep['left']) for dep in self._dependencies]
+        self._rights = [frozenset(dep['right']) for dep in self._dependencies]
+        self._index = defaultdict(list)
+        for i, dep in enumerate(self._dependencies):
+            for attr in dep['left']:
+                self._index[attr].append(i)
+        self._cached_closure = lru_cache(maxsize=cache_size)(self._closure)
+
+    def __iter__(self):
+        return iter(self._dependencies)
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def _closure(self, attributes):
+        counters = list(self._left_sizes)
+        result = set(attributes)
+        queue = list(result)
+        for i, counter in enumerate(counters):
+            if counter == 0:
+                queue.extend(self._rights[i] - result)
+                result |= self._rights[i]
+        while queue:
+            attr = queue.pop()
+            for i in self._index.get(attr, ()):
+                counters[i] -= 1
+                if counters[i] == 0:
+                    queue.extend(self._rights[i] - result)
+                    result |= self._rights[i]
+        return frozenset(result)
+
+    def closure(self, attributes):
+        """
+        Count attributes closure.
+
+        :param attributes: set of attributes to count closure of
+        :return: set of attributes, contained in closure
+        """
+        return set(self._cached_closure(frozenset(attributes)))
+
 
 def closure(attributes, dependencies):
     """
     Count attributes closure according to given functional dependencies. See
     Ullman's "Database Systems - The Complete book", p. 75 for definition of
-    closure and this algorithm.
+    closure and Beeri & Bernstein "Computational problems related to the
+    design of normal form relational schemas" for the linear algorithm used.
 
     :param attributes: set of attributes to count closure of
-    :param dependencies: list of dependencies held on Database
+    :param dependencies: list of dependencies held on Database or
+        `DependencyIndex` built from it
     :return: set of attributes, contained in closure
     """
-    result = set(attributes)
-
-    added = True
-    while added:
-        added = False
-        for dep in dependencies:
-            if (result.issuperset(dep['left']) and
-                    not result.issuperset(dep['right'])):
-                result = result.union(dep['right'])
-                added = True
-    return result
+    if not isinstance(dependencies, DependencyIndex):
+        dependencies = DependencyIndex(dependencies)
+    return dependencies.closure(attributes)
 
 
 def existing_join(relations):
@@ -36,20 +89,21 @@ def existing_join(relations):
     :return: permuted list of relations where each relation intersects with
     at least one of the previous relations
     """
-    _relations = deepcopy(relations)
-    rel_len = len(_relations)
+    # relations themselves are neither copied nor reordered, their indices
+    # are permuted instead
+    order = list(range(len(relations)))
+    rel_len = len(order)
     point = 1
     for i in range(rel_len - 1):
         for j in range(point, rel_len):
-            if common_keys(_relations[i]['attributes'],
-                           _relations[j]['attributes']):
-                _relations[point], _relations[j] = _relations[j],\
-                                                   _relations[point]
+            if common_keys(relations[order[i]]['attributes'],
+                           relations[order[j]]['attributes']):
+                order[point], order[j] = order[j], order[point]
                 point += 1
         if point == rel_len:
-            return _relations
+            return [relations[k] for k in order]
         if point == i + 1:
-            return _relations[:point]
+            return [relations[k] for k in order[:point]]
 
 
 def prioritized_relations(relations, base_relations, dependencies):
@@ -61,14 +115,16 @@ def prioritized_relations(relations, base_relations, dependencies):
     :param relations: list of relations to prioritize
     :param base_relations: list of initial relations
     :param dependencies: list of dependencies that are satisfied by all
-        relations
+        relations or `DependencyIndex` built from it
     :return: list of tuples of the following type: (r, N), where r is relations
         element and N is a priority number from set {1, 2, 3}.
     """
+    if not isinstance(dependencies, DependencyIndex):
+        dependencies = DependencyIndex(dependencies)
     result = []
     for relation in relations:
         attrs = all_attributes(base_relations + [relation])
-        if closure(relation['pk'], dependencies).issuperset(attrs):
+        if dependencies.closure(relation['pk']).issuperset(attrs):
             result.append((relation, 3))
         elif set(all_attributes(base_relations)).intersection(
                 relation['attributes']):
@@ -79,16 +135,10 @@ def prioritized_relations(relations, base_relations, dependencies):
 
 
 def lossless_combinations(relations, dependencies):
-    n = len(relations)
-    for k in range(n + 1):
-        combinations = itertools.combinations(relations, k)
-        for combination in combinations:
-            def is_dependency_held(dep):
-                attributes = set(dep['left'] | dep['right'])
-                return attributes.issubset(all_attributes(combination))
-            satisfied_deps = filter(is_dependency_held, dependencies)
-            if is_lossless(combination, satisfied_deps):
-                yield list(combination)
+    for combination, lossless in chase_combinations([], relations,
+                                                    dependencies):
+        if lossless:
+            yield combination
 
 
 def contexts(all_relations, base, dependencies):
@@ -108,13 +158,89 @@ def contexts(all_relations, base, dependencies):
     relations_to_check, priorities = zip(*prioritized_relations(
         relations_to_check, base_relations, dependencies))
 
-    n = len(relations_to_check)
-    for k in range(n + 1):
-        relation_packs = itertools.combinations(relations_to_check, k)
-        for relations in relation_packs:
-            context = base_relations + list(relations)
-            satisfied_deps = filter(lambda d: set(d['left'] | d['right'])
-                                    .issubset(all_attributes(context)),
-                                    dependencies)
-            if is_lossless(context, satisfied_deps):
+    for context, lossless in chase_combinations(base_relations,
+                                                list(relations_to_check),
+                                                dependencies):
+        if lossless:
+            yield context
+
+
+def _is_connected(relations):
+    return len(relations) < 2 or \
+        len(existing_join(relations)) == len(relations)
+
+
+def search_contexts(all_relations, base, dependencies, max_expansions=None,
+                    time_limit=None):
+    """
+    Best-first search of Contexts based on the `base` relations provided.
+    Candidate sets are explored in order of their size and then of the total
+    priority of their relations (see `prioritized_relations`), so the first
+    context yielded is the smallest one, preferring relations likely to
+    satisfy Lossless join property. The search space is pruned:
+
+    * relations are added only if they intersect with the candidate set, as
+      disconnected relations form cartesian product which can't be joined
+      without losses (unless some dependency has empty left side);
+    * supersets of a found context are not checked as it is already
+      satisfying the property with fewer relations.
+
+    Chased tableau of a candidate set is extended by the added relation for
+    its successors, see `pyro.lossless.chase_combinations`.
+
+    :param all_relations: list of all relations to add to the context
+    :param base: list of strings - names of the relations that are initially in
+        the context
+    :param dependencies: list of dependencies held in the DB
+    :param max_expansions: maximum number of candidate sets to check, no limit
+        if None
+    :param time_limit: number of seconds after which search is stopped, no
+        limit if None
+    :return yield list of relations representing context
+    """
+    base_relations = [r for r in all_relations if r['name'] in base]
+    relations_to_check = [r for r in all_relations if r['name'] not in base]
+    prioritized = prioritized_relations(relations_to_check, base_relations,
+                                        dependencies)
+    candidates = [r for r, _ in prioritized]
+    priorities = [p for _, p in prioritized]
+    dependencies = list(dependencies)
+    connected_only = all(dep['left'] for dep in dependencies)
+
+    start = time.monotonic()
+    counter = itertools.count()
+    found = []
+    seen = {()}
+    frontier = [((0, 0, ()), next(counter), build_tableau(base_relations))]
+    expansions = 0
+    while frontier:
+        if max_expansions is not None and expansions >= max_expansions:
+            logger.warning('Context search stopped after checking {} '
+                           'relation sets'.format(expansions))
+            return
+        if time_limit is not None and time.monotonic() - start > time_limit:
+            logger.warning('Context search stopped after {} seconds'.format(
+                time_limit))
+            return
+        (_, _, indices), _, tableau = heappop(frontier)
+        if any(f.issubset(indices) for f in found):
+            continue
+        expansions += 1
+        context = base_relations + [candidates[i] for i in indices]
+        if not connected_only or _is_connected(context):
+            if chase(tableau, held_dependencies(context, dependencies)):
+                found.append(frozenset(indices))
                 yield context
+                continue
+        attributes = set(all_attributes(context))
+        for i, relation in enumerate(candidates):
+            child = tuple(sorted(set(indices) | {i}))
+            if child in seen or any(f.issubset(child) for f in found):
+                continue
+            if connected_only and attributes and \
+                    not attributes.intersection(relation['attributes']):
+                continue
+            seen.add(child)
+            priority = sum(priorities[j] for j in child)
+            heappush(frontier, ((len(child), -priority, child), next(counter),
+                                extend_tableau(tableau, relation)))
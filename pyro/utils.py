@@ -1,4 +1,5 @@
 import string
+from itertools import islice
 from json import JSONEncoder
 import datetime
 from random import choice
@@ -109,6 +110,21 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def batches(iterable, n):
+    """
+    Yield successive lists of n elements taken from any iterable, consuming
+    it lazily. The last list might be shorter.
+
+    :param iterable: iterable to split, e.g. generator
+    :param n: maximum length of output lists
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, n))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, n))
+
+
 def assemble_list(l, key=lambda x: x):
     """
     Create a list of elements from list `l` of lists of elements, removing
@@ -5,6 +5,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.engine.url import URL
 
 from pyro import db, tj, transformation, representation, cfg
+from pyro.cache import Cache
 from pyro.utils import relation_name, assemble_list, attribute_name
 
 
@@ -28,6 +29,8 @@ if __name__ == '__main__':
     mvd = [{part: set(attributes) for part, attributes in dep.items()}
            for dep in mvd]
     dependencies.extend(mvd)
+    # compile dependencies once for all the closure computations
+    dependencies = transformation.DependencyIndex(dependencies)
 
     # get main attributes
     dimension_attributes = [list(map(attribute_name, d['attributes']))
@@ -40,6 +43,10 @@ if __name__ == '__main__':
     logging.info('Building dimension contexts...')
     contexts = []
     base_total = {measure_relation}
+    search_budget = {
+        'max_expansions': cfg.settings.get('context_search_max_expansions'),
+        'time_limit': cfg.settings.get('context_search_time_limit'),
+    }
     # build dimension contexts
     for dimension in cfg.settings['dimensions']:
         logging.info('Building context for dimension "{}"'.format(
@@ -48,15 +55,16 @@ if __name__ == '__main__':
         base = set(map(relation_name, dimension['attributes']))
         base_total |= base
         # for now pick first found context
-        context = next(transformation.contexts(relations, base, dependencies))
+        context = next(transformation.search_contexts(
+            relations, base, dependencies, **search_budget))
         contexts.append(context)
 
     # build application context
     if cfg.settings['app_context']:
         logging.info('Building application context')
         try:
-            app_context = next(transformation.contexts(relations, base_total,
-                                                       dependencies))
+            app_context = next(transformation.search_contexts(
+                relations, base_total, dependencies, **search_budget))
         except StopIteration:
             # no combination satisfies Lossless Join property. Pick all
             # relations
@@ -74,21 +82,38 @@ if __name__ == '__main__':
                            cfg.settings['dimensions']))
     constraints.append([])  # no application constraint will be used
 
-    cache_file_path = cfg.settings.get('cache_file', 'cache.json')
+    # JSON register can't be opened as a SQLite one and vice versa
+    default_cache_file = 'cache.db' \
+        if cfg.settings.get('cache_backend', 'json') == 'sqlite' \
+        else 'cache.json'
+    cache_file_path = cfg.settings.get('cache_file', default_cache_file)
+    # only the attributes of the result table and the ones needed to build
+    # TJs are selected from the source DB
+    required_attributes = {measure_attribute}.union(*dimension_attributes)
 
     # connect to the output DB
     logging.info('Connecting to the cube DB: {}'.format(
         cfg.settings['cube_db']['database']))
     cube_engine = create_engine(URL(**cfg.settings['cube_db']))
 
-    table_names = []
-    for context, constraint, dimension in zip(contexts, constraints,
-                                              dimension_attributes + [[]]):
-        logging.info('Building Table of Joins for the context {}'.format(
-            list(map(itemgetter('name'), context))))
-        table_of_joins = tj.build(context, dependencies, constraint,
-                                  source_engine, cube_engine, cache_file_path)
-        table_names.append(table_of_joins['name'])
+    workers = cfg.settings.get('tj_workers', 1)
+    if workers > 1:
+        logging.info('Building Tables of Joins in {} processes'.format(
+            workers))
+        tables_of_joins = tj.build_parallel(
+            list(zip(contexts, constraints)), dependencies, source_engine,
+            cube_engine, cache_file_path, workers, required_attributes)
+        table_names = [table_of_joins['name']
+                       for table_of_joins in tables_of_joins]
+    else:
+        table_names = []
+        for context, constraint in zip(contexts, constraints):
+            logging.info('Building Table of Joins for the context {}'.format(
+                list(map(itemgetter('name'), context))))
+            table_of_joins = tj.build(context, dependencies, constraint,
+                                      source_engine, cube_engine,
+                                      cache_file_path, required_attributes)
+            table_names.append(table_of_joins['name'])
 
     logging.info('The source Database has been successfully transformed to '
                  'OLAP representation!')
@@ -96,3 +121,10 @@ if __name__ == '__main__':
     logging.info('Writing the result table to the file')
     representation.create(cube_engine, table_names, dimension_attributes,
                           measure_attribute, cfg.settings['output_file'])
+
+    cache_max_size = cfg.settings.get('cache_max_size')
+    if cache_max_size is not None:
+        evicted = Cache(cube_engine, cache_file_path).evict(
+            cache_max_size, keep=table_names)
+        logging.info('Evicted {} Tables of Joins from the cache'.format(
+            len(evicted)))
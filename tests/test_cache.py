@@ -2,6 +2,8 @@ import json
 import os
 from os.path import abspath, join, dirname
 from shutil import copyfile
+from tempfile import mkstemp
+from unittest import TestCase, skipIf
 from unittest.mock import patch
 
 from sqlalchemy import Column
@@ -11,7 +13,7 @@ from sqlalchemy import String
 from sqlalchemy import Table
 
 from pyro import db
-from pyro.cache import Cache
+from pyro.cache import Cache, SQLiteRegistry, _is_alive, _new_pin
 from tests.alchemy import DatabaseTestCase
 
 
@@ -114,10 +116,37 @@ class TestCache(DatabaseTestCase):
         ]]
         engine = None
 
+        with patch.dict('pyro.cfg.settings', {'partial_cache_hits': False}):
+            cache = Cache(engine, self.cache_file_path)
+            cache.enable([r1, r2], constraint)
+
+        self.assertFalse(cache.enabled)
+
+    def test_enable_partial(self):
+        r1 = {
+            "name": "R_1", "attributes": {"A11": "Integer", "A12": "String",
+                                          "A13": "Integer", "A14": "Boolean"}
+        }
+        r2 = {
+            "name": "R_2", "attributes": {"A21": "Integer", "A22": "String",
+                                          "A23": "Integer", "A24": "Boolean"}
+        }
+        constraint = [[
+            {
+                "attribute": "A4",
+                "operation": "=",
+                "value": "str value"
+            }
+        ]]
+        engine = None
+
         cache = Cache(engine, self.cache_file_path)
         cache.enable([r1, r2], constraint)
 
-        self.assertFalse(cache.enabled)
+        self.assertTrue(cache.enabled)
+        self.assertTrue(cache.partial)
+        self.assertEqual(cache.relation['name'], 'TJ_1')
+        self.assertEqual(len(cache.constraint), 2)
 
     def test_contains_unsatisfied(self):
         metadata = MetaData(self.engine, reflect=True)
@@ -431,6 +460,70 @@ class TestCache(DatabaseTestCase):
         self.assertIn(constraint, [entry['constraint']
                                    for entry in new_config])
 
+    def test_full_match(self):
+        context = [{"name": "R_2", "attributes": {}},
+                   {"name": "R_1", "attributes": {}}]
+        # same constraint as the cached one, but in different order
+        constraint = [
+            [{"attribute": "A6", "operation": "NOT BETWEEN", "value": [1, 16]},
+             {"attribute": "A4", "operation": "<>", "value": "str value"}],
+            [{"attribute": "A2", "operation": "=", "value": 6},
+             {"attribute": "A1", "operation": ">", "value": 4}]]
+        engine = None
+
+        cache = Cache(engine, self.cache_file_path)
+
+        self.assertEqual(cache.full_match(context, constraint)['name'], 'TJ_1')
+        self.assertIsNone(cache.full_match(context[:1], constraint))
+        self.assertIsNone(cache.full_match(context, constraint[:1]))
+
+    def test_full_match_attributes(self):
+        """
+        Cached TJ lacking some required attributes of its context can't be
+        used
+        """
+        context = [{"name": "R_2", "attributes": {}},
+                   {"name": "R_1", "attributes": {}}]
+        constraint = [
+            [{"attribute": "A1", "operation": ">", "value": 4},
+             {"attribute": "A2", "operation": "=", "value": 6}],
+            [{"attribute": "A4", "operation": "<>", "value": "str value"},
+             {"attribute": "A6", "operation": "NOT BETWEEN",
+              "value": [1, 16]}]]
+        engine = None
+
+        cache = Cache(engine, self.cache_file_path)
+        cache._update_config(lambda config: config[0]['relation'][
+            'attributes'].update({'A11': 'Integer'}))
+
+        self.assertEqual(cache.full_match(context, constraint,
+                                          {'A11'})['name'], 'TJ_1')
+        # attributes missing from the context aren't required from cache
+        self.assertEqual(cache.full_match(context, constraint,
+                                          {'A11', 'A99'})['name'], 'TJ_1')
+        self.assertIsNone(cache.full_match(context, constraint,
+                                           {'A11', 'A12'}))
+
+    def test_add_concurrent(self):
+        """
+        Check that entries added by other Cache instances, e.g. in other
+        processes, are not lost
+        """
+        relation_1 = {"name": "TJ_2", "attributes": {"A1": "Integer"}}
+        relation_2 = {"name": "TJ_3", "attributes": {"A1": "Integer"}}
+        context = [{"name": "R_1", "attributes": {"A11": "Integer"}}]
+        engine = None
+
+        cache_1 = Cache(engine, self.cache_file_path)
+        cache_2 = Cache(engine, self.cache_file_path)
+        cache_1.add(relation_1, context, [])
+        cache_2.add(relation_2, context, [])
+
+        with open(self.cache_file_path) as config_file:
+            relations = [entry['relation'] for entry in json.load(config_file)]
+        self.assertIn(relation_1, relations)
+        self.assertIn(relation_2, relations)
+
     def test_restore(self):
         metadata = MetaData(self.engine, reflect=True)
         tj_cached = Table('TJ_1', metadata,
@@ -497,3 +590,244 @@ class TestCache(DatabaseTestCase):
         first_row = res[0]
         del first_row['A7']
         self.assertDictEqual(dict(first_row), row_1)
+
+    def test_restore_packs(self):
+        metadata = MetaData(self.engine, reflect=True)
+        tj_cached = Table('TJ_1', metadata,
+                          Column('A1', Integer, primary_key=True),
+                          Column('A2', String(20)),
+                          Column('g', String(50)))
+        new_tj = Table('TJ_new', metadata,
+                       Column('A1', Integer, primary_key=True),
+                       Column('A2', String(20)),
+                       Column('g', String(50)))
+        metadata.create_all()
+
+        # populate with data
+        with self.engine.connect() as conn:
+            conn.execute(tj_cached.insert(), [
+                {'A1': 1, 'A2': 'a12 str', 'g': 'v1'},
+                {'A1': 2, 'A2': 'a22 str', 'g': 'v1'},
+                {'A1': 3, 'A2': 'a32 str', 'g': 'v2'},
+                {'A1': 4, 'A2': 'a42 str', 'g': 'v3'}
+            ])
+
+        dest_relation = {
+            "name": new_tj.name,
+            "attributes": {"A1": "Integer", "A2": "String", "g": "String"}
+        }
+        context = [
+            {
+                "name": "R_1", "attributes": {"A1": "Integer",
+                                              "A2": "String",
+                                              "A3": "Integer",
+                                              "A4": "Boolean"}
+            },
+            {
+                "name": "R_2", "attributes": {"A1": "Integer",
+                                              "A6": "String"}
+            }]
+        cache = Cache(self.engine, self.cache_file_path)
+        cache._config[0]['constraint'] = []
+        cache._config[0]['relation']['attributes']['g'] = 'String'
+        cache.enable(context=context, constraint=[])
+
+        constraint = [[{"attribute": "A1", "operation": ">", "value": 1}]]
+        with patch('pyro.db.insert_from_select', autospec=True,
+                   side_effect=db.insert_from_select) as mock_insert:
+            cache.restore_packs(dest_relation, 'g', [
+                ('v1', 'w1', constraint), ('v2', 'v2', constraint),
+                ('v3', 'w3', [])])
+
+        self.assertEqual(mock_insert.call_count, 1)
+        res = db.get_rows(self.engine, dest_relation)
+        self.assertEqual(sorted((r['A1'], r['g']) for r in res),
+                         [(2, 'w1'), (3, 'v2'), (4, 'w3')])
+
+
+class TestSQLiteRegistry(TestCase):
+    def setUp(self):
+        fd, self.registry_file_path = mkstemp(suffix='.db')
+        os.close(fd)
+        self.r1 = {'name': 'R_1', 'attributes': {'A11': 'Integer'}}
+        self.r2 = {'name': 'R_2', 'attributes': {'A21': 'Integer'}}
+        self.r3 = {'name': 'R_3', 'attributes': {'A31': 'Integer'}}
+
+    def tearDown(self):
+        os.remove(self.registry_file_path)
+
+    def entry(self, name, context, constraint=None):
+        return {'relation': {'name': name, 'attributes': {'A11': 'Integer'}},
+                'context': context, 'constraint': constraint or []}
+
+    def test_json_register(self):
+        with open(self.registry_file_path, 'w') as registry_file:
+            json.dump([], registry_file)
+        self.assertRaises(ValueError, SQLiteRegistry, self.registry_file_path)
+
+    def test_find(self):
+        constraint = [[{'attribute': 'A11', 'operation': '=', 'value': 1}]]
+        registry = SQLiteRegistry(self.registry_file_path)
+        registry.add(self.entry('TJ_1', [self.r1, self.r2]))
+        registry.add(self.entry('TJ_2', [self.r1]))
+        registry.add(self.entry('TJ_3', [self.r2, self.r1], constraint))
+
+        self.assertEqual(registry.find([self.r2, self.r1], [])['relation'],
+                         {'name': 'TJ_1', 'attributes': {'A11': 'Integer'}})
+        entry = registry.find([self.r1, self.r2], constraint)
+        self.assertEqual(entry['relation']['name'], 'TJ_3')
+        self.assertEqual(entry['context'], [self.r2, self.r1])
+        self.assertIsNone(registry.find([self.r3], []))
+
+    def test_entries_within(self):
+        registry = SQLiteRegistry(self.registry_file_path)
+        registry.add(self.entry('TJ_1', [self.r1, self.r2]))
+        registry.add(self.entry('TJ_2', [self.r3]))
+        registry.add(self.entry('TJ_3', [self.r1]))
+        registry.add(self.entry('TJ_4', [self.r2, self.r3]))
+
+        entries = registry.entries_within(['R_1', 'R_2'])
+        self.assertEqual([e['relation']['name'] for e in entries],
+                         ['TJ_1', 'TJ_3'])
+        entries = registry.entries_within(['R_1', 'R_2', 'R_3'])
+        self.assertEqual(len(entries), 4)
+
+    def test_add_existing(self):
+        registry = SQLiteRegistry(self.registry_file_path)
+        self.assertTrue(registry.add(self.entry('TJ_1', [self.r1])))
+        self.assertFalse(registry.add(self.entry('TJ_1', [self.r1, self.r2])))
+        self.assertFalse(registry.add(self.entry('TJ_2', [self.r1])))
+        self.assertEqual(len(registry.entries_within(['R_1', 'R_2'])), 1)
+
+    def test_persistent(self):
+        SQLiteRegistry(self.registry_file_path).add(
+            self.entry('TJ_1', [self.r1]))
+        registry = SQLiteRegistry(self.registry_file_path)
+        self.assertIsNotNone(registry.find([self.r1], []))
+
+    def test_cache_backend(self):
+        constraint = [[{'attribute': 'A11', 'operation': '=', 'value': 1}]]
+        with patch.dict('pyro.cfg.settings', {'cache_backend': 'sqlite'}):
+            cache = Cache(None, self.registry_file_path)
+            cache.add({'name': 'TJ_1', 'attributes': {'A11': 'Integer'}},
+                      [self.r1, self.r2], constraint)
+            cache = Cache(None, self.registry_file_path)
+            self.assertEqual(cache.full_match([self.r2, self.r1], constraint),
+                             {'name': 'TJ_1',
+                              'attributes': {'A11': 'Integer'}})
+            self.assertIsNone(cache.full_match([self.r1], constraint))
+            cache.enable([self.r1, self.r2, self.r3], constraint)
+        self.assertTrue(cache.enabled)
+        self.assertEqual(cache.relation['name'], 'TJ_1')
+
+
+class TestEvict(DatabaseTestCase):
+    def setUp(self):
+        fd, self.cache_file_path = mkstemp(suffix='.json')
+        os.close(fd)
+        super(TestEvict, self).setUp()
+        self.tj_1 = {'name': 'TJ_1', 'attributes': {'A': Integer}}
+        self.tj_2 = {'name': 'TJ_2', 'attributes': {'A': Integer}}
+        for tj in (self.tj_1, self.tj_2):
+            db.create_table(self.engine, tj)
+            db.insert_rows(self.engine, tj, [{'A': i} for i in range(10)])
+        self.r1 = {'name': 'R_1', 'attributes': {'A': 'Integer'}}
+        self.r2 = {'name': 'R_2', 'attributes': {'A': 'Integer'}}
+
+    def tearDown(self):
+        os.remove(self.cache_file_path)
+        super(TestEvict, self).tearDown()
+
+    def fill(self):
+        cache = Cache(self.engine, self.cache_file_path)
+        cache.add(self.tj_1, [self.r1], [])
+        cache.add(self.tj_2, [self.r2], [])
+        # hit the first one, so the second is the least recently used
+        cache = Cache(self.engine, self.cache_file_path)
+        self.assertEqual(cache.full_match([self.r1], [])['name'], 'TJ_1')
+        return cache
+
+    def check_lru(self):
+        cache = self.fill()
+        with patch('pyro.cache._is_alive', return_value=False):
+            evicted = cache.evict(80)
+        self.assertEqual(evicted, ['TJ_2'])
+        tables = MetaData(self.engine, reflect=True).tables
+        self.assertIn('TJ_1', tables)
+        self.assertNotIn('TJ_2', tables)
+        cache = Cache(self.engine, self.cache_file_path)
+        self.assertIsNone(cache.full_match([self.r2], []))
+        self.assertIsNotNone(cache.full_match([self.r1], []))
+
+    def test_lru(self):
+        self.check_lru()
+
+    def test_lru_sqlite_registry(self):
+        with patch.dict('pyro.cfg.settings', {'cache_backend': 'sqlite'}):
+            os.remove(self.cache_file_path)
+            self.check_lru()
+
+    def test_usage(self):
+        self.fill()
+        with open(self.cache_file_path) as config_file:
+            usages = [e['usage'] for e in json.load(config_file)]
+        self.assertEqual([u['rows'] for u in usages], [10, 10])
+        self.assertEqual([u['size'] for u in usages], [80, 80])
+        self.assertEqual([u['hits'] for u in usages], [1, 0])
+        self.assertEqual([pin['pid'] for pin in usages[0]['pins']],
+                         [os.getpid()])
+
+    def test_pinned(self):
+        cache = self.fill()
+        self.assertEqual(cache.evict(0), [])
+        with patch('pyro.cache._is_alive', return_value=False):
+            self.assertEqual(cache.evict(0, keep=['TJ_2']), ['TJ_1'])
+
+    def check_release(self):
+        cache = Cache(self.engine, self.cache_file_path)
+        # TJ of another process
+        with patch('pyro.cache._new_pin', return_value=dict(
+                _new_pin(), pid=os.getpid() + 1, start=None)):
+            cache.add({'name': 'TJ_3', 'attributes': {'A': Integer}},
+                      [self.r1, self.r2], [])
+        cache.add(self.tj_1, [self.r1], [])
+        cache = Cache(self.engine, self.cache_file_path)
+        cache.enable([self.r1, self.r2], [])
+        self.assertEqual(cache.relation['name'], 'TJ_3')
+        cache.release()
+        # TJ pinned before is kept pinned
+        cache = Cache(self.engine, self.cache_file_path)
+        cache.enable([self.r1], [])
+        self.assertEqual(cache.relation['name'], 'TJ_1')
+        cache.release()
+        with patch('pyro.cache._is_alive',
+                   side_effect=lambda pin: pin['pid'] == os.getpid()):
+            self.assertEqual(cache.evict(0), ['TJ_3'])
+
+    def test_release(self):
+        db.create_table(self.engine, {'name': 'TJ_3',
+                                      'attributes': {'A': Integer}})
+        self.check_release()
+
+    def test_release_sqlite_registry(self):
+        db.create_table(self.engine, {'name': 'TJ_3',
+                                      'attributes': {'A': Integer}})
+        with patch.dict('pyro.cfg.settings', {'cache_backend': 'sqlite'}):
+            os.remove(self.cache_file_path)
+            self.check_release()
+
+
+class TestIsAlive(TestCase):
+    def test_current_process(self):
+        self.assertTrue(_is_alive(_new_pin()))
+
+    @skipIf(_new_pin()['start'] is None, 'process start time is unknown')
+    def test_reused_pid(self):
+        pin = _new_pin()
+        self.assertFalse(_is_alive(dict(pin, start=pin['start'] - 1)))
+
+    def test_other_host(self):
+        pin = dict(_new_pin(), host=_new_pin()['host'] + '.other')
+        self.assertTrue(_is_alive(pin))
+        with patch.dict('pyro.cfg.settings', {'cache_pin_timeout': 60}):
+            self.assertFalse(_is_alive(dict(pin, time=pin['time'] - 61)))
@@ -1,7 +1,8 @@
 from unittest import TestCase
 
 from pyro.constraints.operations import project, is_domain_included, \
-    _is_predicate_domain_included, equal, _conjunction_clauses_equal
+    _is_predicate_domain_included, equal, _conjunction_clauses_equal, \
+    normalize, fingerprint
 
 
 class TestProject(TestCase):
@@ -260,3 +261,43 @@ class TestEqual(TestCase):
 
         self.assertTrue(equal(c1, c2))
         self.assertTrue(equal(c2, c1))
+
+
+class TestNormalize(TestCase):
+    def test_order_and_duplicates(self):
+        c1 = [[{'attribute': 'A2', 'operation': 'in', 'value': [3, 1, 3]},
+               {'attribute': 'A1', 'operation': '=', 'value': 3.0}],
+              [{'attribute': 'A3', 'operation': 'NOT  LIKE', 'value': 'a%'}],
+              [{'attribute': 'A1', 'operation': '=', 'value': 3},
+               {'attribute': 'A2', 'operation': 'IN', 'value': [1, 3]}]]
+        self.assertEqual(normalize(c1), [
+            [{'attribute': 'A1', 'operation': '=', 'value': 3},
+             {'attribute': 'A2', 'operation': 'IN', 'value': [1, 3]}],
+            [{'attribute': 'A3', 'operation': 'NOT LIKE', 'value': 'a%'}]])
+
+    def test_between_order_kept(self):
+        c = [[{'attribute': 'A1', 'operation': 'BETWEEN', 'value': [5, 1]}]]
+        self.assertEqual(normalize(c)[0][0]['value'], [5, 1])
+
+    def test_empty(self):
+        self.assertEqual(normalize([]), [])
+
+
+class TestFingerprint(TestCase):
+    def test_equal_constraints(self):
+        c1 = [[{'operation': '=', 'attribute': 'A3', 'value': 3},
+               {'value': [1, 5, 12], 'attribute': 'A1', 'operation': 'IN'}],
+              [{'attribute': 'A2', 'operation': '>', 'value': 1}]]
+        c2 = [[{'attribute': 'A2', 'operation': '>', 'value': 1}],
+              [{'attribute': 'A1', 'operation': 'IN', 'value': [12, 1, 5]},
+               {'attribute': 'A3', 'operation': '=', 'value': 3}]]
+        self.assertEqual(fingerprint(c1), fingerprint(c2))
+
+    def test_different_constraints(self):
+        c1 = [[{'attribute': 'A1', 'operation': '=', 'value': 3}]]
+        c2 = [[{'attribute': 'A1', 'operation': '=', 'value': '3'}]]
+        c3 = [[{'attribute': 'A1', 'operation': '=', 'value': 3}],
+              [{'attribute': 'A2', 'operation': '=', 'value': 3}]]
+        self.assertNotEqual(fingerprint(c1), fingerprint(c2))
+        self.assertNotEqual(fingerprint(c1), fingerprint(c3))
+        self.assertNotEqual(fingerprint(c1), fingerprint([]))
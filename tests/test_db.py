@@ -1,12 +1,16 @@
+from unittest import TestCase
+from unittest.mock import patch
+
 from sqlalchemy import MetaData, Integer, String, Column, Table, ForeignKey
 from sqlalchemy.dialects.mysql import REAL
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import InternalError
 from sqlalchemy.sql.sqltypes import _Binary, LargeBinary, Float
 
 from pyro import db
 from pyro.db import create_table, _transform_column_type, _execute, \
     get_rows, delete_rows, insert_rows, get_data, delete_unsatisfied, \
-    insert_from_select
+    insert_from_select, delete_matching, drop_table
 from tests.alchemy import DatabaseTestCase
 
 
@@ -61,6 +65,18 @@ class TestCreateTable(DatabaseTestCase):
         metadata.reflect()
         self.assertEqual(len(metadata.tables), 1)
 
+    def test_indexes(self):
+        relation = {'name': 'test_table', 'attributes': {'first': Integer,
+                                                         'second': String(10)}}
+
+        create_table(self.engine, relation, ['first'])
+
+        metadata = MetaData(self.engine, reflect=True)
+        indexes = metadata.tables['test_table'].indexes
+        self.assertEqual(len(indexes), 1)
+        self.assertEqual([c.name for c in next(iter(indexes)).columns],
+                         ['first'])
+
     def test_different_attributes(self):
         metadata = MetaData(self.engine, reflect=True)
         relation = {'name': 'test_table', 'attributes': {'first': Integer,
@@ -76,6 +92,65 @@ class TestCreateTable(DatabaseTestCase):
         self.assertEqual(len(metadata.tables), 1)
 
 
+class TestDropTable(DatabaseTestCase):
+    def test_existing_table(self):
+        relation = {'name': 'test_table', 'attributes': {'first': Integer}}
+        create_table(self.engine, relation)
+
+        drop_table(self.engine, relation)
+
+        metadata = MetaData(self.engine, reflect=True)
+        self.assertEqual(len(metadata.tables), 0)
+
+    def test_non_existing_table(self):
+        drop_table(self.engine, {'name': 'test_table'})
+
+        metadata = MetaData(self.engine, reflect=True)
+        self.assertEqual(len(metadata.tables), 0)
+
+
+class TestMetadataRegistry(DatabaseTestCase):
+    def test_reflected_once(self):
+        relation = {'name': 'test_table', 'attributes': {'first': Integer}}
+        create_table(self.engine, relation)
+
+        with patch.object(MetaData, 'reflect', autospec=True,
+                          side_effect=MetaData.reflect) as mock_reflect:
+            insert_rows(self.engine, relation, [{'first': 1}])
+            insert_rows(self.engine, relation, [{'first': 2}])
+            get_rows(self.engine, relation)
+
+        self.assertEqual(mock_reflect.call_count, 1)
+
+    def test_recreated_table(self):
+        relation = {'name': 'test_table', 'attributes': {'first': Integer,
+                                                         'second': Integer}}
+        create_table(self.engine, relation)
+        insert_rows(self.engine, relation, [{'first': 1, 'second': 2}])
+        relation['attributes'].pop('second')
+        create_table(self.engine, relation)
+
+        insert_rows(self.engine, relation, [{'first': 1}])
+
+        self.assertEqual(get_rows(self.engine, relation), [{'first': 1}])
+
+    def test_invalidate(self):
+        relation = {'name': 'test_table', 'attributes': {'first': Integer}}
+        create_table(self.engine, relation)
+        insert_rows(self.engine, relation, [{'first': 1}])
+        metadata = MetaData(self.engine)
+        metadata.reflect()
+        metadata.tables['test_table'].drop()
+        Table('test_table', MetaData(self.engine),
+              Column('second', Integer)).create()
+
+        db.invalidate_metadata(self.engine)
+        insert_rows(self.engine, {'name': 'test_table'}, [{'second': 2}])
+
+        self.assertEqual(get_data(self.engine, 'test_table', ['second']),
+                         [{'second': 2}])
+
+
 class TestTransformColumnType(DatabaseTestCase):
     def test_handled_types(self):
         integer = Integer()
@@ -316,6 +391,164 @@ class TestJoin(DatabaseTestCase):
         self.assertNotIn({'product_name': 'Bananas',
                           'region_name': 'Texas', 'price': 12.6}, join_result)
 
+    def test_join_clause(self):
+        """
+        Relations should be joined by explicit JOIN clauses having no
+        implied equalities
+        """
+        metadata = MetaData(self.engine, reflect=True)
+        r1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        r2 = Table('R2', metadata, Column('A', Integer, primary_key=True),
+                   Column('C', Integer))
+        r3 = Table('R3', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer), Column('C', Integer))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(r1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2}])
+            conn.execute(r2.insert(), [{'A': 1, 'C': 1}, {'A': 2, 'C': 2}])
+            conn.execute(r3.insert(), [{'A': 1, 'B': 1, 'C': 1},
+                                       {'A': 2, 'B': 1, 'C': 2}])
+        relations = [
+            {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer}},
+            {'name': 'R2', 'attributes': {'A': Integer, 'C': Integer}},
+            {'name': 'R3', 'attributes': {'A': Integer, 'B': Integer,
+                                          'C': Integer}}]
+        attributes = {'A': Integer, 'B': Integer, 'C': Integer}
+        tables = {r['name']: db._get_table(self.engine, r['name'])
+                  for r in relations}
+
+        query = str(db._natural_join_query(tables, relations, attributes))
+        join_result = db.natural_join(self.engine, relations, attributes)
+        with patch.dict('pyro.cfg.settings', {'join_order': 'cardinality'}):
+            self.assertEqual(db.natural_join(self.engine, relations,
+                                             attributes), join_result)
+
+        self.assertEqual(query.count('JOIN'), 2)
+        self.assertEqual(query.count('='), 4)
+        self.assertNotIn('WHERE', query)
+        self.assertEqual(join_result, [{'A': 1, 'B': 1, 'C': 1}])
+
+
+class TestJoinBatches(DatabaseTestCase):
+    def test_batches(self):
+        metadata = MetaData(self.engine, reflect=True)
+        users = Table('users', metadata,
+                      Column('user_id', Integer, primary_key=True),
+                      Column('user_name', String(20)))
+        addresses = Table('addresses', metadata,
+                          Column('address_id', Integer, primary_key=True),
+                          Column('user_id', None, ForeignKey('users.user_id')),
+                          Column('email_address', String(50), nullable=False))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(users.insert(), [{'user_name': 'jack'},
+                                          {'user_name': 'wendy'}])
+            conn.execute(addresses.insert(), [
+                {'user_id': 1, 'email_address': 'jack@yahoo.com'},
+                {'user_id': 1, 'email_address': 'jack@msn.com'},
+                {'user_id': 2, 'email_address': 'www@www.org'},
+            ])
+        relations = [
+            {'name': 'users', 'attributes': {'user_id': Integer,
+                                             'user_name': String}},
+            {'name': 'addresses', 'attributes': {'address_id': Integer,
+                                                 'user_id': Integer,
+                                                 'email_address': String}}]
+        attributes = {'user_name': String, 'email_address': String}
+
+        join_batches = list(db.natural_join_batches(self.engine, relations,
+                                                    attributes, 2))
+
+        self.assertEqual(list(map(len, join_batches)), [2, 1])
+        join_result = db.natural_join(self.engine, relations, attributes)
+        self.assertEqual(join_batches[0] + join_batches[1], join_result)
+
+    def test_pushed_constraint(self):
+        """
+        Only rows the pushed constraint is FALSE for should be skipped
+        """
+        metadata = MetaData(self.engine, reflect=True)
+        users = Table('users', metadata,
+                      Column('user_id', Integer, primary_key=True),
+                      Column('user_name', String(20)))
+        addresses = Table('addresses', metadata,
+                          Column('address_id', Integer, primary_key=True),
+                          Column('user_id', None, ForeignKey('users.user_id')),
+                          Column('email_address', String(50), nullable=False))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(users.insert(), [{'user_name': 'jack'},
+                                          {'user_name': 'wendy'},
+                                          {'user_name': None}])
+            conn.execute(addresses.insert(), [
+                {'user_id': 1, 'email_address': 'jack@yahoo.com'},
+                {'user_id': 2, 'email_address': 'www@www.org'},
+                {'user_id': 3, 'email_address': 'anonymous@www.org'},
+            ])
+        relations = [
+            {'name': 'users', 'attributes': {'user_id': Integer,
+                                             'user_name': String}},
+            {'name': 'addresses', 'attributes': {'address_id': Integer,
+                                                 'user_id': Integer,
+                                                 'email_address': String}}]
+        attributes = {'user_name': String, 'email_address': String}
+        constraint = [[{'attribute': 'user_name', 'operation': '=',
+                        'value': 'jack'}]]
+
+        join_batches = db.natural_join_batches(self.engine, relations,
+                                               attributes,
+                                               pushed_constraint=constraint)
+
+        self.assertEqual(
+            sorted(r['email_address'] for batch in join_batches
+                   for r in batch),
+            ['anonymous@www.org', 'jack@yahoo.com'])
+
+
+class TestServerSideSchema(TestCase):
+    def test_mysql_same_server(self):
+        source = make_url('mysql+pymysql://user@localhost:3306/source')
+        cube = make_url('mysql+pymysql://user@localhost:3306/cube')
+        self.assertEqual(db.server_side_schema(source, cube), 'source')
+
+    def test_mysql_different_servers(self):
+        source = make_url('mysql+pymysql://user@localhost:3306/source')
+        cube = make_url('mysql+pymysql://user@remote:3306/cube')
+        self.assertIsNone(db.server_side_schema(source, cube))
+        with patch.dict('pyro.cfg.settings', {'server_side_join': True}):
+            self.assertEqual(db.server_side_schema(source, cube), 'source')
+
+    def test_different_dialects(self):
+        source = make_url('mysql+pymysql://user@localhost:3306/source')
+        cube = make_url('sqlite:///cube.db')
+        self.assertIsNone(db.server_side_schema(source, cube))
+
+    def test_postgresql(self):
+        source = make_url('postgresql://user@localhost:5432/source')
+        cube = make_url('postgresql://user@localhost:5432/cube')
+        self.assertIsNone(db.server_side_schema(source, cube))
+        with patch.dict('pyro.cfg.settings', {'server_side_join': True}):
+            self.assertIsNone(db.server_side_schema(source, cube))
+
+    def test_sqlite(self):
+        cube = make_url('sqlite://')
+        # attaching source DB file is opt-in
+        self.assertIsNone(db.server_side_schema(make_url('sqlite:///src.db'),
+                                                cube))
+        with patch.dict('pyro.cfg.settings', {'server_side_join': True}):
+            self.assertEqual(
+                db.server_side_schema(make_url('sqlite:///src.db'), cube),
+                db.SQLITE_SOURCE_SCHEMA)
+            self.assertIsNone(db.server_side_schema(make_url('sqlite://'),
+                                                    cube))
+
+    @patch.dict('pyro.cfg.settings', {'server_side_join': False})
+    def test_disabled(self):
+        source = make_url('mysql+pymysql://user@localhost:3306/source')
+        cube = make_url('mysql+pymysql://user@localhost:3306/cube')
+        self.assertIsNone(db.server_side_schema(source, cube))
+
 
 class TestGetData(DatabaseTestCase):
     def test_simple(self):
@@ -765,6 +998,71 @@ class TestDeleteUnsatisfied(DatabaseTestCase):
         self.assertEqual(all_records[2]['user_name'], chris['user_name'])
 
 
+class TestDeleteMatching(DatabaseTestCase):
+    def setUp(self):
+        super(TestDeleteMatching, self).setUp()
+        metadata = MetaData(self.engine)
+        self.target = Table('target', metadata,
+                            Column('A', Integer),
+                            Column('B', Integer),
+                            Column('g', String(10)))
+        self.other = Table('other', metadata,
+                           Column('A', Integer),
+                           Column('B', Integer),
+                           Column('g', String(10)))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(self.target.insert(), [
+                {'A': 1, 'B': 2, 'g': 'x'},
+                {'A': 1, 'B': None, 'g': 'x'},
+                {'A': 2, 'B': 2, 'g': 'x'},
+                {'A': 1, 'B': 2, 'g': 'y'},
+            ])
+            conn.execute(self.other.insert(), [
+                {'A': 1, 'B': 2, 'g': 'z'},
+                {'A': 1, 'B': None, 'g': 'z'},
+            ])
+
+    def test_null_values(self):
+        delete_matching(self.engine, {'name': 'target'}, {'name': 'other'},
+                        ['A', 'B'])
+
+        with self.engine.connect() as conn:
+            all_records = conn.execute(self.target.select()).fetchall()
+        self.assertEqual(len(all_records), 1)
+        self.assertEqual(all_records[0]['A'], 2)
+
+    def test_some_attributes(self):
+        delete_matching(self.engine, {'name': 'target'}, {'name': 'other'},
+                        ['B'])
+
+        with self.engine.connect() as conn:
+            all_records = conn.execute(self.target.select()).fetchall()
+        self.assertEqual(len(all_records), 0)
+
+    def test_with_filter(self):
+        filter_c = [[{'attribute': 'g', 'operation': '=', 'value': 'y'}]]
+
+        delete_matching(self.engine, {'name': 'target'}, {'name': 'other'},
+                        ['A', 'B'], filter_c)
+
+        with self.engine.connect() as conn:
+            all_records = conn.execute(self.target.select()).fetchall()
+        self.assertEqual(len(all_records), 3)
+        self.assertNotIn('y', [r['g'] for r in all_records])
+
+    def test_other_constraint(self):
+        other_c = [[{'attribute': 'B', 'operation': '=', 'value': 2}]]
+
+        delete_matching(self.engine, {'name': 'target'}, {'name': 'other'},
+                        ['A'], other_constraint=other_c)
+
+        with self.engine.connect() as conn:
+            all_records = conn.execute(self.target.select()).fetchall()
+        # both rows having A = 1 match the other row having B = 2
+        self.assertEqual([r['A'] for r in all_records], [2])
+
+
 class TestInsertRows(DatabaseTestCase):
     def test_empty(self):
         """
@@ -827,6 +1125,25 @@ class TestInsertRows(DatabaseTestCase):
         for row in rows:
             self.assertIn(row['user_name'], usernames)
 
+    @patch.dict('pyro.cfg.settings', {'row_insert_chunk_size': 2})
+    def test_generator_in_chunks(self):
+        metadata = MetaData(self.engine, reflect=True)
+        users = Table('users', metadata,
+                      Column('user_id', Integer, primary_key=True),
+                      Column('user_name', String(20)))
+        metadata.create_all()
+        rows = ({'user_name': 'user_{}'.format(i)} for i in range(5))
+
+        with patch('pyro.db._execute', wraps=_execute) as mock_execute:
+            insert_rows(self.engine, {'name': users.name,
+                                      'attributes': users.c._data},
+                        rows)
+
+        self.assertEqual(mock_execute.call_count, 3)
+        with self.engine.connect() as conn:
+            all_records = conn.execute(users.select()).fetchall()
+        self.assertEqual(len(all_records), 5)
+
 
 class TestInsertFromSelect(DatabaseTestCase):
     def test_no_constraints(self):
@@ -1022,6 +1339,60 @@ class TestInsertFromSelect(DatabaseTestCase):
         self.assertEqual(second_row['user_name'], 'wendy')
         self.assertEqual(second_row['user_birth_city'], None)
 
+    def test_mapping(self):
+        metadata = MetaData(self.engine, reflect=True)
+        users_1 = Table('users', metadata,
+                        Column('user_id', Integer, primary_key=True),
+                        Column('user_name', String(20)))
+        users_2 = Table('users_backup', metadata,
+                        Column('user_id', Integer, primary_key=True),
+                        Column('user_name', String(20)))
+        metadata.create_all()
+
+        # populate with data
+        with self.engine.connect() as conn:
+            conn.execute(users_1.insert(), [
+                {'user_name': 'jack'},
+                {'user_name': 'wendy'},
+                {'user_name': 'mary'}
+            ])
+
+        insert_from_select(self.engine,
+                           {'name': users_2.name,
+                            'attributes': users_2.c._data},
+                           {'name': users_1.name,
+                            'attributes': users_1.c._data},
+                           [[{'attribute': 'user_id', 'operation': 'IN',
+                              'value': [1, 2]}]],
+                           mapping={'user_name': {'jack': 'john'}})
+
+        with self.engine.connect() as conn:
+            res = conn.execute(users_2.select().order_by(users_2.c.user_id))
+            all_records = res.fetchall()
+        self.assertEqual([tuple(r) for r in all_records],
+                         [(1, 'john'), (2, 'wendy')])
+
+    def test_keep_unknown(self):
+        metadata = MetaData(self.engine, reflect=True)
+        source = Table('source', metadata, Column('A', Integer),
+                       Column('B', Integer))
+        dest = Table('dest', metadata, Column('A', Integer),
+                     Column('B', Integer))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(source.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                           {'A': 3, 'B': None}])
+        constraint = [[{'attribute': 'B', 'operation': '<', 'value': 2}]]
+
+        insert_from_select(self.engine,
+                           {'name': 'dest', 'attributes': dest.c._data},
+                           {'name': 'source', 'attributes': source.c._data},
+                           constraint, keep_unknown=True)
+
+        with self.engine.connect() as conn:
+            all_records = conn.execute(dest.select()).fetchall()
+        self.assertEqual(sorted(r['A'] for r in all_records), [1, 3])
+
 
 class TestCountAttributes(DatabaseTestCase):
     def test_single_attribute(self):
@@ -1291,3 +1662,25 @@ class TestProject(DatabaseTestCase):
                                          'user_fullname': None})
         self.assertEqual(projection[3], {'user_name': 'wendy3',
                                          'user_fullname': 'Wendy Williams'})
+
+
+class TestTableSize(DatabaseTestCase):
+    def test_actual_string_length(self):
+        metadata = MetaData(self.engine)
+        tj = Table('TJ', metadata,
+                   Column('A', Integer),
+                   Column('g', String(10000)))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(tj.insert(), [{'A': 1, 'g': 'abc'},
+                                       {'A': 2, 'g': None}])
+
+        self.assertEqual(db.table_size(self.engine, {'name': 'TJ'}),
+                         (2, 19))
+
+    def test_empty(self):
+        metadata = MetaData(self.engine)
+        Table('TJ', metadata, Column('g', String(10)))
+        metadata.create_all()
+
+        self.assertEqual(db.table_size(self.engine, {'name': 'TJ'}), (0, 0))
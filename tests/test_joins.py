@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from pyro.joins import join_order, join_equalities, hash_join
+
+
+class TestJoinOrder(TestCase):
+    def setUp(self):
+        self.r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        self.r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        self.r3 = {'name': 'R3', 'attributes': {'C': 'INT', 'D': 'INT'}}
+        self.r4 = {'name': 'R4', 'attributes': {'E': 'INT'}}
+
+    def test_existing_join(self):
+        self.assertEqual(join_order([self.r1, self.r3, self.r2]),
+                         [self.r1, self.r2, self.r3])
+        self.assertEqual(join_order([self.r1]), [self.r1])
+
+    def test_disconnected(self):
+        self.assertEqual(join_order([self.r4, self.r1, self.r2]),
+                         [self.r4, self.r1, self.r2])
+
+    def test_cardinalities(self):
+        cardinalities = {'R1': 100, 'R2': 10, 'R3': 1, 'R4': 50}
+
+        self.assertEqual(
+            join_order([self.r1, self.r2, self.r3, self.r4], cardinalities),
+            [self.r3, self.r2, self.r1, self.r4])
+
+
+class TestJoinEqualities(TestCase):
+    def test_implied_equalities(self):
+        relations = [
+            {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}},
+            {'name': 'R2', 'attributes': {'A': 'INT', 'C': 'INT'}},
+            {'name': 'R3', 'attributes': {'A': 'INT', 'B': 'INT',
+                                          'C': 'INT'}}]
+
+        self.assertEqual(join_equalities(relations),
+                         [[], [('A', 0)], [('A', 0), ('B', 0), ('C', 1)]])
+
+
+class TestHashJoin(TestCase):
+    def test_hash_join(self):
+        build_rows = [{'A': 1, 'B': 1}, {'A': 2, 'B': 1}, {'A': 3, 'B': None}]
+        probe_rows = iter([{'B': 1, 'C': 10}, {'B': 2, 'C': 20},
+                           {'B': None, 'C': 30}])
+
+        rows = list(hash_join(build_rows, probe_rows, ['B']))
+
+        self.assertEqual(rows, [{'A': 1, 'B': 1, 'C': 10},
+                                {'A': 2, 'B': 1, 'C': 10}])
+
+    def test_attributes(self):
+        rows = hash_join([{'A': 1, 'B': 1}], [{'B': 1, 'C': 10}], ['B'],
+                         {'A', 'C'})
+
+        self.assertEqual(list(rows), [{'A': 1, 'C': 10}])
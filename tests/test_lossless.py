@@ -1,6 +1,10 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from unittest.mock import patch
 
-from pyro.lossless import _build_tableau, is_lossless
+from pyro import lossless
+from pyro.lossless import build_tableau, is_lossless, extend_tableau, \
+    chase_combinations, _build_matrix, chase_matrix, chase, held_dependencies
+from pyro.utils import all_attributes
 
 
 class TestBuildTableau(TestCase):
@@ -13,7 +17,7 @@ class TestBuildTableau(TestCase):
                                            'D': 'INT'}}
         r2 = {'name': 'R2', 'attributes': {'A': 'INT', 'B': 'INT', 'C': 'INT',
                                            'D': 'INT'}}
-        tableau = _build_tableau([r1, r2])
+        tableau = build_tableau([r1, r2])
         # all values of this table should be equal to the keys as all
         # attributes are present in both tables
         for row in tableau:
@@ -27,7 +31,7 @@ class TestBuildTableau(TestCase):
         """
         r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
         r2 = {'name': 'R2', 'attributes': {'C': 'INT', 'D': 'INT'}}
-        tableau = _build_tableau([r1, r2])
+        tableau = build_tableau([r1, r2])
         self.assertEqual(tableau[0]['A'], ('A',))
         self.assertEqual(tableau[0]['B'], ('B',))
         self.assertEqual(tableau[0]['C'], ('C', 'R1'))
@@ -43,7 +47,7 @@ class TestBuildTableau(TestCase):
         """
         r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT', 'C': 'INT'}}
         r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT', 'D': 'INT'}}
-        tableau = _build_tableau([r1, r2])
+        tableau = build_tableau([r1, r2])
         self.assertEqual(tableau[0]['A'], ('A',))
         self.assertEqual(tableau[0]['B'], ('B',))
         self.assertEqual(tableau[0]['C'], ('C',))
@@ -129,3 +133,141 @@ class TestIsLossless(TestCase):
             {'left': ('B', 'D'), 'right': ('E',)},  # R2 primary key
         ]
         self.assertFalse(is_lossless([r1, r2], deps))
+
+
+class TestExtendTableau(TestCase):
+    def test_same_as_built(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        tableau = extend_tableau(build_tableau([r1]), r2)
+        self.assertEqual(tableau[0]['A'], ('A',))
+        self.assertEqual(tableau[0]['B'], ('B',))
+        self.assertEqual(tableau[0]['C'], ('C', '#0'))
+        self.assertEqual(tableau[1]['A'], ('A', 'R2'))
+        self.assertEqual(tableau[1]['B'], ('B',))
+        self.assertEqual(tableau[1]['C'], ('C',))
+
+    def test_original_intact(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        tableau = build_tableau([r1])
+        extend_tableau(tableau, r2)
+        self.assertEqual(tableau, [{'A': ('A',), 'B': ('B',)}])
+
+
+class TestChaseCombinations(TestCase):
+    def test_same_as_is_lossless(self):
+        """
+        Check that incremental chase gives the same results as checking every
+        combination from scratch
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'D': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'A': 'INT', 'C': 'INT'}}
+        r3 = {'name': 'R3', 'attributes': {'B': 'INT', 'C': 'INT', 'D': 'INT'}}
+        r4 = {'name': 'R4', 'attributes': {'B': 'INT', 'E': 'INT'}}
+        deps = [
+            {'left': {'A'}, 'right': {'B'}},
+            {'left': {'B'}, 'right': {'C', 'E'}},
+            {'left': {'C', 'D'}, 'right': {'A'}},
+        ]
+        results = list(chase_combinations([r1], [r2, r3, r4], deps))
+        self.assertEqual(len(results), 8)
+        for context, lossless in results:
+            satisfied_deps = [
+                d for d in deps
+                if (d['left'] | d['right']).issubset(all_attributes(context))]
+            self.assertEqual(lossless, is_lossless(context, satisfied_deps))
+        self.assertIn(([r1, r2, r3, r4], True), results)
+        self.assertIn(([r1, r4], False), results)
+
+    def test_increasing_size(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        deps = [{'left': {'B'}, 'right': {'C'}}]
+        contexts = [c for c, _ in chase_combinations([], [r1, r2], deps)]
+        self.assertEqual(contexts, [[], [r1], [r2], [r1, r2]])
+
+
+class TestChase(TestCase):
+    def test_symbols_equated(self):
+        """
+        Check that tableau is rewritten with the representatives of equated
+        symbols
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'A': 'INT', 'C': 'INT'}}
+        r3 = {'name': 'R3', 'attributes': {'C': 'INT', 'D': 'INT'}}
+        tableau = build_tableau([r1, r2, r3])
+        deps = [{'left': ('C',), 'right': ('B',)}]
+        self.assertFalse(chase(tableau, deps))
+        self.assertEqual(tableau[1]['B'], tableau[2]['B'])
+        self.assertEqual(tableau[0]['B'], ('B',))
+
+    def test_clear_row_found_during_pass(self):
+        """
+        Check that chase stops as soon as a clear row appears and doesn't
+        apply the rest of dependencies
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        r3 = {'name': 'R3', 'attributes': {'C': 'INT', 'D': 'INT'}}
+        tableau = build_tableau([r1, r2, r3])
+        deps = [{'left': ('B',), 'right': ('C',)},
+                {'left': ('C',), 'right': ('D',)},
+                {'left': ('D',), 'right': ('A',)}]
+        self.assertTrue(chase(tableau, deps))
+        self.assertEqual(tableau[2]['A'], ('A', 'R3'))
+
+    def test_already_clear(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT'}}
+        self.assertTrue(chase(build_tableau([r1]), []))
+
+
+@skipIf(lossless.np is None, 'numpy is not installed')
+class TestChaseMatrix(TestCase):
+    def test_build_matrix(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        attributes, matrix = _build_matrix([r1, r2])
+        self.assertEqual(attributes, ['A', 'B', 'C'])
+        self.assertEqual(matrix[0].tolist()[:2], [0, 0])
+        self.assertEqual(matrix[1].tolist()[1:], [0, 0])
+        self.assertNotEqual(matrix[0, 2], matrix[1, 0])
+        self.assertTrue(matrix[0, 2] > 0 and matrix[1, 0] > 0)
+
+    def test_same_as_dict_tableau(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'D': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'A': 'INT', 'C': 'INT'}}
+        r3 = {'name': 'R3', 'attributes': {'B': 'INT', 'C': 'INT', 'D': 'INT'}}
+        r4 = {'name': 'R4', 'attributes': {'B': 'INT', 'E': 'INT'}}
+        deps = [
+            {'left': {'A'}, 'right': {'B'}},
+            {'left': {'B'}, 'right': {'C', 'E'}},
+            {'left': {'C', 'D'}, 'right': {'A'}},
+        ]
+        for relations in ([r1, r2], [r1, r2, r3], [r1, r2, r3, r4],
+                          [r3, r4], [r1, r4]):
+            held = held_dependencies(relations, deps)
+            attributes, matrix = _build_matrix(relations)
+            self.assertEqual(chase_matrix(matrix, attributes, held),
+                             chase(build_tableau(relations), held))
+
+    def test_chase_engine(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT', 'C': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'C': 'INT', 'D': 'INT'}}
+        deps = [{'left': ('C',), 'right': ('D',)}]
+        with patch('pyro.lossless.chase_matrix') as chase_matrix_mock:
+            self.assertTrue(is_lossless([r1, r2], deps))
+            self.assertFalse(is_lossless([r1, r2], []))
+        chase_matrix_mock.assert_not_called()
+        with patch.dict('pyro.cfg.settings', {'chase_engine': 'matrix'}), \
+                patch('pyro.lossless.chase_matrix',
+                      wraps=chase_matrix) as chase_matrix_mock:
+            self.assertTrue(is_lossless([r1, r2], deps))
+        chase_matrix_mock.assert_called_once()
+
+    def test_numpy_missing(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        with patch.dict('pyro.cfg.settings', {'chase_engine': 'matrix'}), \
+                patch('pyro.lossless.np', None):
+            self.assertRaises(ImportError, is_lossless, [r1], [])
@@ -0,0 +1,63 @@
+from unittest.mock import patch
+
+from sqlalchemy import MetaData, Table, Column, Integer
+
+from pyro import db
+from pyro.memo import SubJoinMemo
+from tests.alchemy import DatabaseTestCase
+
+
+class TestSubJoinMemo(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        metadata = MetaData(self.engine)
+        r1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        r2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        r3 = Table('R3', metadata, Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        with self.engine.connect() as conn:
+            conn.execute(r1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                       {'A': 3, 'B': None}])
+            conn.execute(r2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': 2},
+                                       {'B': 3, 'C': 3}])
+            conn.execute(r3.insert(), [{'C': 1, 'D': 10}, {'C': 2, 'D': 20},
+                                       {'C': 3, 'D': None}])
+        self.relations = [
+            {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer}},
+            {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer}},
+            {'name': 'R3', 'attributes': {'C': Integer, 'D': Integer}}]
+        self.attributes = {'A': Integer, 'B': Integer, 'C': Integer,
+                           'D': Integer}
+
+    def _join(self, memo, relations):
+        return [row for batch in memo.join_batches(relations)
+                for row in batch]
+
+    def test_derived_join(self):
+        memo = SubJoinMemo(self.engine, self.attributes, 100)
+        self._join(memo, self.relations[:2])
+
+        with patch('pyro.memo.db.natural_join_batches',
+                   wraps=db.natural_join_batches) as join_batches:
+            rows = self._join(memo, self.relations)
+
+        # only the relation not joined yet is queried
+        join_batches.assert_called_once()
+        self.assertEqual(join_batches.call_args[0][1], self.relations[2:])
+        expected = db.natural_join(self.engine, self.relations,
+                                   self.attributes)
+        self.assertCountEqual(rows, [dict(row) for row in expected])
+
+    def test_max_rows(self):
+        memo = SubJoinMemo(self.engine, self.attributes, 1)
+        self._join(memo, self.relations[:2])
+
+        with patch('pyro.memo.db.natural_join_batches',
+                   wraps=db.natural_join_batches) as join_batches:
+            self._join(memo, self.relations)
+
+        # join having more rows than the memo can keep isn't memoized
+        self.assertEqual(join_batches.call_args[0][1], self.relations)
@@ -1,7 +1,8 @@
 from unittest import TestCase
 from unittest.mock import patch
 
-from pyro.representation import _get_hierarchy, _to_html, _group_cells
+from pyro.representation import _get_hierarchy, _to_html, _group_cells, \
+    _build
 
 
 class TestGetHierarchy(TestCase):
@@ -47,6 +48,34 @@ class TestGetHierarchy(TestCase):
         self.assertEqual(hierarchy, ('A1', 'A4', 'A5'))
 
 
+class TestBuild(TestCase):
+    @patch('pyro.representation.db')
+    def test_body(self, mock_db):
+        """
+        Check that measure values are placed into the correct cells
+        """
+        mock_db.count_attributes.return_value = [2]
+        mock_db.project.side_effect = [
+            [{'Y': 'y1'}, {'Y': 'y2'}],
+            [{'X': 'x1'}, {'X': None}],
+        ]
+        mock_db.get_data.return_value = [
+            {'X': 'x1', 'Y': 'y1', 'M': 1},
+            {'X': 'x1', 'Y': 'y1', 'M': 2},
+            {'X': None, 'Y': 'y2', 'M': 3},
+            {'X': 'x3', 'Y': 'y2', 'M': 4},
+        ]
+
+        table = list(_build(None, ['TJ_y', 'TJ_x', 'TJ_z'], [['Y'], ['X']],
+                            'M'))
+
+        self.assertEqual(mock_db.get_data.call_count, 1)
+        self.assertEqual(table, [('', 'Y', 'y1', 'y2'),
+                                 ('X', '', 'M', 'M'),
+                                 ('x1', '', (1, 2), ()),
+                                 (None, '', (), (3,))])
+
+
 class TestGroupCells(TestCase):
     def test_general(self):
         table = [[None, 'value_11', 'value_12', (1, 2, 3, 4)],
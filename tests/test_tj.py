@@ -1,9 +1,13 @@
+import json
 import os
+from tempfile import TemporaryDirectory, mkstemp
 from unittest import TestCase
+from unittest.mock import patch
 
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import MetaData
+from sqlalchemy import String
 from sqlalchemy import Table
 from sqlalchemy import create_engine
 
@@ -32,6 +36,32 @@ class TestVectorSerialization(TestCase):
             ['users', 'addresses', 'payments', 'pictures'])
 
 
+class TestBitmapSerialization(TestCase):
+    def test_encode_bitmap(self):
+        vector_relations = ['R_1', 'R_2', 'R_3']
+        r1 = {'name': 'R_1', 'attributes': {'A_1': 'INT'}}
+        r3 = {'name': 'R_3', 'attributes': {'A_3': 'INT'}}
+        self.assertEqual(pyro.tj.encode_bitmap([r1], vector_relations), 1)
+        self.assertEqual(pyro.tj.encode_bitmap([r3], vector_relations), 4)
+        self.assertEqual(pyro.tj.encode_bitmap([r3, r1], vector_relations),
+                         5)
+
+    def test_decode_bitmap(self):
+        vector_relations = ['R_1', 'R_2', 'R_3']
+        self.assertEqual(pyro.tj.decode_bitmap(6, vector_relations),
+                         ['R_2', 'R_3'])
+        self.assertEqual(pyro.tj.decode_bitmap(0, vector_relations), [])
+
+    def test_vector_value(self):
+        r1 = {'name': 'R_1', 'attributes': {'A_1': 'INT'}}
+        tj = {'name': 'TJ', 'attributes': {},
+              'vector_relations': ['R_0', 'R_1']}
+        self.assertEqual(pyro.tj.vector_value(tj, [r1]), 2)
+        del tj['vector_relations']
+        self.assertEqual(pyro.tj.vector_value(tj, [r1]),
+                         pyro.tj.encode_vector([r1]))
+
+
 class TestIsVectorLess(TestCase):
     def test(self):
         pyro.tj.VECTOR_SEPARATOR = ';'
@@ -65,6 +95,12 @@ class TestIsVectorLess(TestCase):
             {'g': '[A_1,A_2];[A_3,A_4];[A_4,A_5,A_6]'},
             {'g': '[A_1,A_2];[A_3,A_4]'}))
 
+    def test_bitmap(self):
+        self.assertTrue(pyro.tj.is_vector_less({'g': 0b101}, {'g': 0b101}))
+        self.assertTrue(pyro.tj.is_vector_less({'g': 0b100}, {'g': 0b101}))
+        self.assertFalse(pyro.tj.is_vector_less({'g': 0b010}, {'g': 0b101}))
+        self.assertFalse(pyro.tj.is_vector_less({'g': 0b111}, {'g': 0b101}))
+
 
 class TestIsSubordinate(TestCase):
     def test_same_relation_set_one_relation(self):
@@ -138,6 +174,31 @@ class TestIsSubordinate(TestCase):
              'g': '[A_1,A_2]'},
             {'A_1': 'a', 'A_2': 'b', 'A_3': 'c', 'g': '[A_1,A_2],[A_2,A_3]'}))
 
+    def test_bitmap_vectors(self):
+        r1 = {'name': 'R_1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R_2', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        vectors = {0b01: [r1], 0b10: [r2], 0b11: [r1, r2]}
+        self.assertTrue(pyro.tj.is_subordinate(
+            {'A': 1, 'B': 2, 'C': None, 'g': 0b01},
+            {'A': 1, 'B': 2, 'C': 3, 'g': 0b11}, vectors))
+        # B is NULL in R_1 rather than empty
+        self.assertFalse(pyro.tj.is_subordinate(
+            {'A': 1, 'B': None, 'C': None, 'g': 0b01},
+            {'A': 1, 'B': 2, 'C': 3, 'g': 0b11}, vectors))
+        self.assertTrue(pyro.tj.is_subordinate(
+            {'A': None, 'B': 2, 'C': 3, 'g': 0b10},
+            {'A': 1, 'B': 2, 'C': 3, 'g': 0b11}, vectors))
+        self.assertRaises(ValueError, pyro.tj.is_subordinate,
+                          {'A': 1, 'B': None, 'C': None, 'g': 0b01},
+                          {'A': 1, 'B': 2, 'C': 3, 'g': 0b11})
+
+        tj_data = [{'A': 1, 'B': 2, 'C': None, 'g': 0b01},
+                   {'A': 1, 'B': None, 'C': None, 'g': 0b01}]
+        new_data = [{'A': 1, 'B': 2, 'C': 3, 'g': 0b11}]
+        self.assertEqual(
+            list(pyro.tj.filter_subordinate_rows(tj_data, new_data, vectors)),
+            list(pyro.tj.find_subordinate_rows(tj_data, new_data, vectors)))
+
 
 class TestFilterSubordinateRows(TestCase):
     def test(self):
@@ -156,6 +217,123 @@ class TestFilterSubordinateRows(TestCase):
         self.assertRaises(StopIteration)
 
 
+class TestFindSubordinateRows(TestCase):
+    def setUp(self):
+        self.r1 = {'name': 'R_1', 'attributes': {'A_1': 'INT', 'A_2': 'INT'}}
+        self.r2 = {'name': 'R_2', 'attributes': {'A_2': 'INT', 'A_3': 'INT'}}
+        self.vector_1 = pyro.tj.encode_vector([self.r1])
+        self.vector_2 = pyro.tj.encode_vector([self.r2])
+        self.vector_12 = pyro.tj.encode_vector([self.r1, self.r2])
+        self.vectors = {self.vector_1: [self.r1], self.vector_2: [self.r2],
+                        self.vector_12: [self.r1, self.r2]}
+
+    def test(self):
+        base_row_1 = {'A_1': 'a', 'A_2': 'b', 'A_3': None, 'g': self.vector_1}
+        base_row_2 = {'A_1': 'a', 'A_2': None, 'A_3': None,
+                      'g': self.vector_1}
+        base_row_3 = {'A_1': None, 'A_2': 'b', 'A_3': None,
+                      'g': self.vector_1}
+        base_row_4 = {'A_1': None, 'A_2': 'b', 'A_3': 'c', 'g': self.vector_2}
+        tj_data = [base_row_1, base_row_2, base_row_3, base_row_4]
+        new_data = [
+            {'A_1': 'a', 'A_2': 'b', 'A_3': 'c', 'g': self.vector_12},
+            {'A_1': 'a', 'A_2': None, 'A_3': 'c', 'g': self.vector_12}]
+
+        rows_to_delete = list(pyro.tj.find_subordinate_rows(tj_data, new_data,
+                                                            self.vectors))
+
+        self.assertEqual(len(rows_to_delete), 3)
+        self.assertIn(base_row_1, rows_to_delete)
+        self.assertIn(base_row_2, rows_to_delete)
+        self.assertIn(base_row_4, rows_to_delete)
+
+    def test_not_contained_vector(self):
+        tj_data = [{'A_1': 'a', 'A_2': 'b', 'A_3': 'c', 'g': self.vector_12}]
+        new_data = [{'A_1': None, 'A_2': 'b', 'A_3': 'c', 'g': self.vector_2}]
+
+        rows_to_delete = pyro.tj.find_subordinate_rows(tj_data, new_data,
+                                                       self.vectors)
+
+        self.assertEqual(list(rows_to_delete), [])
+
+    def test_same_as_reference(self):
+        tj_data = [{'A_1': a_1, 'A_2': a_2, 'A_3': None, 'g': self.vector_1}
+                   for a_1 in (None, 1, 2) for a_2 in (None, 1, 2)]
+        tj_data += [{'A_1': None, 'A_2': a_2, 'A_3': a_3, 'g': self.vector_2}
+                    for a_2 in (None, 1, 2) for a_3 in (None, 1, 2)]
+        new_data = [{'A_1': a_1, 'A_2': a_2, 'A_3': a_3, 'g': self.vector_12}
+                    for a_1 in (None, 1) for a_2 in (1, 2) for a_3 in (2,)]
+
+        expected = pyro.tj.filter_subordinate_rows(tj_data, new_data)
+        rows_to_delete = pyro.tj.find_subordinate_rows(tj_data, new_data,
+                                                       self.vectors)
+
+        self.assertEqual(sorted(map(str, rows_to_delete)),
+                         sorted(set(map(str, expected))))
+
+    def test_bitmap(self):
+        vectors = {1: [self.r1], 2: [self.r2], 3: [self.r1, self.r2]}
+        base_row_1 = {'A_1': 'a', 'A_2': 'b', 'A_3': None, 'g': 1}
+        base_row_2 = {'A_1': None, 'A_2': 'b', 'A_3': 'd', 'g': 2}
+        new_row_1 = {'A_1': 'a', 'A_2': 'b', 'A_3': 'c', 'g': 3}
+        new_row_2 = {'A_1': 'a', 'A_2': 'b', 'A_3': 'c', 'g': 2}
+
+        rows_to_delete = pyro.tj.find_subordinate_rows(
+            [base_row_1, base_row_2, new_row_2], [new_row_1], vectors)
+
+        self.assertEqual(list(rows_to_delete), [base_row_1, new_row_2])
+
+
+class TestSubordinationEngine(TestCase):
+    def setUp(self):
+        self.cube = create_engine('sqlite://')
+
+    def test_default(self):
+        with patch.dict('pyro.cfg.settings', clear=True):
+            self.assertEqual(pyro.tj.subordination_engine(self.cube),
+                             'python')
+
+    def test_single_engine(self):
+        with patch.dict('pyro.cfg.settings', {'subordination_engine': 'sql'}):
+            self.assertEqual(pyro.tj.subordination_engine(self.cube), 'sql')
+
+    def test_per_dialect(self):
+        setting = {'subordination_engine': {'mysql': 'sql'}}
+        with patch.dict('pyro.cfg.settings', setting):
+            self.assertEqual(pyro.tj.subordination_engine(self.cube),
+                             'python')
+        setting = {'subordination_engine': {'sqlite': 'sql'}}
+        with patch.dict('pyro.cfg.settings', setting):
+            self.assertEqual(pyro.tj.subordination_engine(self.cube), 'sql')
+
+
+class TestGetAttributes(TestCase):
+    def test_all_attributes(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT'},
+              'pk': {'B'}}
+        self.assertEqual(pyro.tj.get_attributes([r1, r2], []),
+                         {'A': 'INT', 'B': 'INT', 'C': 'INT'})
+
+    def test_required_attributes(self):
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT',
+                                           'Blob': 'TEXT'},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': 'INT', 'C': 'INT',
+                                           'Text': 'TEXT'},
+              'pk': {'C'}}
+        r3 = {'name': 'R3', 'attributes': {'D': 'INT', 'E': 'INT'},
+              'pk': set()}
+        # keys, common attributes and required ones are kept
+        self.assertEqual(pyro.tj.get_attributes([r1, r2], [], {'Text'}),
+                         {'A': 'INT', 'B': 'INT', 'C': 'INT',
+                          'Text': 'TEXT'})
+        # relation without key keeps all its attributes
+        self.assertEqual(pyro.tj.get_attributes([r1, r3], [], set()),
+                         {'A': 'INT', 'D': 'INT', 'E': 'INT'})
+
+
 class TestBuild(DatabaseTestCase):
     def setUp(self):
         self.cache_file_path = 'cache.json'
@@ -393,3 +571,922 @@ class TestBuild(DatabaseTestCase):
         self.assertEqual(len(all_records), 3)
         self.assertIn("['A', 'B', 'C'],['C', 'D']",  # R1 & R2 vector
                       map(lambda r: r['g'], all_records))
+
+    def test_sql_subordination_engine(self):
+        """
+        Subordinate rows deleted inside the cube DB should give the same TJ as
+        the Python engine
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'C': Integer},
+              'pk': {'A', 'B'}}
+        r2 = {'name': 'R2', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        constraint = [[{'attribute': 'D', 'operation': '>', 'value': 40}]]
+        dependencies = [{'left': {'C'}, 'right': {'D'}}]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t2 = Table('R2', metadata,
+                   Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        # populate with data
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [
+                {'A': 1, 'B': 2, 'C': 3},
+                {'A': 1, 'B': 22, 'C': None},
+                {'A': 2, 'B': 2, 'C': 33}
+            ])
+            conn.execute(t2.insert(), [
+                {'C': 3, 'D': 4},
+                {'C': 33, 'D': 44},
+                {'C': 333, 'D': 444}
+            ])
+
+        with patch.dict('pyro.cfg.settings', {'subordination_engine': 'python',
+                                              'server_side_join': False}), \
+                patch('pyro.tj._pop_subordinate_rows',
+                      wraps=pyro.tj._pop_subordinate_rows) as mock_pop:
+            tj_1 = pyro.tj.build([r1, r2], dependencies, constraint, source,
+                                 cube, self.cache_file_path)
+        # subordinate rows are found the way `find_subordinate_rows` does
+        self.assertTrue(mock_pop.called)
+        os.remove(self.cache_file_path)  # clear cache file
+        with patch.dict('pyro.cfg.settings', {'subordination_engine': 'sql',
+                                              'server_side_join': False}):
+            tj_2 = pyro.tj.build([r1, r2], dependencies, constraint, source,
+                                 cube, self.cache_file_path)
+
+        metadata = MetaData(cube, reflect=True)
+        results = []
+        with cube.connect() as conn:
+            for tj in (tj_1, tj_2):
+                s = metadata.tables[tj['name']].select()
+                records = conn.execute(s).fetchall()
+                results.append(sorted(map(dict, records),
+                                      key=lambda r: str(sorted(r.items()))))
+
+        self.assertEqual(len(results[0]), 3)
+        self.assertEqual(results[0], results[1])
+        # staging tables are dropped
+        self.assertEqual(len(metadata.tables), 2)
+
+    def test_python_merge_max_rows(self):
+        """
+        Python engine should merge rows by SQL when there are too many TJ
+        rows to compare with, giving the same TJ
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}}]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata,
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': None},
+                                       {'A': 3, 'B': 3}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': 2}])
+
+        def rows(tj):
+            return sorted(pyro.db.get_rows(cube, tj),
+                          key=lambda r: str(sorted(r.items())))
+
+        with patch.dict('pyro.cfg.settings', {'server_side_join': False}):
+            tj_1 = pyro.tj.build([r1, r2], dependencies, [], source, cube,
+                                 self.cache_file_path)
+        os.remove(self.cache_file_path)  # clear cache file
+        with patch.dict('pyro.cfg.settings', {'server_side_join': False,
+                                              'python_merge_max_rows': 0}), \
+                patch('pyro.tj._merge_staging',
+                      wraps=pyro.tj._merge_staging) as mock_merge:
+            tj_2 = pyro.tj.build([r1, r2], dependencies, [], source, cube,
+                                 self.cache_file_path)
+        self.assertTrue(mock_merge.called)
+        self.assertEqual(len(rows(tj_1)), 4)
+        self.assertEqual(rows(tj_1), rows(tj_2))
+        # staging tables are dropped
+        self.assertEqual(set(MetaData(cube, reflect=True).tables),
+                         {tj_1['name'], tj_2['name']})
+
+    @patch.dict('pyro.cfg.settings', {'join_batch_size': 1})
+    def test_join_batches_no_cache(self):
+        """
+        TJ built from the join streamed by single rows should be the same as
+        the one built at once
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'C': Integer},
+              'pk': {'A', 'B'}}
+        r2 = {'name': 'R2', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        constraint = []
+        dependencies = [{'left': {'C'}, 'right': {'D'}}]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t2 = Table('R2', metadata,
+                   Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        # populate with data
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [
+                {'A': 1, 'B': 2, 'C': 3},
+                {'A': 1, 'B': 22, 'C': None},
+                {'A': 2, 'B': 2, 'C': 3}
+            ])
+            conn.execute(t2.insert(), [
+                {'C': 3, 'D': 4},
+                {'C': 33, 'D': 44}
+            ])
+
+        tj = pyro.tj.build([r1, r2], dependencies, constraint, source, cube,
+                           self.cache_file_path)
+
+        metadata = MetaData(cube, reflect=True)
+        with cube.connect() as conn:
+            s = metadata.tables[tj['name']].select()
+            all_records = conn.execute(s).fetchall()
+        self.assertEqual(len(all_records), 4)
+        self.assertEqual(len([r for r in all_records if r['D'] == 4]), 2)
+
+    def test_server_side_join(self):
+        """
+        TJ built by INSERT ... SELECT from the attached source DB should be
+        the same as the one built by transferring rows
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'C': Integer},
+              'pk': {'A', 'B'}}
+        r2 = {'name': 'R2', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        constraint = [[{'attribute': 'D', 'operation': '>', 'value': 40}]]
+        dependencies = [{'left': {'C'}, 'right': {'D'}}]
+        fd, source_path = mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, source_path)
+        source = create_engine('sqlite:///' + source_path)
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t2 = Table('R2', metadata,
+                   Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        # populate with data
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [
+                {'A': 1, 'B': 2, 'C': 3},
+                {'A': 1, 'B': 22, 'C': None},
+                {'A': 2, 'B': 2, 'C': 33}
+            ])
+            conn.execute(t2.insert(), [
+                {'C': 3, 'D': 4},
+                {'C': 33, 'D': 44},
+                {'C': 333, 'D': 444}
+            ])
+
+        with patch.dict('pyro.cfg.settings', {'server_side_join': False}):
+            tj_1 = pyro.tj.build([r1, r2], dependencies, constraint, source,
+                                 cube, self.cache_file_path)
+        os.remove(self.cache_file_path)  # clear cache file
+        with patch('pyro.db.natural_join_batches') as mock_join, \
+                patch.dict('pyro.cfg.settings', {'server_side_join': True}):
+            tj_2 = pyro.tj.build([r1, r2], dependencies, constraint, source,
+                                 cube, self.cache_file_path)
+
+        mock_join.assert_not_called()
+        metadata = MetaData(cube, reflect=True)
+        results = []
+        with cube.connect() as conn:
+            for tj in (tj_1, tj_2):
+                s = metadata.tables[tj['name']].select()
+                records = conn.execute(s).fetchall()
+                results.append(sorted(map(dict, records),
+                                      key=lambda r: str(sorted(r.items()))))
+
+        self.assertEqual(len(results[0]), 3)
+        self.assertEqual(results[0], results[1])
+
+    def test_bitmap_vector_with_cache(self):
+        """
+        Bitmap vectors of restored rows should be translated to the mapping
+        of the new TJ
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'C': Integer},
+              'pk': {'A', 'B'}}
+        r2 = {'name': 'R2', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        constraint = []
+        dependencies = [{'left': {'C'}, 'right': {'D'}}]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t2 = Table('R2', metadata,
+                   Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        # populate with data
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [
+                {'A': 1, 'B': 2, 'C': 3},
+                {'A': 1, 'B': 22, 'C': None}
+            ])
+            conn.execute(t2.insert(), [
+                {'C': 3, 'D': 4},
+                {'C': 33, 'D': 44}
+            ])
+
+        with patch.dict('pyro.cfg.settings', {'vector_encoding': 'bitmap'}):
+            tj_2 = pyro.tj.build([r2], dependencies, constraint, source,
+                                 cube, self.cache_file_path)
+            with patch('pyro.cache.Cache.restore_packs', autospec=True,
+                       side_effect=pyro.tj.Cache.restore_packs) \
+                    as mock_restore:
+                tj = pyro.tj.build([r1, r2], dependencies, constraint, source,
+                                   cube, self.cache_file_path)
+
+        self.assertEqual(tj_2['vector_relations'], ['R2'])
+        self.assertEqual(tj['vector_relations'], ['R1', 'R2'])
+        self.assertEqual(mock_restore.call_count, 1)
+        metadata = MetaData(cube, reflect=True)
+        with cube.connect() as conn:
+            s = metadata.tables[tj['name']].select()
+            all_records = conn.execute(s).fetchall()
+        vectors = {(r['A'], r['B'], r['C'], r['D']): r['g']
+                   for r in all_records}
+        self.assertEqual(vectors, {(1, 22, None, None): 0b01,
+                                   (None, None, 33, 44): 0b10,
+                                   (1, 2, 3, 4): 0b11})
+
+    def test_restore_packs_at_once(self):
+        """
+        All packs covered by cache should be restored by a single statement,
+        including packs whose constraint is contradicting: it's unknown for
+        the rows having NULL values
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        r3 = {'name': 'R3', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}},
+                        {'left': {'C'}, 'right': {'D'}}]
+        constraint = [[{'attribute': 'C', 'operation': '>', 'value': 5},
+                       {'attribute': 'C', 'operation': '<', 'value': 2}],
+                      [{'attribute': 'D', 'operation': '>=', 'value': 7}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t3 = Table('R3', metadata, Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                       {'A': 3, 'B': 3}, {'A': 4, 'B': 5}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': 2},
+                                       {'B': 3, 'C': 3}, {'B': 4, 'C': 4},
+                                       {'B': 6, 'C': None}])
+            conn.execute(t3.insert(), [{'C': 1, 'D': 5}, {'C': 2, 'D': 7},
+                                       {'C': 3, 'D': 9}, {'C': 5, 'D': 8}])
+        context = [r1, r2, r3]
+
+        def rows(engine, tj):
+            return sorted(pyro.db.get_rows(engine, tj),
+                          key=lambda r: str(sorted(r.items())))
+
+        pyro.tj.build(context, dependencies, [], source, cube,
+                      self.cache_file_path)
+        with patch('pyro.db.insert_from_select', autospec=True,
+                   side_effect=pyro.db.insert_from_select) as mock_insert, \
+                patch('pyro.cache.Cache.restore_packs', autospec=True,
+                      side_effect=pyro.tj.Cache.restore_packs) as mock_restore:
+            tj = pyro.tj.build(context, dependencies, constraint, source,
+                               cube, self.cache_file_path)
+        cube_2 = create_engine('sqlite://')
+        with TemporaryDirectory() as cache_dir:
+            tj_scratch = pyro.tj.build(context, dependencies, constraint,
+                                       source, cube_2,
+                                       os.path.join(cache_dir, 'cache.json'))
+
+        self.assertEqual(rows(cube, tj), rows(cube_2, tj_scratch))
+        self.assertEqual(mock_insert.call_count, 1)
+        packs = mock_restore.call_args[0][3]
+        self.assertEqual(len(packs), 6)
+        # constraint is contradicting for R2 pack, but unknown for NULL C
+        self.assertIn((6, None), [(r['B'], r['C']) for r in rows(cube, tj)])
+
+    def test_required_attributes(self):
+        """
+        TJ built for the required attributes should be the projection of the
+        full one, and full TJ should be restored from cache for it
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'X': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer,
+                                           'Y': Integer},
+              'pk': {'B'}}
+        dependencies = [{'left': {'A'}, 'right': {'B', 'X'}},
+                        {'left': {'B'}, 'right': {'C', 'Y'}}]
+        constraint = [[{'attribute': 'Y', 'operation': '<', 'value': 30}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer), Column('X', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer), Column('Y', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1, 'X': 10},
+                                       {'A': 2, 'B': 2, 'X': 10},
+                                       {'A': 3, 'B': 5, 'X': 30}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1, 'Y': 10},
+                                       {'B': 2, 'C': 1, 'Y': 30},
+                                       {'B': 3, 'C': 3, 'Y': 20}])
+        context = [r1, r2]
+
+        def rows(tj, attributes):
+            return sorted((tuple(r[a] for a in attributes)
+                           for r in pyro.db.get_rows(cube, tj)), key=str)
+
+        tj = pyro.tj.build(context, dependencies, constraint, source, cube,
+                           self.cache_file_path, {'C'})
+        self.assertEqual(set(tj['attributes']), {'A', 'B', 'C', 'Y', 'g'})
+        # cached TJ lacks X, so it's neither matched nor restored
+        tj_full = pyro.tj.build(context, dependencies, constraint, source,
+                                cube, self.cache_file_path)
+        self.assertNotEqual(tj_full['name'], tj['name'])
+        self.assertIn('X', tj_full['attributes'])
+        self.assertEqual(rows(tj, ['A', 'B', 'C', 'Y', 'g']),
+                         rows(tj_full, ['A', 'B', 'C', 'Y', 'g']))
+        # the first TJ is still matched for the required attributes
+        tj_2 = pyro.tj.build(context, dependencies, constraint, source, cube,
+                             self.cache_file_path, {'C'})
+        self.assertEqual(tj_2['name'], tj['name'])
+
+
+class ChainTestCase(DatabaseTestCase):
+    """TestCase class building TJs of the chain of relations R1, R2, ..."""
+
+    def create_chain(self, *data):
+        """
+        Create the chain of relations R1(A, B), R2(B, C), ... in the source
+        DB, key of each relation determining the other attribute
+
+        :param data: lists of rows of each of the relations
+        :return: tuple (context, dependencies)
+        """
+        metadata = MetaData(self.engine, reflect=True)
+        context, dependencies = [], []
+        for i, rows in enumerate(data):
+            key, value = 'ABCDEFGH'[i:i + 2]
+            relation = {'name': 'R{}'.format(i + 1),
+                        'attributes': {key: Integer, value: Integer},
+                        'pk': {key}}
+            table = Table(relation['name'], metadata,
+                          Column(key, Integer, primary_key=True),
+                          Column(value, Integer))
+            table.create()
+            with self.engine.connect() as conn:
+                conn.execute(table.insert(), rows)
+            context.append(relation)
+            dependencies.append({'left': {key}, 'right': {value}})
+        return context, dependencies
+
+    def build_fresh(self, context, dependencies, constraint, cube):
+        """
+        Build TJ from scratch without any cache
+
+        :return: TJ relation
+        """
+        with TemporaryDirectory() as directory:
+            return pyro.tj.build(context, dependencies, constraint,
+                                 self.engine, cube,
+                                 os.path.join(directory, 'cache.json'))
+
+    @staticmethod
+    def sorted_rows(engine, tj):
+        return sorted(pyro.db.get_rows(engine, tj),
+                      key=lambda r: str(sorted(r.items())))
+
+
+class TestPushedConstraint(ChainTestCase):
+    def test_filtered_packs(self):
+        """
+        Rows of the packs should be filtered while joined only if they can't
+        subordinate rows surviving in the contained packs
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        r3 = {'name': 'R3', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        constraint = [[{'attribute': 'B', 'operation': 'IN',
+                        'value': [1, 2]}]]
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}},
+                        {'left': {'C'}, 'right': {'D'}}]
+        context = [r1, r2, r3]
+        tj = pyro.tj.create_tj_schema(context, dependencies)
+        vectors = {pyro.tj.vector_value(tj, relations): relations
+                   for relations in ([r1], [r2], [r3], [r1, r2], [r2, r3],
+                                     context)}
+
+        self.assertEqual(pyro.tj._pushed_constraint(constraint, tj, [r1, r2],
+                                                    vectors),
+                         constraint)
+        # R3 rows aren't filtered, so rows joined with them are needed
+        self.assertIsNone(pyro.tj._pushed_constraint(constraint, tj,
+                                                     [r2, r3], vectors))
+
+    def test_build(self):
+        """
+        TJ built with constraints pushed into the join queries should be the
+        same as the one built without them
+        """
+        context, dependencies = self.create_chain(
+            [{'A': 1, 'B': 1}, {'A': 2, 'B': 2}, {'A': 3, 'B': 3},
+             {'A': 4, 'B': None}, {'A': 5, 'B': 5}],
+            [{'B': 1, 'C': 1}, {'B': 3, 'C': 3}, {'B': 4, 'C': 4}])
+        constraint = [[{'attribute': 'B', 'operation': 'IN',
+                        'value': [1, 2]}]]
+
+        results = []
+        for setting in ({'server_side_join': False},
+                        {'server_side_join': True}):
+            cube = create_engine('sqlite://')
+            with patch.dict('pyro.cfg.settings', setting):
+                with patch('pyro.db.natural_join_batches', autospec=True,
+                           side_effect=pyro.db.natural_join_batches) \
+                        as mock_join:
+                    tj = self.build_fresh(context, dependencies, constraint,
+                                          cube)
+                with patch('pyro.tj._pushed_constraint', return_value=None):
+                    tj_unfiltered = self.build_fresh(context, dependencies,
+                                                     constraint, cube)
+            results.append(self.sorted_rows(cube, tj))
+            self.assertEqual(results[-1], self.sorted_rows(cube,
+                                                           tj_unfiltered))
+            if not setting['server_side_join']:
+                self.assertTrue(all(call[1]['pushed_constraint']
+                                    for call in mock_join.call_args_list))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0]), 3)
+
+
+class TestPackOrder(ChainTestCase):
+    def test_build(self):
+        """
+        TJ built from the largest relation packs to the smallest ones should
+        be the same as the one built the other way round, though subordinate
+        rows are never inserted
+        """
+        context, dependencies = self.create_chain(
+            [{'A': 1, 'B': 1}, {'A': 2, 'B': 2}, {'A': 3, 'B': 3},
+             {'A': 4, 'B': None}],
+            [{'B': 1, 'C': 1}, {'B': 2, 'C': 2}, {'B': 4, 'C': None}])
+        # rows failing the constraint still subordinate the smaller packs'
+        # rows
+        constraint = [[{'attribute': 'C', 'operation': '>', 'value': 1}]]
+
+        def build(setting):
+            cube = create_engine('sqlite://')
+            with patch.dict('pyro.cfg.settings', setting), \
+                    patch('pyro.db.insert_rows', autospec=True,
+                          side_effect=pyro.db.insert_rows) as mock_insert:
+                tj = self.build_fresh(context, dependencies, constraint, cube)
+            inserted = sum(len(list(call[0][2]))
+                           for call in mock_insert.call_args_list)
+            return self.sorted_rows(cube, tj), inserted
+
+        for engine in ('python', 'sql'):
+            settings = {'server_side_join': False,
+                        'subordination_engine': engine}
+            rows, inserted = build(settings)
+            rows_largest_first, inserted_largest_first = build(
+                dict(settings, pack_order='largest_first'))
+
+            self.assertEqual(rows_largest_first, rows)
+            self.assertEqual(len(rows), 4)
+            if engine == 'python':
+                # SQL engine inserts all rows into staging table anyway
+                self.assertLess(inserted_largest_first, inserted)
+
+
+class TestSubJoinMemo(ChainTestCase):
+    def test_build(self):
+        """
+        TJ built with joins of the packs derived from the memoized ones
+        should be the same as the one built by the source DB joins
+        """
+        context, dependencies = self.create_chain(
+            [{'A': 1, 'B': 1}, {'A': 2, 'B': 2}, {'A': 3, 'B': None}],
+            [{'B': 1, 'C': 1}, {'B': 2, 'C': 2}, {'B': 3, 'C': 3}],
+            [{'C': 1, 'D': 1}, {'C': 3, 'D': 3}, {'C': 4, 'D': None}])
+
+        def build(setting):
+            cube = create_engine('sqlite://')
+            with patch.dict('pyro.cfg.settings', setting):
+                tj = self.build_fresh(context, dependencies, [], cube)
+            return self.sorted_rows(cube, tj)
+
+        plain = build({'server_side_join': False})
+        with patch('pyro.memo.db.natural_join_batches', autospec=True,
+                   side_effect=pyro.db.natural_join_batches) as mock_join:
+            memoized = build({'server_side_join': False,
+                              'subjoin_memo_rows': 100})
+
+        self.assertEqual(memoized, plain)
+        # packs of all three relations aren't joined by the source DB
+        self.assertTrue(mock_join.called)
+        self.assertTrue(all(len(call[0][1]) < 3
+                            for call in mock_join.call_args_list))
+
+
+class TestPartialCacheHit(ChainTestCase):
+    def setUp(self):
+        self.cache_dir = TemporaryDirectory()
+        self.cache_file_path = os.path.join(self.cache_dir.name, 'cache.json')
+        super(TestPartialCacheHit, self).setUp()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+        super(TestPartialCacheHit, self).tearDown()
+
+    def test_partial_cache_hit(self):
+        """
+        TJ built from partially matching cache entry and the rows missing in
+        it should be the same as the one built from scratch
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        r3 = {'name': 'R3', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}},
+                        {'left': {'C'}, 'right': {'D'}}]
+        cached_constraint = [[{'attribute': 'D', 'operation': 'BETWEEN',
+                               'value': [4, 6]}]]
+        constraint = [[{'attribute': 'D', 'operation': 'BETWEEN',
+                        'value': [4, 8]}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t3 = Table('R3', metadata, Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                       {'A': 3, 'B': 3}, {'A': 4, 'B': 5}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': 2},
+                                       {'B': 3, 'C': 3}, {'B': 4, 'C': 4}])
+            conn.execute(t3.insert(), [{'C': 1, 'D': 5}, {'C': 2, 'D': 7},
+                                       {'C': 3, 'D': 9}, {'C': 5, 'D': 8}])
+        context = [r1, r2, r3]
+
+        def rows(tj):
+            return sorted(pyro.db.get_rows(cube, tj),
+                          key=lambda r: str(sorted(r.items())))
+
+        pyro.tj.build(context, dependencies, cached_constraint, source, cube,
+                      self.cache_file_path)
+        with patch('pyro.db.natural_join_batches', autospec=True,
+                   side_effect=pyro.db.natural_join_batches) as mock_join, \
+                patch.dict('pyro.cfg.settings', {'server_side_join': False}):
+            tj_partial = pyro.tj.build(context, dependencies, constraint,
+                                       source, cube, self.cache_file_path)
+        tj_full = self.build_fresh(context, dependencies, constraint, cube)
+
+        self.assertNotEqual(tj_partial['name'], tj_full['name'])
+        self.assertEqual(rows(tj_partial), rows(tj_full))
+        self.assertIn((2, 2, 2, 7),
+                      [(r['A'], r['B'], r['C'], r['D'])
+                       for r in rows(tj_partial)])
+        # only the packs rows might be missing in cache for are joined
+        self.assertTrue(mock_join.called)
+        for call in mock_join.call_args_list:
+            self.assertIn('R3', [r['name'] for r in call[0][1]])
+
+    def test_partial_cache_hit_subordinate_delta(self):
+        """
+        Rows missing in cache of the smaller packs should be subordinated by
+        the rows missing in cache of the larger packs
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}}]
+        cached_constraint = [[{'attribute': 'A', 'operation': '=',
+                               'value': 1}]]
+        constraint = [[{'attribute': 'A', 'operation': '<=', 'value': 3}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                       {'A': 3, 'B': 3}, {'A': 4, 'B': 4}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': None},
+                                       {'B': 4, 'C': 4}])
+        context = [r1, r2]
+
+        def rows(tj):
+            return sorted(((r['A'], r['B'], r['C'])
+                           for r in pyro.db.get_rows(cube, tj)), key=str)
+
+        for engine in ('python', 'sql'):
+            with patch.dict('pyro.cfg.settings',
+                            {'server_side_join': False,
+                             'subordination_engine': engine}):
+                pyro.tj.build(context, dependencies, cached_constraint,
+                              source, cube, self.cache_file_path)
+                tj_partial = pyro.tj.build(context, dependencies, constraint,
+                                           source, cube, self.cache_file_path)
+                tj_full = self.build_fresh(context, dependencies,
+                                           constraint, cube)
+            os.remove(self.cache_file_path)
+            self.assertEqual(rows(tj_partial), rows(tj_full))
+            # R1 row is subordinate to the joined one, both missing in cache
+            self.assertIn((2, 2, None), rows(tj_partial))
+            self.assertEqual(rows(tj_partial).count((2, 2, None)), 1)
+
+
+    def test_projection_not_included(self):
+        """
+        Rows missing in cache should be joined even if the cached constraint
+        includes the given one, as its projection to a pack might not
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}}]
+        # projection to R2 is C = 3, while the given one is empty
+        cached_constraint = [[{'attribute': 'A', 'operation': '<=',
+                               'value': 5}],
+                             [{'attribute': 'C', 'operation': '=',
+                               'value': 3}]]
+        constraint = [[{'attribute': 'A', 'operation': '<=', 'value': 2}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 9, 'C': 1}])
+        context = [r1, r2]
+
+        def rows(tj):
+            return sorted(((r['A'], r['B'], r['C'])
+                           for r in pyro.db.get_rows(cube, tj)), key=str)
+
+        pyro.tj.build(context, dependencies, cached_constraint, source, cube,
+                      self.cache_file_path)
+        tj_cached = pyro.tj.build(context, dependencies, constraint, source,
+                                  cube, self.cache_file_path)
+        tj_full = self.build_fresh(context, dependencies, constraint, cube)
+
+        self.assertEqual(rows(tj_cached), rows(tj_full))
+        self.assertIn((None, 9, 1), rows(tj_cached))
+
+    def test_subordinate_to_dropped_rows(self):
+        """
+        Rows missing in cache should be subordinated by the rows of the
+        larger packs the cached TJ has dropped for failing cached constraint
+        """
+        f = {'name': 'F', 'attributes': {'fk': Integer, 'ak': Integer,
+                                         'mval': Integer},
+             'pk': {'fk'}}
+        a = {'name': 'A', 'attributes': {'ak': Integer, 'aname': String,
+                                         'ck': Integer},
+             'pk': {'ak'}}
+        c = {'name': 'C', 'attributes': {'ck': Integer, 'cname': String},
+             'pk': {'ck'}}
+        dependencies = [{'left': {'fk'}, 'right': {'ak', 'mval'}},
+                        {'left': {'ak'}, 'right': {'aname', 'ck'}},
+                        {'left': {'ck'}, 'right': {'cname'}}]
+        # every pack's projection of the constraint is included in the
+        # cached one but A's, which is empty
+        cached_constraint = [[{'attribute': 'aname', 'operation': '=',
+                               'value': 'a1'}],
+                             [{'attribute': 'mval', 'operation': '>',
+                               'value': 4}]]
+        constraint = [[{'attribute': 'mval', 'operation': '>', 'value': 4}],
+                      [{'attribute': 'cname', 'operation': '=',
+                        'value': 'c0'}]]
+        source = self.engine
+        cube = create_engine('sqlite://')  # additional in-memory DB for test
+        metadata = MetaData(source, reflect=True)
+        tf = Table('F', metadata, Column('fk', Integer, primary_key=True),
+                   Column('ak', Integer), Column('mval', Integer))
+        ta = Table('A', metadata, Column('ak', Integer, primary_key=True),
+                   Column('aname', String), Column('ck', Integer))
+        tc = Table('C', metadata, Column('ck', Integer, primary_key=True),
+                   Column('cname', String))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(tf.insert(), [{'fk': 1, 'ak': 1, 'mval': 1},
+                                       {'fk': 2, 'ak': 2, 'mval': 5}])
+            conn.execute(ta.insert(), [{'ak': 1, 'aname': 'a2', 'ck': None},
+                                       {'ak': 2, 'aname': 'a1', 'ck': 1}])
+            conn.execute(tc.insert(), [{'ck': 1, 'cname': 'c1'}])
+        context = [f, a, c]
+
+        def rows(tj):
+            return sorted(((r['fk'], r['ak'], r['aname'], r['cname'])
+                           for r in pyro.db.get_rows(cube, tj)), key=str)
+
+        pyro.tj.build(context, dependencies, cached_constraint, source, cube,
+                      self.cache_file_path)
+        tj_cached = pyro.tj.build(context, dependencies, constraint, source,
+                                  cube, self.cache_file_path)
+        tj_full = self.build_fresh(context, dependencies, constraint, cube)
+
+        self.assertEqual(rows(tj_cached), rows(tj_full))
+        # A row is subordinate to the F row failing both constraints, which
+        # is only joined in the pack of F and A
+        self.assertNotIn((None, 1, 'a2', None), rows(tj_cached))
+
+
+class TestBuildParallel(DatabaseTestCase):
+    def setUp(self):
+        self.cache_file_path = 'cache.json'
+        fd, self.cube_file = mkstemp(suffix='.db')
+        os.close(fd)
+        super(TestBuildParallel, self).setUp()
+
+    def tearDown(self):
+        os.remove(self.cache_file_path)
+        os.remove(self.cube_file)
+        super(TestBuildParallel, self).tearDown()
+
+    def test_same_as_sequential(self):
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer,
+                                           'C': Integer},
+              'pk': {'A', 'B'}}
+        r2 = {'name': 'R2', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        dependencies = [{'left': {'C'}, 'right': {'D'}}]
+        source = self.engine
+        cube = create_engine('sqlite:///{}'.format(self.cube_file))
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata,
+                   Column('A', Integer, primary_key=True),
+                   Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t2 = Table('R2', metadata,
+                   Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1, 'C': 1},
+                                       {'A': 2, 'B': 2, 'C': 3}])
+            conn.execute(t2.insert(), [{'C': 1, 'D': 5}, {'C': 2, 'D': 6}])
+        jobs = [([r1, r2], []),
+                ([r1], [[{'attribute': 'A', 'operation': '=', 'value': 1}]])]
+
+        tjs = pyro.tj.build_parallel(jobs, dependencies, source, cube,
+                                     self.cache_file_path, 2)
+
+        self.assertEqual(len(tjs), 2)
+        self.assertEqual(set(tjs[0]['attributes']), {'A', 'B', 'C', 'D', 'g'})
+        self.assertEqual(set(tjs[1]['attributes']), {'A', 'B', 'C', 'g'})
+        records = [pyro.db.get_rows(cube, tj) for tj in tjs]
+        self.assertEqual(len(records[0]), 3)
+        self.assertEqual(len(records[1]), 1)
+        with open(self.cache_file_path) as cache_file:
+            self.assertEqual(len(json.load(cache_file)), 2)
+
+    def prepare_chain(self):
+        r1 = {'name': 'R1', 'attributes': {'A': Integer, 'B': Integer},
+              'pk': {'A'}}
+        r2 = {'name': 'R2', 'attributes': {'B': Integer, 'C': Integer},
+              'pk': {'B'}}
+        r3 = {'name': 'R3', 'attributes': {'C': Integer, 'D': Integer},
+              'pk': {'C'}}
+        dependencies = [{'left': {'A'}, 'right': {'B'}},
+                        {'left': {'B'}, 'right': {'C'}},
+                        {'left': {'C'}, 'right': {'D'}}]
+        constraint = [[{'attribute': 'D', 'operation': '<', 'value': 8}]]
+        source = self.engine
+        cube = create_engine('sqlite:///{}'.format(self.cube_file))
+        metadata = MetaData(source, reflect=True)
+        t1 = Table('R1', metadata, Column('A', Integer, primary_key=True),
+                   Column('B', Integer))
+        t2 = Table('R2', metadata, Column('B', Integer, primary_key=True),
+                   Column('C', Integer))
+        t3 = Table('R3', metadata, Column('C', Integer, primary_key=True),
+                   Column('D', Integer))
+        metadata.create_all()
+        with source.connect() as conn:
+            conn.execute(t1.insert(), [{'A': 1, 'B': 1}, {'A': 2, 'B': 2},
+                                       {'A': 3, 'B': 4}])
+            conn.execute(t2.insert(), [{'B': 1, 'C': 1}, {'B': 2, 'C': 2},
+                                       {'B': 3, 'C': 3}])
+            conn.execute(t3.insert(), [{'C': 1, 'D': 5}, {'C': 2, 'D': 9},
+                                       {'C': 4, 'D': 7}])
+        return [r1, r2, r3], dependencies, constraint, source, cube
+
+    def test_concurrent_packs(self):
+        """
+        Check that relation packs joined concurrently give the same TJ as the
+        sequential build
+        """
+        context, dependencies, constraint, source, cube = \
+            self.prepare_chain()
+
+        def rows(tj):
+            return sorted(pyro.db.get_rows(cube, tj),
+                          key=lambda r: str(sorted(r.items())))
+
+        tj_1 = pyro.tj.build(context, dependencies, constraint, source,
+                             cube, self.cache_file_path)
+        os.remove(self.cache_file_path)
+        with patch.dict('pyro.cfg.settings', {'pack_workers': 4}), \
+                patch('pyro.tj._merge_in_python') as mock_merge:
+            tj_2 = pyro.tj.build(context, dependencies, constraint,
+                                 source, cube, self.cache_file_path)
+        mock_merge.assert_not_called()
+        self.assertEqual(rows(tj_1), rows(tj_2))
+        self.assertTrue(rows(tj_1))
+        # staging tables are dropped
+        self.assertEqual(set(MetaData(cube, reflect=True).tables),
+                         {tj_1['name'], tj_2['name']})
+
+    def test_concurrent_packs_error(self):
+        """
+        Check that staging tables of the packs joined concurrently are
+        dropped if merging fails
+        """
+        context, dependencies, constraint, source, cube = \
+            self.prepare_chain()
+        insert_from_select = pyro.db.insert_from_select
+        merged = []
+
+        def fail_second(engine, relation, *args, **kwargs):
+            if merged:
+                raise RuntimeError('merge failed')
+            merged.append(relation)
+            insert_from_select(engine, relation, *args, **kwargs)
+
+        with patch.dict('pyro.cfg.settings', {'pack_workers': 4}), \
+                patch('pyro.db.insert_from_select', side_effect=fail_second):
+            self.assertRaises(RuntimeError, pyro.tj.build, context,
+                              dependencies, constraint, source, cube,
+                              self.cache_file_path)
+        # only TJ is left
+        self.assertEqual(set(MetaData(cube, reflect=True).tables),
+                         {merged[0]['name']})
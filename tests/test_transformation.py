@@ -1,7 +1,8 @@
 from unittest import TestCase
+from unittest.mock import patch
 
 from pyro.transformation import closure, prioritized_relations, contexts, \
-    existing_join
+    existing_join, DependencyIndex, search_contexts
 
 
 class TestClosure(TestCase):
@@ -27,6 +28,44 @@ class TestClosure(TestCase):
                          {'A', 'B', 'C', 'D', 'E'})
 
 
+class TestDependencyIndex(TestCase):
+    def setUp(self):
+        self.dependencies = [
+            {'left': {'A', 'B'}, 'right': {'C'}},
+            {'left': {'B', 'C'}, 'right': {'A', 'D'}},
+            {'left': {'D'}, 'right': {'E'}},
+            {'left': {'C', 'F'}, 'right': {'B'}},
+        ]
+
+    def test_closure(self):
+        index = DependencyIndex(self.dependencies)
+        self.assertEqual(index.closure({'D'}), {'D', 'E'})
+        self.assertEqual(index.closure({'A', 'B'}),
+                         {'A', 'B', 'C', 'D', 'E'})
+        self.assertEqual(index.closure({'C', 'F'}),
+                         {'A', 'B', 'C', 'D', 'E', 'F'})
+        self.assertEqual(closure({'A', 'B'}, index),
+                         {'A', 'B', 'C', 'D', 'E'})
+
+    def test_empty_left_side(self):
+        index = DependencyIndex([{'left': set(), 'right': {'A'}},
+                                 {'left': {'A'}, 'right': {'B'}}])
+        self.assertEqual(index.closure(set()), {'A', 'B'})
+
+    def test_memoized(self):
+        index = DependencyIndex(self.dependencies)
+        result = index.closure({'A', 'B'})
+        result.add('Z')
+        self.assertEqual(index.closure(['B', 'A']),
+                         {'A', 'B', 'C', 'D', 'E'})
+        self.assertEqual(index._cached_closure.cache_info().hits, 1)
+
+    def test_dependencies_list(self):
+        index = DependencyIndex(self.dependencies)
+        self.assertEqual(list(index), self.dependencies)
+        self.assertEqual(len(index), 4)
+
+
 class TestExistingJoin(TestCase):
     def test_no_intersections(self):
         """
@@ -64,6 +103,20 @@ class TestExistingJoin(TestCase):
         result = existing_join([r1, r2, r3, r4, r5])
         self.assertEqual(result, [r1, r3, r5, r2, r4])
 
+    def test_relations_not_copied(self):
+        """
+        Check that relations are neither copied nor reordered in place
+        """
+        r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'B': 'INT'}}
+        r2 = {'name': 'R2', 'attributes': {'C': 'INT', 'D': 'INT'}}
+        r3 = {'name': 'R3', 'attributes': {'B': 'INT', 'C': 'INT'}}
+        relations = [r1, r2, r3]
+
+        result = existing_join(relations)
+        self.assertEqual([r['name'] for r in result], ['R1', 'R3', 'R2'])
+        self.assertTrue(all(r is o for r, o in zip(result, [r1, r3, r2])))
+        self.assertEqual(relations, [r1, r2, r3])
+
 
 class TestPrioritizedRelations(TestCase):
     def test_all_low_priority(self):
@@ -210,3 +263,56 @@ class TestContexts(TestCase):
         self.assertEqual(next(contexts_gen), [r1])
         self.assertEqual(next(contexts_gen), [r1, r2, r3])
         self.assertRaises(StopIteration, next, contexts_gen)
+
+
+class TestSearchContexts(TestCase):
+    def setUp(self):
+        self.r1 = {'name': 'R1', 'attributes': {'A': 'INT', 'D': 'INT'},
+                   'pk': {'A'}}
+        self.r2 = {'name': 'R2', 'attributes': {'A': 'INT', 'C': 'INT'},
+                   'pk': {'A'}}
+        self.r3 = {'name': 'R3', 'attributes': {'B': 'INT', 'C': 'INT',
+                                                'D': 'INT'},
+                   'pk': {'B', 'C'}}
+        self.deps = [
+            {'left': {'A'}, 'right': {'B'}},
+            {'left': {'B'}, 'right': {'C'}},
+            {'left': {'C', 'D'}, 'right': {'A'}},
+        ]
+
+    def test_first_context_same_as_exhaustive(self):
+        relations = [self.r1, self.r2, self.r3]
+        for base in (['R1'], ['R1', 'R3'], ['R2', 'R3']):
+            self.assertEqual(
+                next(search_contexts(relations, base, self.deps)),
+                next(contexts(relations, base, self.deps)))
+
+    def test_supersets_pruned(self):
+        contexts_gen = search_contexts([self.r1, self.r2, self.r3], ['R1'],
+                                       self.deps)
+        self.assertEqual(next(contexts_gen), [self.r1])
+        self.assertRaises(StopIteration, next, contexts_gen)
+
+    def test_disconnected_pruned(self):
+        """
+        Check that relations not intersecting with the context are not added
+        """
+        r4 = {'name': 'R4', 'attributes': {'E': 'INT'}, 'pk': {'E'}}
+        with patch('pyro.transformation.chase',
+                   return_value=False) as chase_mock:
+            list(search_contexts([self.r1, r4], ['R1'], []))
+        self.assertEqual(chase_mock.call_count, 1)
+
+    def test_max_expansions(self):
+        contexts_gen = search_contexts([self.r1, self.r2, self.r3],
+                                       ['R1', 'R3'], self.deps,
+                                       max_expansions=1)
+        self.assertRaises(StopIteration, next, contexts_gen)
+
+    def test_time_limit(self):
+        with patch('pyro.transformation.time.monotonic',
+                   side_effect=[0, 0, 10]):
+            contexts_gen = search_contexts([self.r1, self.r2, self.r3],
+                                           ['R1', 'R3'], self.deps,
+                                           time_limit=5)
+            self.assertRaises(StopIteration, next, contexts_gen)
@@ -2,7 +2,7 @@ from datetime import datetime
 from unittest import TestCase
 
 from pyro.utils import containing_relation, min_dict, all_equal, \
-    all_attributes, chunks, assemble_list, xstr
+    all_attributes, chunks, assemble_list, xstr, batches
 
 
 class TestAllAttributes(TestCase):
@@ -156,6 +156,18 @@ class TestChunks(TestCase):
         self.assertRaises(StopIteration, next, _chunks)
 
 
+class TestBatches(TestCase):
+    def test_generator(self):
+        _batches = batches((i for i in range(5)), 2)
+        self.assertEqual(next(_batches), [0, 1])
+        self.assertEqual(next(_batches), [2, 3])
+        self.assertEqual(next(_batches), [4])
+        self.assertRaises(StopIteration, next, _batches)
+
+    def test_empty(self):
+        self.assertEqual(list(batches([], 2)), [])
+
+
 class TestAssembleList(TestCase):
     def test_mixed(self):
         """